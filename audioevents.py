@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Audio trouble, picked out of the children's output as it is pumped.
+
+The players and the daemon already say when something goes wrong - an
+underrun, a dropped connection, a new sample rate - but only in lines that
+scroll past. Each service's rules are compiled at import into one alternation,
+so a line costs a single regex search whatever the number of rules, on the raw
+bytes before anything decodes them. A match becomes a typed event: a running
+total per type, and the times of the recent ones for a per-minute rate.
+
+A connection is only news once it has been lost. The players say "connected
+to" on every start too, so that line counts as a reconnect only when it is
+not the first of the process's life and no lost connection has been counted
+for it already.
+"""
+import re
+import threading
+import time
+from collections import deque
+
+TYPES = ("underrun", "reconnect", "format_change", "buffer_resize")
+RECENT = 256             # events remembered for the per-minute rate
+RATE_WINDOW_S = 60
+
+# (type, pattern) per service, matched case-insensitively anywhere in a line.
+# These follow what each program prints at its default log level. "lost" and
+# "connect" are not types of their own: both end up as reconnects (see feed).
+RULES = {
+    "pulseaudio": [
+        ("underrun", rb"underrun"),
+        ("format_change", rb"changing sample rate|sample rate changed|sample spec changed"),
+        ("buffer_resize", rb"(?:requested|adjust(?:ed|ing)?) latency|latency (?:changed|adjusted)"),
+    ],
+    "snapclient": [
+        ("underrun", rb"underrun|xrun"),
+        ("lost", rb"reconnect|connection (?:lost|refused|reset)"),
+        ("connect", rb"connected to"),
+        ("format_change", rb"sample ?format"),
+        ("buffer_resize", rb"\bbuffer(?:ms)?\s*[:=]\s*\d+"),
+    ],
+    "squeezelite": [
+        ("underrun", rb"underrun"),
+        ("lost", rb"reconnect|connection (?:lost|closed|refused)"),
+        ("connect", rb"connected to"),
+        ("format_change", rb"sample rate|resampl"),
+        ("buffer_resize", rb"buffer (?:size|resize)"),
+    ],
+}
+
+
+def _compile(rules):
+    parts = ["(?P<%s__%d>%s)" % (kind, i, pattern.decode())
+             for i, (kind, pattern) in enumerate(rules)]
+    return re.compile(("(?i)" + "|".join(parts)).encode())
+
+
+_COMPILED = {name: _compile(rules) for name, rules in RULES.items()}
+
+
+class Extractor:
+    """One service's events. The pump feeds it; the loop reads it."""
+
+    def __init__(self, service):
+        self._pattern = _COMPILED.get(service)
+        self.totals = dict.fromkeys(TYPES, 0)
+        self._recent = deque(maxlen=RECENT)  # (monotonic time, type)
+        self.last = None                     # (type, the line) of the latest
+        self._snap = None                    # snapshot() until the next event
+        self._connected = False              # this process has connected once
+        self._lost = False                   # ...and a loss is already counted
+        self._lock = threading.Lock()
+
+    def started(self):
+        """A new process: its first connection is not a reconnect."""
+        self._connected = self._lost = False
+
+    def feed(self, raw, now=None):
+        """Look at one line; returns the event type it was, if any."""
+        if self._pattern is None:
+            return None
+        match = self._pattern.search(raw)
+        if match is None:
+            return None
+        kind = match.lastgroup.split("__", 1)[0]
+        if kind == "connect":
+            counted = not self._connected or self._lost
+            self._connected, self._lost = True, False
+            if counted:
+                return None
+            kind = "reconnect"
+        elif kind == "lost":
+            self._lost = True
+            kind = "reconnect"
+        with self._lock:
+            self.totals[kind] += 1
+            self._recent.append((time.monotonic() if now is None else now, kind))
+            self.last = (kind, raw)
+            self._snap = None
+        return kind
+
+    def snapshot(self):
+        """(totals, recent event times, last) as plain values to publish.
+        The loop asks every tick; only an event makes it build a new one."""
+        with self._lock:
+            if self._snap is None:
+                last = None
+                if self.last is not None:
+                    last = {"type": self.last[0],
+                            "line": self.last[1].decode("utf-8", errors="replace")}
+                self._snap = (dict(self.totals), tuple(self._recent), last)
+            return self._snap
+
+
+def per_minute(recent, now):
+    """Events of each type in the last RATE_WINDOW_S; RECENT caps the count."""
+    out = dict.fromkeys(TYPES, 0)
+    for when, kind in recent:
+        if now - when <= RATE_WINDOW_S:
+            out[kind] += 1
+    return out
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Per-service cgroup v2 quotas, when the container has a subtree to give.
+
+Given a delegated cgroup (one this process may write to), the supervisor moves
+itself into a leaf of it, enables the cpu, io and memory controllers for the
+rest, and gives each service a sibling cgroup of its own: cpu.max caps it
+outright, cpu.weight and io.weight share out what contention there is, and
+cpu.stat and memory.current say what it has actually used. Without one -
+Docker mounts /sys/fs/cgroup read-only unless told otherwise - none of this
+happens and the services run as they always did.
+
+Every path is under a root the caller passes in, so tests can point it at a
+plain directory laid out like cgroupfs.
+"""
+import os
+
+MOUNT = "/sys/fs/cgroup"
+CONTROLLERS = ("cpu", "io", "memory")
+CPU_PERIOD_US = 100000
+SUPERVISOR_LEAF = "supervisor"
+
+# What a service gets with nothing set: no cap, and the kernel's default share.
+DEFAULTS = {"cpu_max": 0, "cpu_weight": 100, "io_weight": 100}
+
+
+def detect(mount=None):
+    """This process's own cgroup, if it is v2 and ours to divide; else None."""
+    mount = mount or MOUNT
+    try:
+        with open("/proc/self/cgroup") as handle:
+            lines = handle.read().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        if line.startswith("0::"):
+            path = os.path.join(mount, line[3:].strip().lstrip("/"))
+            if (os.path.exists(os.path.join(path, "cgroup.controllers"))
+                    and os.access(os.path.join(path, "cgroup.subtree_control"), os.W_OK)):
+                return path
+    return None
+
+
+def _write(path, value):
+    with open(path, "w") as handle:
+        handle.write(value)
+
+
+def _read(path):
+    with open(path) as handle:
+        return handle.read()
+
+
+class Tree:
+    """The delegated subtree: one leaf for us, one cgroup per service."""
+
+    def __init__(self, root):
+        self.root = root
+        self.controllers = set()
+
+    def setup(self):
+        """Move into the leaf and enable the controllers for the services.
+
+        cgroup v2 lets a cgroup with processes in it hand controllers to its
+        children only if it has none of its own, so the supervisor moves out
+        of the root first. Raises OSError if the subtree will not have it.
+        """
+        leaf = os.path.join(self.root, SUPERVISOR_LEAF)
+        os.makedirs(leaf, exist_ok=True)
+        _write(os.path.join(leaf, "cgroup.procs"), str(os.getpid()))
+        available = _read(os.path.join(self.root, "cgroup.controllers")).split()
+        wanted = [c for c in CONTROLLERS if c in available]
+        if wanted:
+            _write(os.path.join(self.root, "cgroup.subtree_control"),
+                   " ".join("+" + c for c in wanted))
+        self.controllers = set(wanted)
+
+    def place(self, name, pid, settings):
+        """Put `pid` in the service's cgroup, with its settings applied first.
+        Returns what could not be done, as text."""
+        failed = self.apply(name, settings)
+        try:
+            _write(os.path.join(self.root, name, "cgroup.procs"), str(pid))
+        except OSError as exc:
+            failed.append("cgroup.procs: %s" % exc.strerror)
+        return failed
+
+    def apply(self, name, settings):
+        """Write the service's quotas, creating its cgroup if need be."""
+        try:
+            os.makedirs(os.path.join(self.root, name), exist_ok=True)
+        except OSError as exc:
+            return ["cgroup: %s" % exc.strerror]
+        settings = dict(DEFAULTS, **settings)
+        try:
+            cpu_max, cpu_weight, io_weight = (
+                int(settings[key]) for key in ("cpu_max", "cpu_weight", "io_weight"))
+        except (TypeError, ValueError) as exc:
+            # Checked when stored; anything else is reported, never written.
+            return ["cgroup: %s" % exc]
+        quota = cpu_max * CPU_PERIOD_US // 100
+        files = []
+        if "cpu" in self.controllers:
+            files.append(("cpu.max", "%s %d" % (quota or "max", CPU_PERIOD_US)))
+            files.append(("cpu.weight", str(cpu_weight)))
+        if "io" in self.controllers:
+            files.append(("io.weight", "default %d" % io_weight))
+        failed = []
+        for filename, value in files:
+            try:
+                _write(os.path.join(self.root, name, filename), value)
+            except OSError as exc:
+                failed.append("%s: %s" % (filename, exc.strerror))
+        return failed
+
+    def usage(self, name):
+        """{"cpu_usec", "memory"} the service's cgroup has used; None where a
+        counter cannot be read."""
+        path = os.path.join(self.root, name)
+        out = {"cpu_usec": None, "memory": None}
+        try:
+            for line in _read(os.path.join(path, "cpu.stat")).splitlines():
+                key, _, value = line.partition(" ")
+                if key == "usage_usec":
+                    out["cpu_usec"] = int(value)
+        except (OSError, ValueError):
+            pass
+        try:
+            out["memory"] = int(_read(os.path.join(path, "memory.current")))
+        except (OSError, ValueError):
+            pass
+        return out
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Each service's resource usage over the last day, in a fixed amount of memory.
+
+The loop adds one sample per service each time it reads /proc (see procstat):
+CPU %, RSS, restarts so far, and whether it was up. Samples go into rings of
+preallocated arrays, so the cost is known at boot and does not grow over a
+week: the raw ring holds a day of samples, and coarser rings hold the min, max
+and mean of each minute and each ten minutes of the same day. A query for a
+long range is answered from a coarse ring, so reading a day's chart does not
+mean walking every sample in it.
+
+Slots are numbered by monotonic time divided by the ring's step; each slot
+remembers which number it holds, so a stale slot from a lap ago, or a gap
+while the sampler was off, reads as no data rather than as old data.
+"""
+import math
+import threading
+import time
+from array import array
+
+HISTORY_S = 24 * 3600    # how far back every ring reaches
+ROLLUPS_S = (60, 600)    # steps of the coarser rings
+FIELDS = ("cpu_percent", "rss", "restarts", "up")
+
+
+def _round(value):
+    # The rings hold float32; its last digits are noise, not precision.
+    return None if value is None else round(value, 2)
+
+
+class _Ring:
+    """One resolution. A raw ring keeps each sample; a rollup ring keeps, per
+    field, the min, max, sum and count of the samples in each slot."""
+
+    def __init__(self, step, span, raw):
+        self.step = step
+        self.slots = max(1, int(span // step))
+        self.raw = raw
+        self.last = None         # newest slot number written
+        self._stamp = array("I", bytes(4 * self.slots))  # slot number + 1; 0 = empty
+        floats = bytes(4 * self.slots)
+        if raw:
+            self._val = [array("f", floats) for _ in FIELDS]
+        else:
+            self._min = [array("f", floats) for _ in FIELDS]
+            self._max = [array("f", floats) for _ in FIELDS]
+            self._sum = [array("d", bytes(8 * self.slots)) for _ in FIELDS]
+            self._count = [array("I", floats) for _ in FIELDS]
+
+    @property
+    def nbytes(self):
+        arrays = [self._stamp] + (self._val if self.raw else
+                                  self._min + self._max + self._sum + self._count)
+        return sum(a.itemsize * len(a) for a in arrays)
+
+    def add(self, n, values):
+        pos = n % self.slots
+        fresh = self._stamp[pos] != n + 1
+        self._stamp[pos] = n + 1
+        self.last = n if self.last is None else max(self.last, n)
+        if self.raw:
+            # Two samples in one slot (timer jitter): the later one stands.
+            for col, value in zip(self._val, values):
+                col[pos] = value
+            return
+        for i, value in enumerate(values):
+            if fresh:
+                self._count[i][pos] = 0
+                self._sum[i][pos] = 0.0
+            if math.isnan(value):
+                continue
+            if not self._count[i][pos]:
+                self._min[i][pos] = self._max[i][pos] = value
+            else:
+                self._min[i][pos] = min(self._min[i][pos], value)
+                self._max[i][pos] = max(self._max[i][pos], value)
+            self._sum[i][pos] += value
+            self._count[i][pos] += 1
+
+    def slots_between(self, lo, hi):
+        """(n, [(min, max, sum, count) per field]) for slots lo..hi that hold
+        data, oldest first."""
+        if self.last is None:
+            return
+        lo = max(lo, self.last - self.slots + 1, 0)
+        hi = min(hi, self.last)
+        for n in range(lo, hi + 1):
+            pos = n % self.slots
+            if self._stamp[pos] != n + 1:
+                continue
+            if self.raw:
+                values = [col[pos] for col in self._val]
+                yield n, [(None, None, 0.0, 0) if math.isnan(v) else (v, v, v, 1)
+                          for v in values]
+            else:
+                yield n, [(self._min[i][pos], self._max[i][pos], self._sum[i][pos],
+                           self._count[i][pos]) for i in range(len(FIELDS))]
+
+
+class History:
+    """A day of one service's samples, at `step` seconds and coarser."""
+
+    def __init__(self, step=1, span=None):
+        span = span or HISTORY_S
+        self.step = step
+        self._rings = [_Ring(step, span, raw=True)]
+        self._rings += [_Ring(s, span, raw=False) for s in ROLLUPS_S if s > step]
+        # The loop adds while a panel thread queries.
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """Memory held by the rings, fixed at construction."""
+        return sum(ring.nbytes for ring in self._rings)
+
+    def add(self, now, cpu_percent, rss, restarts, up):
+        """Record a sample taken at monotonic time `now`; None is no data."""
+        values = [math.nan if v is None else float(v) for v in (cpu_percent, rss, restarts, up)]
+        with self._lock:
+            for ring in self._rings:
+                ring.add(int(now // ring.step), values)
+
+    def query(self, start, stop, points):
+        """The samples between Unix times `start` and `stop`, merged into at
+        most `points` equal buckets: per field, each bucket's min, max and
+        mean, or None where there was nothing to merge."""
+        offset = time.time() - time.monotonic()
+        points = max(1, int(points))
+        width = max((stop - start) / points, 1e-9)
+        # The coarsest ring whose slots still fit inside one bucket.
+        ring = self._rings[0]
+        for candidate in self._rings[1:]:
+            if candidate.step <= width:
+                ring = candidate
+        lo = int((start - offset) // ring.step)
+        hi = int((stop - offset) // ring.step)
+        acc = [[[None, None, 0.0, 0] for _ in FIELDS] for _ in range(points)]
+        with self._lock:
+            rows = list(ring.slots_between(lo, hi))
+        for n, fields in rows:
+            b = int((n * ring.step + offset - start) // width)
+            bucket = acc[min(max(b, 0), points - 1)]
+            for cell, (mn, mx, total, count) in zip(bucket, fields):
+                if not count:
+                    continue
+                cell[0] = mn if cell[0] is None else min(cell[0], mn)
+                cell[1] = mx if cell[1] is None else max(cell[1], mx)
+                cell[2] += total
+                cell[3] += count
+        out = {"t": [round(start + (i + 0.5) * width, 3) for i in range(points)],
+               "step": round(width, 3), "resolution": ring.step}
+        for i, field in enumerate(FIELDS):
+            series = {"min": [], "max": [], "mean": []}
+            for bucket in acc:
+                mn, mx, total, count = bucket[i]
+                series["min"].append(_round(mn))
+                series["max"].append(_round(mx))
+                series["mean"].append(_round(total / count) if count else None)
+            out[field] = series
+        return out
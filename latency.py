@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Finds each node's lowest PULSE_LATENCY_MSEC that plays without dropouts.
+
+Opt-in (LATENCY_AUTOTUNE). The supervisor hands the tuner the running total of
+underruns its children have reported (see audioevents) every few seconds, and
+the tuner answers with a new latency when one is due:
+
+- up a rung when UP_UNDERRUNS underruns land within UP_WINDOW_S;
+- down a rung after a clean stretch, which starts at DOWN_CLEAN_S and doubles
+  each time a step down had to be taken back - so a node does not keep
+  probing a latency it has already shown it cannot hold;
+- never more often than once every MIN_CHANGE_S, and ignoring the underruns of
+  the SETTLE_S after a change, which the restart itself causes.
+
+The configured PULSE_LATENCY_MSEC is where it starts. What it settles on is
+kept in a small file, so a container restart resumes there rather than
+relearning it through a night of dropouts.
+"""
+import json
+import os
+import time
+from collections import deque
+
+LADDER = (5, 10, 15, 20, 30, 40, 60, 80, 100, 150, 200)
+UP_UNDERRUNS = 3
+UP_WINDOW_S = 60
+DOWN_CLEAN_S = 1800
+DOWN_CLEAN_MAX_S = 8 * 3600
+MIN_CHANGE_S = 300
+SETTLE_S = 30
+DECISIONS = 20           # most recent decisions kept for the panel
+
+
+def _rung(msec, direction):
+    """The next latency up or down the ladder from `msec`, or None."""
+    if direction > 0:
+        higher = [step for step in LADDER if step > msec]
+        return higher[0] if higher else None
+    lower = [step for step in LADDER if step < msec]
+    return lower[-1] if lower else None
+
+
+class LatencyTuner:
+    def __init__(self, configured, consumers, watched=None, state_path=None):
+        self.configured = int(configured)
+        self.msec = self.configured
+        self.consumers = list(consumers)         # restarted to apply a change
+        self.watched = list(watched or consumers)  # whose underruns count
+        self.state_path = state_path
+        self.clean_s = DOWN_CLEAN_S
+        self.decisions = deque(maxlen=DECISIONS)
+        self.changes = 0         # every change since boot, for /metrics
+        self._changed_at = None
+        self._last_down = None   # when it last stepped down, to spot a bounce
+        self._clean_since = None
+        self._seen = 0           # underrun total at the last observe()
+        self._recent = deque()   # monotonic times of underruns that counted
+        self._state = None
+        self._load()
+
+    def _load(self):
+        if not self.state_path:
+            return
+        try:
+            with open(self.state_path) as handle:
+                stored = json.load(handle)
+        except (OSError, ValueError):
+            return
+        # A value tuned from a different starting point is not this one's.
+        if stored.get("configured") == self.configured and stored.get("msec") in LADDER:
+            self.msec = stored["msec"]
+            self.clean_s = min(max(int(stored.get("clean_s", DOWN_CLEAN_S)), DOWN_CLEAN_S),
+                               DOWN_CLEAN_MAX_S)
+
+    def _save(self):
+        if not self.state_path:
+            return
+        tmp = self.state_path + ".tmp"
+        try:
+            with open(tmp, "w") as handle:
+                json.dump({"configured": self.configured, "msec": self.msec,
+                           "clean_s": self.clean_s}, handle)
+            os.replace(tmp, self.state_path)
+        except OSError:
+            pass  # losing it costs a relearn, not audio
+
+    def configure(self, configured):
+        """The operator set PULSE_LATENCY_MSEC: start again from there."""
+        configured = int(configured)
+        if configured == self.configured:
+            return False
+        self.configured = self.msec = configured
+        self.clean_s = DOWN_CLEAN_S
+        self._recent.clear()
+        self._changed_at = self._last_down = None
+        self._state = None
+        self._save()
+        return True
+
+    def observe(self, now, underruns):
+        """Take the children's underrun total so far; returns a new latency
+        to apply, or None to keep the current one."""
+        new = max(0, underruns - self._seen)
+        self._seen = underruns
+        if self._clean_since is None:
+            self._clean_since = now
+        settling = self._changed_at is not None and now - self._changed_at < SETTLE_S
+        if new and not settling:
+            self._recent.extend([now] * new)
+            self._clean_since = now
+        while self._recent and now - self._recent[0] > UP_WINDOW_S:
+            self._recent.popleft()
+
+        if self._changed_at is not None and now - self._changed_at < MIN_CHANGE_S:
+            return None
+        if len(self._recent) >= UP_UNDERRUNS:
+            target = _rung(self.msec, +1)
+            if target is None:
+                return None
+            if self._last_down is not None and now - self._last_down < self.clean_s:
+                # The last step down did not hold: wait longer before the next.
+                self.clean_s = min(self.clean_s * 2, DOWN_CLEAN_MAX_S)
+            reason = "%d underruns in %ds" % (len(self._recent), UP_WINDOW_S)
+            self._last_down = None
+            return self._change(now, target, reason)
+        if now - self._clean_since >= self.clean_s:
+            target = _rung(self.msec, -1)
+            if target is None:
+                return None
+            reason = "no underruns for %ds" % (now - self._clean_since)
+            self._last_down = now
+            return self._change(now, target, reason)
+        return None
+
+    def _change(self, now, target, reason):
+        self.decisions.append({"at": round(time.time(), 3), "from": self.msec,
+                               "to": target, "reason": reason})
+        self.msec = target
+        self.changes += 1
+        self._changed_at = self._clean_since = now
+        self._recent.clear()
+        self._state = None
+        self._save()
+        return target
+
+    def state(self):
+        """What the panel shows; the same object until something changes."""
+        if self._state is None:
+            self._state = {"msec": self.msec, "configured": self.configured,
+                           "clean_s": self.clean_s, "changes": self.changes,
+                           "decisions": list(self.decisions)}
+        return self._state
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""Each service's recent output, kept as raw bytes in a fixed amount of memory.
+
+The pump appends every line a child prints, and almost nobody reads them: the
+ring is only looked at when someone opens a service's logs in the panel. So a
+line is stored as it arrived - its bytes and a monotonic nanosecond timestamp -
+and is only decoded and given a clock time when it is read.
+
+All the storage is allocated up front: one byte arena the lines are packed into
+end to end, wrapping at the end, and parallel arrays holding where each line
+sits and when it arrived. The oldest lines are overwritten as new ones need the
+room, so the ring costs the same after a week as it did at boot, however chatty
+the child.
+
+Optionally (history_bytes) the lines the arena lets go of are not lost but
+packed into blocks of BLOCK_BYTES and compressed, oldest blocks dropped once
+they add up to history_bytes. Log text compresses around tenfold, so a couple
+of MB holds on the order of 100k lines. Only the block being filled is kept
+uncompressed, and a read decompresses just the blocks its range falls in.
+"""
+import threading
+import time
+import zlib
+from array import array
+from collections import deque
+
+RING_BYTES = 1 << 20     # arena per service
+RING_LINES = 16384       # most lines held, however short
+LINE_MAX = 1024          # a longer line is cut to this many bytes
+TAIL_LINES = 1000        # lines a live follower may fall behind by
+BLOCK_BYTES = 64 << 10   # text per compressed history block
+ZLIB_LEVEL = 6
+
+# Monotonic time says how far apart two lines are; this turns it into the wall
+# clock for display. Taken once, so the stored timestamps stay monotonic even
+# if the clock is stepped.
+_WALL_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+def format_line(ts_ns, raw):
+    wall = (ts_ns + _WALL_OFFSET_NS) / 1e9
+    return "%s.%03d %s" % (time.strftime("%H:%M:%S", time.localtime(wall)),
+                           int(wall * 1000) % 1000, raw.decode("utf-8", errors="replace"))
+
+
+class Tail:
+    """One live follower's queue of new lines, filled by LogRing.append.
+
+    It is bounded: a follower that cannot keep up - a browser on a slow link,
+    a paused tab - loses lines, counted in `dropped`, rather than holding
+    memory or the pump that is feeding it.
+    """
+
+    def __init__(self, maxlen=None):
+        self._lines = deque()
+        self.maxlen = maxlen or TAIL_LINES
+        self.dropped = 0
+        self._ready = threading.Event()
+
+    def _push(self, entry):
+        if len(self._lines) >= self.maxlen:
+            self.dropped += 1
+        else:
+            self._lines.append(entry)
+        self._ready.set()
+
+    def get(self, timeout=None):
+        """Wait for new lines; return ([(seq, ts_ns, raw)], dropped since last)."""
+        self._ready.wait(timeout)
+        self._ready.clear()
+        out = []
+        while self._lines:
+            out.append(self._lines.popleft())
+        dropped, self.dropped = self.dropped, 0
+        return out, dropped
+
+
+class _Block:
+    """History lines being gathered for the next compressed block."""
+
+    __slots__ = ("first", "ts", "lens", "data")
+
+    def __init__(self, first):
+        self.first = first
+        self.ts = array("q")
+        self.lens = array("H")
+        self.data = bytearray()
+
+    def pack(self):
+        return zlib.compress(self.ts.tobytes() + self.lens.tobytes() + self.data, ZLIB_LEVEL)
+
+    def entries(self, start, stop):
+        out, off = [], 0
+        for i, size in enumerate(self.lens):
+            seq = self.first + i
+            if seq >= stop:
+                break
+            if seq >= start:
+                out.append((self.ts[i], bytes(self.data[off:off + size])))
+            off += size
+        return out
+
+
+def _unpack(first, count, blob):
+    """A sealed block back as a _Block."""
+    raw = zlib.decompress(blob)
+    block = _Block(first)
+    block.ts.frombytes(raw[:8 * count])
+    block.lens.frombytes(raw[8 * count:10 * count])
+    block.data = raw[10 * count:]
+    return block
+
+
+class LogRing:
+    """A bounded log: append bytes, read formatted lines, oldest first."""
+
+    def __init__(self, max_bytes=None, max_lines=None, line_max=None, history_bytes=0):
+        self.max_bytes = max_bytes or RING_BYTES
+        self.maxlen = max_lines or RING_LINES
+        self.line_max = min(line_max or LINE_MAX, self.max_bytes, 0xFFFF)
+        self._arena = bytearray(self.max_bytes)
+        self._ts = array("q", bytes(8 * self.maxlen))
+        self._off = array("I", bytes(4 * self.maxlen))
+        self._len = array("H", bytes(2 * self.maxlen))
+        self._first = 0      # slot of the oldest line
+        self._count = 0
+        self._wpos = 0       # where the next line's bytes go
+        self.next_seq = 0    # sequence number the next line will get
+        # The pump appends while a panel thread reads; a reader must not see a
+        # slot half-rewritten or the ring's bounds move under it.
+        self._lock = threading.Lock()
+        self._tails = []
+        # Called with (seq, ts_ns, bytes) for every line, under the lock so
+        # lines reach it in order; the spool's, when there is one.
+        self.sink = None
+        # Compressed history behind the arena: (first seq, lines, blob) per
+        # sealed block, oldest first, and the block still being filled.
+        self.history_bytes = history_bytes
+        self._blocks = deque()
+        self._blocks_bytes = 0
+        self._filling = None
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    def __iter__(self):
+        return iter(self.lines())
+
+    def append(self, line, ts_ns=None):
+        if isinstance(line, str):
+            line = line.encode("utf-8", errors="replace")
+        data = line[:self.line_max]
+        size = len(data)
+        ts_ns = time.monotonic_ns() if ts_ns is None else ts_ns
+        with self._lock:
+            for tail in self._tails:
+                tail._push((self.next_seq, ts_ns, data))
+            if self.sink is not None:
+                self.sink(self.next_seq, ts_ns, data)
+            self._append(data, size, ts_ns)
+
+    def subscribe(self, maxlen=None):
+        """A Tail that receives every line appended from now on."""
+        tail = Tail(maxlen)
+        with self._lock:
+            self._tails.append(tail)
+        return tail
+
+    def unsubscribe(self, tail):
+        with self._lock:
+            if tail in self._tails:
+                self._tails.remove(tail)
+
+    def _append(self, data, size, ts_ns):
+        if self._wpos + size > self.max_bytes:
+            # Lines never straddle the end of the arena. Whatever sits between
+            # here and the end is the oldest data there is, so it goes first.
+            while self._count and self._off[self._first] >= self._wpos:
+                self._evict()
+            self._wpos = 0
+        # Make room: the oldest lines are the ones just ahead of the write
+        # position, as long as they are ahead of it at all.
+        while self._count and (
+                self._count == self.maxlen
+                or self._wpos <= self._off[self._first] < self._wpos + size):
+            self._evict()
+
+        slot = (self._first + self._count) % self.maxlen
+        self._arena[self._wpos:self._wpos + size] = data
+        self._ts[slot] = ts_ns
+        self._off[slot] = self._wpos
+        self._len[slot] = size
+        self._count += 1
+        self._wpos += size
+        self.next_seq += 1
+
+    def _evict(self):
+        if self.history_bytes:
+            slot = self._first
+            off = self._off[slot]
+            self._keep(self.next_seq - self._count, self._ts[slot],
+                       self._arena[off:off + self._len[slot]])
+        self._first = (self._first + 1) % self.maxlen
+        self._count -= 1
+
+    def _keep(self, seq, ts_ns, data):
+        block = self._filling
+        if block is None:
+            block = self._filling = _Block(seq)
+        block.ts.append(ts_ns)
+        block.lens.append(len(data))
+        block.data += data
+        if len(block.data) >= BLOCK_BYTES:
+            blob = block.pack()
+            self._blocks.append((block.first, len(block.lens), blob))
+            self._blocks_bytes += len(blob)
+            self._filling = None
+            while self._blocks_bytes > self.history_bytes:
+                self._blocks_bytes -= len(self._blocks.popleft()[2])
+
+    @property
+    def first_seq(self):
+        """Sequence number of the oldest line still held."""
+        if self._blocks:
+            return self._blocks[0][0]
+        if self._filling is not None:
+            return self._filling.first
+        return self.next_seq - self._count
+
+    @property
+    def nbytes(self):
+        """Memory the lines take: the arena and the compressed history."""
+        filling = len(self._filling.data) if self._filling is not None else 0
+        return self.max_bytes + self._blocks_bytes + filling
+
+    def entries(self, start=None, stop=None):
+        """(timestamp_ns, raw bytes) for the lines numbered start..stop-1 that
+        are still held, oldest first; all of them by default."""
+        with self._lock:
+            older, out = self._entries(start, stop)
+        return self._history(older) + out
+
+    def _entries(self, start, stop):
+        """The arena's lines in range, and what to read from the history for
+        the rest: that is decompressed by _history, after the lock is let go."""
+        start = self.first_seq if start is None else max(start, self.first_seq)
+        stop = self.next_seq if stop is None else min(stop, self.next_seq)
+        first = self.next_seq - self._count
+        older = []
+        if start < min(stop, first):
+            hi = min(stop, first)
+            older = [(f, n, blob, start, hi) for f, n, blob in self._blocks
+                     if f < hi and f + n > start]
+            block = self._filling
+            if block is not None and block.first < hi:
+                older.append((block.first, None, block.entries(start, hi), start, hi))
+            start = first
+        out = []
+        for seq in range(start, stop):
+            slot = (self._first + seq - first) % self.maxlen
+            off = self._off[slot]
+            out.append((self._ts[slot], bytes(self._arena[off:off + self._len[slot]])))
+        return older, out
+
+    @staticmethod
+    def _history(older):
+        out = []
+        for first, count, blob, start, stop in older:
+            if count is None:
+                out.extend(blob)  # the unsealed block, already copied out
+            else:
+                out.extend(_unpack(first, count, blob).entries(start, stop))
+        return out
+
+    def lines(self):
+        return [format_line(ts, raw) for ts, raw in self.entries()]
+
+    def read(self, since=None, limit=None):
+        """Lines from sequence number `since` on, for a reader that polls.
+
+        Returns (lines, first, next, lost): the formatted lines, the sequence
+        number of the first of them, the cursor to pass as `since` next time,
+        and how many lines the reader missed because the ring wrapped past
+        them. With no `since`, it is the newest `limit` lines.
+        """
+        with self._lock:
+            next_seq, first_seq = self.next_seq, self.first_seq
+            if since is None:
+                start = first_seq if limit is None else max(first_seq, next_seq - limit)
+                lost = 0
+            else:
+                since = min(max(since, 0), next_seq)
+                start = max(since, first_seq)
+                lost = start - since
+            stop = next_seq if limit is None else min(next_seq, start + limit)
+            older, entries = self._entries(start, stop)
+        # Decompressing and formatting are the expensive parts, and need no lock.
+        lines = [format_line(ts, raw) for ts, raw in self._history(older) + entries]
+        return lines, start, start + len(lines), lost
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""Each service's output on disk, for history the in-memory ring has lost.
+
+Optional (LOG_SPOOL_DIR): the ring covers the last few minutes of a chatty
+child, and it goes with the container; the spool keeps as much as its
+retention allows, across restarts, under /config or a tmpfs.
+
+Lines reach it from the ring (see LogRing's sink) with the sequence number the
+ring gave them, so a reader's cursor means the same thing in both. The pump
+only queues them; one writer thread appends whatever has queued up to the
+service's current segment in a single write. Each service has a directory of
+segment files named after their first sequence number, each a run of records:
+
+    seq (u64) | wall-clock ns (i64) | length (u16) | the line's bytes
+
+Lines the writer never got to - dropped when it falls QUEUE_LINES behind, or
+queued when the container died - still had their numbers. So that a restart
+does not hand those out again, each service's NEXT file holds a number above
+any the ring can have used: RESERVE ahead of the newest line while it runs,
+exactly the next one after a clean stop.
+
+A segment is closed at SEGMENT_BYTES, and the oldest segment of any service is
+deleted whenever all of them together go over the retention. Every
+INDEX_EVERY-th record's sequence number, time and offset are kept in memory,
+so a read maps the file and starts within a few records of where it wants to
+be rather than loading or scanning the whole thing.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+from logring import _WALL_OFFSET_NS
+
+HEADER = struct.Struct("<QqH")
+SEGMENT_BYTES = 4 << 20  # most a segment grows to, budget permitting
+SEGMENT_MIN = 64 << 10
+SEGMENTS_MAX = 256       # per service, however small they are
+INDEX_EVERY = 64         # records between index entries
+QUEUE_LINES = 20000      # lines waiting for the writer before they are dropped
+LINGER_S = 0.1           # how long the writer lets a batch gather
+SUFFIX = ".seg"
+NEXT = "next"            # per service: numbering resumes at or above this
+RESERVE = QUEUE_LINES    # numbers claimed ahead of the newest line
+
+
+class _Segment:
+    __slots__ = ("path", "size", "count", "seqs", "times", "offsets", "last_seq", "last_ts")
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0            # bytes written and readable
+        self.count = 0
+        self.seqs = array("Q")   # every INDEX_EVERY-th record's...
+        self.times = array("q")  # ...time...
+        self.offsets = array("Q")  # ...and where it starts
+        self.last_seq = None
+        self.last_ts = None
+
+    def note(self, seq, ts_ns, offset):
+        if self.count % INDEX_EVERY == 0:
+            self.seqs.append(seq)
+            self.times.append(ts_ns)
+            self.offsets.append(offset)
+        self.count += 1
+        self.last_seq, self.last_ts = seq, ts_ns
+
+
+def _records(view, offset, size):
+    """(seq, wall ns, bytes, offset) for each whole record from `offset` to
+    `size` of a mapped segment; slicing a map copies, so nothing pins it."""
+    while offset + HEADER.size <= size:
+        seq, ts_ns, length = HEADER.unpack_from(view, offset)
+        end = offset + HEADER.size + length
+        if end > size:
+            return
+        yield seq, ts_ns, view[offset + HEADER.size:end], offset
+        offset = end
+
+
+class ServiceSpool:
+    """One service's segments. Written only by the spool's writer thread."""
+
+    def __init__(self, spool, name, directory):
+        self._spool = spool
+        self.name = name
+        self.directory = directory
+        self._segments = []
+        self._active = None
+        self._fd = None
+        self._lock = threading.Lock()
+        self.next_seq = 0        # where the ring should carry on numbering
+        self.dropped = 0         # lines numbered that never reached disk
+        self._newest = None      # newest sequence number the ring passed on
+        self._claimed = 0        # what NEXT says
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+        self._resume()
+
+    def _scan(self):
+        """Index what an earlier run left, cutting off a half-written record."""
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(SUFFIX))
+        for filename in names:
+            path = os.path.join(self.directory, filename)
+            seg = _Segment(path)
+            try:
+                with open(path, "r+b") as handle:
+                    size = os.fstat(handle.fileno()).st_size
+                    if size:
+                        with mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_READ) as view:
+                            for seq, ts_ns, data, offset in _records(view, 0, size):
+                                seg.note(seq, ts_ns, offset)
+                                seg.size = offset + HEADER.size + len(data)
+                    if seg.size != size:
+                        handle.truncate(seg.size)
+            except (OSError, ValueError):
+                continue
+            if seg.count:
+                self._segments.append(seg)
+                self.next_seq = seg.last_seq + 1
+            else:
+                _unlink(path)
+
+    def _resume(self):
+        """Number on above anything an earlier run may have handed out, and
+        claim the first RESERVE of this run's numbers before any is used."""
+        try:
+            with open(os.path.join(self.directory, NEXT)) as handle:
+                self.next_seq = max(self.next_seq, int(handle.read()))
+        except (OSError, ValueError):
+            pass
+        self._claim(self.next_seq + RESERVE)
+
+    def _claim(self, upto):
+        tmp = os.path.join(self.directory, NEXT + ".tmp")
+        with self._lock:  # the writer's claims against close()'s
+            try:
+                with open(tmp, "w") as handle:
+                    handle.write("%d\n" % upto)
+                os.replace(tmp, os.path.join(self.directory, NEXT))
+            except OSError as exc:
+                self._spool._failed(self, exc)
+                return
+            self._claimed = upto
+
+    @property
+    def nbytes(self):
+        return sum(seg.size for seg in self._segments)
+
+    def append(self, seq, ts_ns, data):
+        """Queue a line; called by the ring, with its monotonic timestamp."""
+        self._spool._put(self, seq, ts_ns + _WALL_OFFSET_NS, data)
+
+    # ---- writer thread ------------------------------------------------------
+
+    def _write(self, records):
+        if self._newest is not None and self._newest + RESERVE // 2 >= self._claimed:
+            self._claim(self._newest + RESERVE)
+        pending, notes = bytearray(), []
+        for i, (seq, ts_ns, data) in enumerate(records):
+            if self._active is None or self._active.size + len(pending) >= self._spool.segment_bytes:
+                self._commit(pending, notes)
+                pending, notes = bytearray(), []
+                if not self._rotate(seq):
+                    self.dropped += len(records) - i
+                    return
+            notes.append((seq, ts_ns, self._active.size + len(pending)))
+            pending += HEADER.pack(seq, ts_ns, len(data))
+            pending += data
+        self._commit(pending, notes)
+
+    def _commit(self, pending, notes):
+        if not pending:
+            return
+        view = memoryview(pending)
+        try:
+            while view:
+                view = view[os.write(self._fd, view):]
+        except OSError as exc:
+            # Take back whatever part of the batch did land, so the file ends
+            # where its index does; failing that, leave the segment behind.
+            try:
+                os.ftruncate(self._fd, self._active.size)
+            except OSError:
+                self._close()
+            self.dropped += len(notes)
+            self._spool._failed(self, exc)
+            return
+        seg = self._active
+        with self._lock:
+            for seq, ts_ns, offset in notes:
+                seg.note(seq, ts_ns, offset)
+            seg.size += len(pending)
+
+    def _rotate(self, seq):
+        """Close the current segment and start one at `seq`."""
+        self._close()
+        path = os.path.join(self.directory, "%020d%s" % (seq, SUFFIX))
+        try:
+            self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        except OSError as exc:
+            self._spool._failed(self, exc)
+            return False
+        seg = _Segment(path)
+        with self._lock:
+            self._segments.append(seg)
+            self._active = seg
+            while len(self._segments) > SEGMENTS_MAX:
+                _unlink(self._segments.pop(0).path)
+        return True
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._active = None
+
+    def _drop_oldest(self):
+        """Delete the oldest closed segment; its size, or None if there is none."""
+        with self._lock:
+            if not self._segments or self._segments[0] is self._active:
+                return None
+            seg = self._segments.pop(0)
+        _unlink(seg.path)
+        return seg.size
+
+    # ---- readers ------------------------------------------------------------
+
+    def _plan(self, find):
+        """(path, offset, size) of each segment from the one `find` picks on,
+        starting at the offset it gives; taken under the lock, read without."""
+        with self._lock:
+            for i, seg in enumerate(self._segments):
+                offset = find(seg)
+                if offset is not None:
+                    return [(seg.path, offset, seg.size)] + [
+                        (later.path, 0, later.size) for later in self._segments[i + 1:]]
+        return []
+
+    def _walk(self, plan):
+        for path, offset, size in plan:
+            if not size:
+                continue
+            try:
+                with open(path, "rb") as handle, \
+                        mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_READ) as view:
+                    for seq, ts_ns, data, _ in _records(view, offset, size):
+                        yield seq, ts_ns, data
+            except (OSError, ValueError):
+                continue  # trimmed away since the plan was made
+
+    def read(self, since, limit):
+        """Up to `limit` (seq, monotonic ns, bytes) from sequence `since` on -
+        the same timestamps the ring would give, for format_line."""
+        def find(seg):
+            if seg.last_seq is None or seg.last_seq < since:
+                return None
+            return seg.offsets[max(bisect_right(seg.seqs, since) - 1, 0)]
+        out = []
+        for seq, ts_ns, data in self._walk(self._plan(find)):
+            if seq >= since:
+                out.append((seq, ts_ns - _WALL_OFFSET_NS, data))
+                if len(out) >= limit:
+                    break
+        return out
+
+    def seq_at(self, when):
+        """Sequence number of the first line at or after Unix time `when`;
+        the oldest held if it is older still, or next_seq if it is newer."""
+        ts = int(when * 1e9)
+        def find(seg):
+            if seg.last_ts is None or seg.last_ts < ts:
+                return None
+            return seg.offsets[max(bisect_left(seg.times, ts) - 1, 0)]
+        for seq, ts_ns, _ in self._walk(self._plan(find)):
+            if ts_ns >= ts:
+                return seq
+        with self._lock:
+            last = self._segments[-1].last_seq if self._segments else None
+        return self.next_seq if last is None else max(self.next_seq, last + 1)
+
+
+class Spool:
+    """Every service's spool, their shared retention, and the writer thread.
+    `log(level, msg)` is told when it cannot write; by default nobody is."""
+
+    def __init__(self, root, max_mb, log=None):
+        self.root = root
+        self.log = log or (lambda level, msg: None)
+        self.max_bytes = int(max_mb) << 20
+        # Small enough that trimming the oldest segment frees a fraction of
+        # the budget, not most of it.
+        self.segment_bytes = min(SEGMENT_BYTES, max(self.max_bytes // 8, SEGMENT_MIN))
+        self.services = {}
+        self.dropped = 0         # lines dropped with the writer QUEUE_LINES behind
+        self._said_dropped = 0
+        self._queue = deque()
+        self._wake = threading.Event()
+        self._reported = set()
+        os.makedirs(root, exist_ok=True)
+        threading.Thread(target=self._run, daemon=True, name="log-spool").start()
+
+    def service(self, name):
+        if name not in self.services:
+            self.services[name] = ServiceSpool(self, name, os.path.join(self.root, name))
+        return self.services[name]
+
+    def _put(self, svc, seq, ts_ns, data):
+        svc._newest = seq
+        if len(self._queue) >= QUEUE_LINES:
+            svc.dropped += 1
+            self.dropped += 1
+            return
+        self._queue.append((svc, seq, ts_ns, data))
+        self._wake.set()
+
+    def flush(self, timeout=2.0):
+        """Wait for what is queued so far to be written."""
+        done = threading.Event()
+        self._queue.append(done)
+        self._wake.set()
+        done.wait(timeout)
+
+    def close(self, timeout=2.0):
+        """Flush, and note exactly where each service's numbering resumes."""
+        self.flush(timeout)
+        for svc in list(self.services.values()):
+            svc._claim(svc.next_seq if svc._newest is None else svc._newest + 1)
+
+    def _failed(self, svc, exc):
+        # Once per service: a full disk would otherwise say so every batch.
+        if svc.name not in self._reported:
+            self._reported.add(svc.name)
+            self.log("WARN", "⚠️ Cannot write %s's log under %s (%s); it is kept in memory only"
+                     % (svc.name, svc.directory, exc.strerror or exc))
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(LINGER_S)
+            self._wake.clear()
+            batches, waiting = {}, []
+            while self._queue:
+                item = self._queue.popleft()
+                if isinstance(item, threading.Event):
+                    waiting.append(item)
+                else:
+                    batches.setdefault(item[0], []).append(item[1:])
+            try:
+                for svc, records in batches.items():
+                    svc._write(records)
+                if batches:
+                    self._trim()
+            except Exception as exc:  # one bad batch must not end spooling
+                self.log("ERROR", "🛑 log spool: %r" % exc)
+            if self.dropped != self._said_dropped:
+                self.log("WARN", "⚠️ %d log lines not written to disk: the spool is not keeping up"
+                         % (self.dropped - self._said_dropped))
+                self._said_dropped = self.dropped
+            for done in waiting:
+                done.set()
+
+    def _trim(self):
+        """Delete the oldest segments, whoever's, until all fit the budget."""
+        total = sum(svc.nbytes for svc in self.services.values())
+        while total > self.max_bytes:
+            oldest = [svc for svc in self.services.values()
+                      if svc._segments and svc._segments[0] is not svc._active]
+            if not oldest:
+                return
+            # One a failed write left empty has no time; it goes first.
+            svc = min(oldest, key=lambda s: (s._segments[0].last_ts is not None,
+                                             s._segments[0].last_ts or 0))
+            freed = svc._drop_oldest()
+            if freed is None:
+                return
+            total -= freed
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Prometheus metrics for the panel's /metrics, in the OpenMetrics text format.
+
+Nothing here runs until someone scrapes. The service table is read from the
+snapshot the supervisor already publishes, and the counters it keeps anyway;
+the histograms - how long a tick takes, how long an intent waits, how long the
+panel takes to answer - do not exist until the first scrape asks for them, so
+a container nobody monitors does not time a single tick.
+"""
+import math
+import threading
+import time
+from bisect import bisect_left
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Seconds. A tick is normally well under a millisecond; an intent waits for the
+# tick that runs it, and a stop waits for the child to go.
+TICK_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+INTENT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+HTTP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+
+
+class Histogram:
+    """Counts of observations per bucket, and their sum.
+
+    Observed from the loop or a panel thread, read by the scrape: the lock
+    keeps a scrape from seeing the count of one observation without its sum.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect_left(self.buckets, value)] += 1
+            self._sum += value
+
+    def samples(self, name, labels=""):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        sep = "," if labels else ""
+        out, seen = [], 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            seen += count
+            out.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, _number(bound), seen))
+        brace = "{%s}" % labels if labels else ""
+        out.append("%s_count%s %d" % (name, brace, seen))
+        out.append("%s_sum%s %s" % (name, brace, _number(total)))
+        return out
+
+
+def _number(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Family:
+    def __init__(self, name, kind, help):
+        self.lines = ["# TYPE %s %s" % (name, kind), "# HELP %s %s" % (name, help)]
+        self.name = name
+        self.kind = kind
+
+    def add(self, value, suffix="", **labels):
+        name = self.name + ("_total" if self.kind == "counter" else suffix)
+        if labels:
+            name += "{%s}" % ",".join('%s="%s"' % (k, _label(v)) for k, v in labels.items())
+        self.lines.append("%s %s" % (name, _number(value)))
+
+
+def render(sup, http=None, dropped=0):
+    """The whole exposition. `http` maps (route, method) to a Histogram."""
+    snap = sup.snapshot
+    now = time.monotonic()
+    states = ("running", "starting", "backoff", "stopped")
+    fams = {
+        "up": _Family("ledfx_service_up", "gauge", "1 if the service's process is running."),
+        "state": _Family("ledfx_service_state", "stateset", "What the supervisor is doing with it."),
+        "desired": _Family("ledfx_service_desired", "gauge", "1 unless stopped from the panel or config."),
+        "restarts": _Family("ledfx_service_restarts", "counter", "Restarts after a crash."),
+        "uptime": _Family("ledfx_service_uptime_seconds", "gauge", "Time since it was last started."),
+        "exit": _Family("ledfx_service_last_exit_code", "gauge", "Exit status of its last run; NaN if none."),
+        "backoff": _Family("ledfx_service_backoff_seconds", "gauge", "Delay before the next restart after a crash."),
+        "retry": _Family("ledfx_service_retry_in_seconds", "gauge", "Time left before a pending restart."),
+        "lines": _Family("ledfx_service_log_lines", "counter", "Lines the service has printed."),
+        "bytes": _Family("ledfx_service_log_bytes", "counter", "Bytes the service has printed."),
+        "held": _Family("ledfx_service_log_held_lines", "gauge",
+                        "Lines of its output the panel can still show from memory."),
+        "memory": _Family("ledfx_service_log_memory_bytes", "gauge",
+                          "Memory those lines take, compressed history included."),
+        "limits": _Family("ledfx_service_limit_restarts", "counter",
+                          "Restarts for going over a limit in services.json."),
+        "cpu": _Family("ledfx_service_cpu_percent", "gauge", "CPU use at the last sample, % of one core."),
+        "rss": _Family("ledfx_service_rss_bytes", "gauge", "Resident memory at the last sample."),
+        "fds": _Family("ledfx_service_open_fds", "gauge", "Open file descriptors at the last sample."),
+        "threads": _Family("ledfx_service_threads", "gauge", "Threads at the last sample."),
+        "events": _Family("ledfx_audio_events", "counter",
+                          "Underruns, reconnects and the like, found in the service's output."),
+        "event_rate": _Family("ledfx_audio_events_per_minute", "gauge",
+                              "The same events over the last minute."),
+    }
+    for row in snap.status(now):
+        name = row["name"]
+        svc = sup.services.get(name)
+        fams["up"].add(row["running"], service=name)
+        for state in states:
+            fams["state"].add(row["state"] == state, service=name, ledfx_service_state=state)
+        fams["desired"].add(row["desired"], service=name)
+        fams["restarts"].add(row["restarts"], service=name)
+        fams["uptime"].add(float(row["uptime"]), service=name)
+        exit_code = row["last_exit"] if isinstance(row["last_exit"], int) else None
+        fams["exit"].add(exit_code, service=name)
+        fams["retry"].add(float(row["retry_in"]), service=name)
+        fams["limits"].add(row["limit_restarts"], service=name)
+        if svc is not None:
+            # Moved by the crash handler, the sampler and the log pump rather
+            # than published with the snapshot; each is a single attribute read.
+            fams["backoff"].add(svc.delay, service=name)
+            fams["held"].add(len(svc.logs), service=name)
+            fams["memory"].add(svc.logs.nbytes, service=name)
+    for reading in sup.readings(now):
+        name = reading["name"]
+        fams["lines"].add(reading["log_lines"], service=name)
+        fams["bytes"].add(reading["log_bytes"], service=name)
+        for kind, total in reading["events"].items():
+            fams["events"].add(total, service=name, type=kind)
+            fams["event_rate"].add(reading["events_per_minute"][kind], service=name, type=kind)
+        usage = reading["usage"]
+        if usage is not None:
+            fams["cpu"].add(usage["cpu_percent"], service=name)
+            fams["rss"].add(usage["rss"], service=name)
+            fams["fds"].add(usage["fds"], service=name)
+            fams["threads"].add(usage["threads"], service=name)
+
+    out = []
+    for fam in fams.values():
+        out.extend(fam.lines)
+    healthy = _Family("ledfx_healthy", "gauge", "1 if every wanted service is running and settled.")
+    healthy.add(snap.healthy)
+    dropped_fam = _Family("ledfx_log_dropped_lines", "counter",
+                          "Log lines dropped because stdout could not keep up.")
+    dropped_fam.add(dropped)
+    queued = _Family("ledfx_supervisor_intents_queued", "gauge",
+                     "Panel requests waiting for the supervisor loop.")
+    queued.add(sup.queued())
+    for fam in (healthy, dropped_fam, queued):
+        out.extend(fam.lines)
+    spool = sup.spool
+    if spool is not None:
+        held = _Family("ledfx_log_spool_bytes", "gauge", "Bytes of the service's log kept on disk.")
+        lost = _Family("ledfx_log_spool_dropped_lines", "counter",
+                       "Lines of the service's log never written to disk: the spool fell "
+                       "behind or could not write.")
+        for name, svc_spool in spool.services.items():
+            held.add(svc_spool.nbytes, service=name)
+            lost.add(svc_spool.dropped, service=name)
+        out.extend(held.lines + lost.lines)
+    if snap.latency is not None:
+        tuned = _Family("ledfx_pulse_latency_msec", "gauge",
+                        "PULSE_LATENCY_MSEC the tuner gives the PulseAudio clients.")
+        tuned.add(snap.latency["msec"])
+        changes = _Family("ledfx_pulse_latency_changes", "counter",
+                          "Times the tuner has changed it since the container started.")
+        changes.add(snap.latency["changes"])
+        out.extend(tuned.lines + changes.lines)
+
+    stats = sup.stats
+    if stats is not None:
+        for name, hist, help in (
+                ("ledfx_supervisor_tick_seconds", stats.tick, "Time one supervisor tick took."),
+                ("ledfx_supervisor_intent_seconds", stats.intent,
+                 "From a panel request being posted to its outcome being published.")):
+            out += ["# TYPE %s histogram" % name, "# HELP %s %s" % (name, help)]
+            out += hist.samples(name)
+    if http:
+        name = "ledfx_http_request_seconds"
+        out += ["# TYPE %s histogram" % name, "# HELP %s Time the panel took to answer." % name]
+        for (route, method), hist in sorted(http.items()):
+            out += hist.samples(name, 'route="%s",method="%s"' % (_label(route), method))
+    out.append("# EOF")
+    return "\n".join(out) + "\n"
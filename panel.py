@@ -5,14 +5,20 @@ It owns no processes. Every action posts an intent to the supervisor loop and
 waits briefly for it to land, so a request cannot race the loop over a child.
 """
 import hmac
+import json
 import os
+import re
+import secrets
 import threading
+import time
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, request, send_from_directory
 
+import metrics
 import services
+from logring import format_line
 from services import ConfigError
-from supervisor import log
+from supervisor import CHANGE_FIELDS, log, log_dropped
 
 ADMIN_USER = os.environ.get("ADMIN_USER", "admin")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "")
@@ -25,12 +31,121 @@ PANEL_HOST = os.environ.get("PANEL_HOST", "0.0.0.0")
 # the outcome.
 INTENT_TIMEOUT = 3.0
 
+# Revisions and snapshot versions both restart at boot; this keeps an ETag from
+# before a container restart from matching a different document after it.
+BOOT_ID = secrets.token_hex(4)
+
+# An event stream with nothing to report still sends a comment this often, so a
+# proxy does not time it out and a closed browser tab is noticed.
+EVENT_KEEPALIVE_S = 15
+
+# Lines per log request. A first look gets the newest LOG_PAGE of them; a
+# reader polling with ?since= gets at most LOG_PAGE_MAX per call and follows
+# the cursor for the rest.
+LOG_PAGE = 500
+LOG_PAGE_MAX = 5000
+
+# A history query with no range is the last HISTORY_WINDOW_S seconds; its
+# points are capped so a chart cannot ask the panel to walk a day of samples.
+HISTORY_WINDOW_S = 3600
+HISTORY_POINTS = 300
+HISTORY_POINTS_MAX = 1000
+
+
+def _int_arg(name, minimum=None, maximum=None):
+    """An optional integer query parameter; junk is a 400, not a guess."""
+    raw = request.args.get(name)
+    if raw is None or raw == "":
+        return None
+    try:
+        value = int(raw)
+    except ValueError:
+        raise ConfigError("%s must be a number" % name)
+    if minimum is not None and value < minimum:
+        raise ConfigError("%s must be at least %d" % (name, minimum))
+    if maximum is not None and value > maximum:
+        value = maximum
+    return value
+
+
+def _line_filter(match, regex):
+    """The predicate a log follower asked for; a bad expression is a 400.
+
+    It sees the line as served, and tests only the text after the timestamp.
+    """
+    if regex:
+        if len(regex) > 256:
+            raise ConfigError("regex is too long (max 256 characters)")
+        try:
+            pattern = re.compile(regex)
+        except re.error as exc:
+            raise ConfigError("regex is not valid: %s" % exc)
+        return lambda line: pattern.search(line.split(" ", 1)[-1]) is not None
+    if match:
+        return lambda line: match in line.split(" ", 1)[-1]
+    return lambda line: True
+
+
+def _line_event(lines, cursor, dropped):
+    return "id: %d\ndata: %s\n\n" % (cursor, json.dumps(
+        {"logs": lines, "next": cursor, "dropped": dropped}))
+
+
+def _read_logs(svc, since, limit):
+    """LogRing.read, except that a cursor older than the ring still holds is
+    served from the service's spool when it has one."""
+    spool = svc.spool
+    if spool is not None and since is not None and since < svc.logs.first_seq:
+        entries = spool.read(since, limit)
+        if entries:
+            lines = [format_line(ts, raw) for _, ts, raw in entries]
+            first = entries[0][0]
+            return lines, first, entries[-1][0] + 1, first - since
+    return svc.logs.read(since, limit)
+
+
+def _not_modified(etag, weak=False):
+    """A 304 for a client that already holds `etag`, else None. Checked
+    before the body is built, so an unchanged poll costs next to nothing."""
+    held = request.if_none_match.contains_weak if weak else request.if_none_match.contains
+    if held(etag):
+        return _tagged(Response(status=304), etag, weak)
+    return None
+
+
+def _tagged(res, etag, weak=False):
+    # no-cache: keep it, but ask every time - which is what makes it a 304.
+    res.set_etag(etag, weak=weak)
+    res.headers["Cache-Control"] = "no-cache"
+    return res
+
 
 def create_app(sup, doc):
     here = os.path.dirname(os.path.abspath(__file__))
     app = Flask(__name__, static_folder=os.path.join(here, "static"), static_url_path="")
+    if "revision" not in doc:
+        services.touch(doc)
     state = {"doc": doc}
     lock = threading.Lock()
+    # Request timings per (route, method); None until the first scrape.
+    http = {"timings": None}
+
+    @app.before_request
+    def start_timer():
+        if http["timings"] is not None:
+            g.started = time.monotonic()
+
+    @app.after_request
+    def stop_timer(res):
+        started = g.pop("started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "(unmatched)"
+            key = (route, request.method)
+            hist = http["timings"].get(key)
+            if hist is None:
+                hist = http["timings"].setdefault(key, metrics.Histogram(metrics.HTTP_BUCKETS))
+            hist.observe(time.monotonic() - started)
+        return res
 
     @app.before_request
     def require_auth():
@@ -66,7 +181,11 @@ def create_app(sup, doc):
     @app.get("/api/config")
     def api_config():
         doc = state["doc"]
-        return jsonify(
+        etag = "%s-c%d" % (BOOT_ID, doc["revision"])
+        cached = _not_modified(etag)
+        if cached is not None:
+            return cached
+        return _tagged(jsonify(
             role=doc["role"],
             auth=bool(ADMIN_PASSWORD),
             services=doc["services"],
@@ -75,7 +194,7 @@ def create_app(sup, doc):
             # So the page can link out to LedFx's own UI on its real port
             # rather than assuming 8888.
             ledfx_port=doc["services"]["ledfx"]["port"],
-        )
+        ), etag)
 
     @app.patch("/api/config")
     def api_patch_config():
@@ -88,7 +207,8 @@ def create_app(sup, doc):
             state["doc"] = new_doc
             if changed:
                 log("INFO", "⚙️ Applying config change to: %s" % ", ".join(changed))
-                sup.reconfigure(specs, changed).wait(INTENT_TIMEOUT)
+            # Even with nothing to restart: a new limit takes effect from here.
+            sup.reconfigure(specs, changed).wait(INTENT_TIMEOUT)
         return jsonify(ok=True, changed=changed, services=new_doc["services"], env=new_doc["env"])
 
     @app.post("/api/config/reset")
@@ -102,13 +222,73 @@ def create_app(sup, doc):
 
     @app.get("/api/services")
     def api_services():
+        """Uptime and retry_in are as of the request, `as_of` in Unix time.
+        They are all that moves between snapshots, so the ETag is weak: a 304
+        says nothing but the clock has changed, and a client holding the old
+        body moves them on by the response's Date minus its `as_of`."""
+        doc, snap = state["doc"], sup.snapshot
+        etag = "%s-s%d.%d" % (BOOT_ID, doc["revision"], snap.version)
+        cached = _not_modified(etag, weak=True)
+        if cached is not None:
+            return cached
         # `blocked` says why a service cannot run yet (no Snapserver host, say),
         # so the page can show a reason instead of an inexplicable "stopped".
-        blocked = {n: s.get("blocked") for n, s in services.build(state["doc"]).items()}
-        rows = sup.status()
+        blocked = {n: s.get("blocked") for n, s in services.build(doc).items()}
+        as_of, rows = time.time(), snap.status()
         for row in rows:
             row["blocked"] = blocked.get(row["name"])
-        return jsonify(services=rows, healthy=sup.healthy())
+        # `latency` is the tuner's current value and recent decisions, or
+        # null when LATENCY_AUTOTUNE is off.
+        return _tagged(jsonify(services=rows, healthy=snap.healthy, latency=snap.latency,
+                               published=round(snap.published_wall, 3),
+                               as_of=round(as_of, 3)), etag, weak=True)
+
+    @app.get("/api/readings")
+    def api_readings():
+        """Each service's latest CPU, memory, threads, open files and context
+        switches from /proc (usage; null while it is not running), its
+        cgroup's counters, how much it has printed, and its audio events.
+
+        Kept out of /api/services and its event stream: these move every
+        sample, and there they would change the ETag and wake every watcher
+        each time. Poll this at the rate you want them."""
+        return jsonify(services=sup.readings(), at=round(time.time(), 3))
+
+    @app.get("/api/events")
+    def api_events():
+        """Server-Sent Events: the full table once, then only the rows whose
+        state, pid, restarts, last exit or blocked reason changed, as the
+        supervisor loop publishes them. Between changes it costs nothing."""
+
+        def stream():
+            version, sent, sent_healthy, sent_latency = None, {}, None, None
+            yield "retry: 3000\n\n"
+            while True:
+                snap = sup.changes(version, EVENT_KEEPALIVE_S)
+                latest, rows, healthy = snap.version, snap.status(), snap.healthy
+                latency = snap.latency
+                blocked = {n: s.get("blocked") for n, s in services.build(state["doc"]).items()}
+                delta = []
+                for row in rows:
+                    row["blocked"] = blocked.get(row["name"])
+                    key = tuple(row[f] for f in CHANGE_FIELDS) + (row["blocked"],)
+                    if sent.get(row["name"]) != key:
+                        sent[row["name"]] = key
+                        delta.append(row)
+                if delta or healthy != sent_healthy or latency is not sent_latency:
+                    sent_healthy, sent_latency = healthy, latency
+                    yield "id: %d\ndata: %s\n\n" % (latest, json.dumps(
+                        {"services": delta, "healthy": healthy, "latency": latency}))
+                elif latest == version:
+                    yield ": keepalive\n\n"
+                version = latest
+
+        return Response(stream(), mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            # nginx (and so Home Assistant Ingress) would otherwise hold the
+            # events back until its buffer filled.
+            "X-Accel-Buffering": "no",
+        })
 
     @app.post("/api/services/<name>/<action>")
     def api_action(name, action):
@@ -133,19 +313,118 @@ def create_app(sup, doc):
                 doc = state["doc"]
                 if name in doc["services"]:
                     doc["services"][name]["enabled"] = (action == "start")
+                    services.touch(doc)
                     services.save(doc)
-        return jsonify(ok=True, service=sup.services[name].status())
+        return jsonify(ok=True, service=sup.snapshot.service(name))
 
     @app.get("/api/services/<name>/logs")
     def api_logs(name):
+        """`?since=<next>` returns only lines added after the previous call,
+        plus the cursor for the next one and how many lines the ring dropped
+        before this reader got to them. With a log spool, `?from=` in Unix
+        seconds starts at the first line printed then, from disk."""
+        svc = sup.services.get(name)
+        if svc is None:
+            return jsonify(error="unknown service %s" % name), 404
+        since = _int_arg("since", minimum=0)
+        start = _int_arg("from")
+        if start is not None:
+            if svc.spool is None:
+                raise ConfigError("from needs a log spool (LOG_SPOOL_DIR)")
+            since = svc.spool.seq_at(start)
+        limit = _int_arg("limit", minimum=1, maximum=LOG_PAGE_MAX)
+        if limit is None:
+            limit = LOG_PAGE if since is None else LOG_PAGE_MAX
+        lines, first, nxt, lost = _read_logs(svc, since, limit)
+        return jsonify(name=name, logs=lines, first=first, next=nxt, lost=lost)
+
+    @app.get("/api/services/<name>/history")
+    def api_history(name):
+        """`?from=&to=` in Unix seconds, `?points=` buckets between them; each
+        field comes back as min, max and mean per bucket, null where the
+        service has no samples."""
         svc = sup.services.get(name)
         if svc is None:
             return jsonify(error="unknown service %s" % name), 404
-        return jsonify(name=name, logs=list(svc.logs))
+        if svc.history is None:
+            return jsonify(error="resource sampling is off (SAMPLE_INTERVAL_SEC=0)"), 404
+        stop = _int_arg("to")
+        stop = time.time() if stop is None else stop
+        start = _int_arg("from")
+        start = stop - HISTORY_WINDOW_S if start is None else start
+        if start >= stop:
+            raise ConfigError("from must be before to")
+        points = _int_arg("points", minimum=1, maximum=HISTORY_POINTS_MAX) or HISTORY_POINTS
+        data = svc.history.query(start, stop, points)
+        return jsonify(name=name, **{"from": start, "to": stop}, **data)
+
+    @app.get("/api/services/<name>/logs/stream")
+    def api_logs_stream(name):
+        """Server-Sent Events: each line the service prints, as it prints it.
+
+        `?match=` keeps lines containing that text and `?regex=` lines matching
+        that expression; `?since=<next>` first replays what the ring (or the
+        spool) still holds from that cursor, so a page can switch from polling
+        without a gap. A follower too slow to keep up loses lines, and each
+        event says how many.
+        """
+        svc = sup.services.get(name)
+        if svc is None:
+            return jsonify(error="unknown service %s" % name), 404
+        since = _int_arg("since", minimum=0)
+        # A reconnecting EventSource says where it got to; that beats the
+        # cursor in the URL it was first opened with.
+        last_id = request.headers.get("Last-Event-ID", "")
+        if last_id.isdigit():
+            since = int(last_id)
+        keep = _line_filter(request.args.get("match"), request.args.get("regex"))
+
+        def stream():
+            # Subscribe before replaying, so nothing falls between the two.
+            tail = svc.logs.subscribe()
+            try:
+                yield "retry: 3000\n\n"
+                cursor = 0
+                if since is not None:
+                    lines, _, cursor, lost = _read_logs(svc, since, LOG_PAGE_MAX)
+                    lines = [line for line in lines if keep(line)]
+                    if lines or lost:
+                        yield _line_event(lines, cursor, lost)
+                while True:
+                    entries, dropped = tail.get(EVENT_KEEPALIVE_S)
+                    lines = []
+                    for seq, ts, raw in entries:
+                        if seq < cursor:
+                            continue  # already sent by the replay
+                        cursor = seq + 1
+                        line = format_line(ts, raw)
+                        if keep(line):
+                            lines.append(line)
+                    if lines or dropped:
+                        yield _line_event(lines, cursor, dropped)
+                    elif not entries:
+                        yield ": keepalive\n\n"
+            finally:
+                svc.logs.unsubscribe(tail)
+
+        return Response(stream(), mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        })
+
+    @app.get("/metrics")
+    def api_metrics():
+        """Prometheus scrape target. The first scrape switches on the timings
+        the histograms need, so until then there is nothing to pay for."""
+        sup.collect_stats()
+        if http["timings"] is None:
+            http["timings"] = {}
+        body = metrics.render(sup, dict(http["timings"]), log_dropped())
+        return Response(body, content_type=metrics.CONTENT_TYPE)
 
     @app.get("/api/health")
     def api_health():
-        healthy = sup.healthy()
+        healthy = sup.snapshot.healthy
         return jsonify(healthy=healthy), (200 if healthy else 503)
 
     return app
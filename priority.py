@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Where and how urgently a service's process runs: CPUs, nice, I/O and
+realtime scheduling.
+
+Applied from the supervisor to a child that is already running, never in the
+child between fork and exec: preexec_fn is not safe with the panel's threads
+alive. Every one of these is a per-thread setting on Linux, so it is applied
+to each thread in /proc/<pid>/task; threads the process starts afterwards
+inherit it from the one that starts them.
+"""
+import ctypes
+import ctypes.util
+import os
+import platform
+
+PROC = "/proc"
+
+IONICE_CLASSES = {"": 0, "realtime": 1, "best-effort": 2, "idle": 3}
+IONICE_LEVEL = 4          # the kernel's own default within a class
+SCHED_POLICIES = {"": os.SCHED_OTHER, "fifo": os.SCHED_FIFO, "rr": os.SCHED_RR}
+
+# What a service gets with nothing set; a process left at these is not touched.
+DEFAULTS = {"cpus": "", "nice": 0, "ionice": "", "sched": "", "rt_priority": 10}
+
+# ioprio_set has no wrapper in Python or glibc, so it is a raw syscall, and
+# its number depends on the architecture.
+_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "armv7l": 314, "armv6l": 314, "i686": 289}
+_IOPRIO_WHO_PROCESS = 1
+_libc = None
+
+
+def parse_cpus(text):
+    """"0-2,5" -> {0, 1, 2, 5}; empty means every CPU, and is an empty set."""
+    cpus = set()
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        first, dash, last = part.partition("-")
+        if not first.isdigit() or (dash and not last.isdigit()):
+            raise ValueError("%r is not a CPU number or range" % part)
+        lo, hi = int(first), int(last or first)
+        if lo > hi or hi > 1023:
+            raise ValueError("%r is not a CPU range" % part)
+        cpus.update(range(lo, hi + 1))
+    return cpus
+
+
+def _ioprio_set(tid, klass):
+    global _libc
+    number = _IOPRIO_SET.get(platform.machine())
+    if number is None:
+        raise OSError("ionice is not supported on %s" % platform.machine())
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    data = IONICE_LEVEL if klass in (1, 2) else 0
+    if _libc.syscall(number, _IOPRIO_WHO_PROCESS, tid, (klass << 13) | data) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def apply(pid, settings, root=None):
+    """Apply `settings` (see DEFAULTS) to every thread of `pid`. Returns what
+    could not be applied, as text - an unprivileged container cannot raise
+    priority, and that should cost a warning, not the service."""
+    settings = dict(DEFAULTS, **settings)
+    try:
+        tids = [int(t) for t in os.listdir(os.path.join(root or PROC, str(pid), "task"))]
+    except OSError:
+        tids = [pid]
+    # Checked when stored, so only a value that got past that ends up here;
+    # it costs a warning like a refusal does, and the service runs as it is.
+    try:
+        cpus = parse_cpus(settings["cpus"]) or os.sched_getaffinity(0)
+        policy = SCHED_POLICIES[settings["sched"]]
+        param = os.sched_param(settings["rt_priority"] if policy != os.SCHED_OTHER else 0)
+        nice = int(settings["nice"])
+        klass = IONICE_CLASSES[settings["ionice"]]
+    except KeyError as exc:
+        return ["priority: unknown value %s" % exc]
+    except (TypeError, ValueError) as exc:
+        return ["priority: %s" % exc]
+    steps = [
+        ("CPU affinity", lambda tid: os.sched_setaffinity(tid, cpus)),
+        ("scheduling policy", lambda tid: os.sched_setscheduler(tid, policy, param)),
+        ("nice", lambda tid: os.setpriority(os.PRIO_PROCESS, tid, nice)),
+        ("ionice", lambda tid: _ioprio_set(tid, klass)),
+    ]
+    failed = []
+    for what, step in steps:
+        for tid in tids:
+            try:
+                step(tid)
+            except ProcessLookupError:
+                continue  # a thread that has just exited
+            except OSError as exc:
+                failed.append("%s: %s" % (what, exc.strerror or exc))
+                break
+            except (TypeError, ValueError) as exc:
+                failed.append("%s: %s" % (what, exc))
+                break
+    return failed
@@ -9,13 +9,19 @@ file. `reset_to_env()` goes back the other way when that is what you want.
 This module is the only place that knows what a snapclient command line looks
 like. The supervisor just runs argv lists.
 """
+import glob
+import itertools
 import json
 import os
 import re
 import shlex
+import socket
 from collections import OrderedDict
 from pathlib import Path
 
+import cgroups
+import priority
+
 CONFIG_PATH = os.environ.get("PANEL_CONFIG", "/config/services.json")
 SCHEMA_VERSION = 1
 
@@ -44,6 +50,11 @@ RETIRED_ROLES = {
 # bring them back, since they cannot respawn a server themselves.
 PULSE_DEPENDENTS = ["snapclient", "squeezelite", "ledfx"]
 
+# Per-service resource limits the supervisor enforces by restarting the
+# service, and what each defaults to; 0 means no limit. The CPU limit has to
+# hold for cpu_window_s before it counts, so a burst does not trip it.
+LIMIT_DEFAULTS = {"max_rss_mb": 0, "max_cpu_percent": 0, "cpu_window_s": 60, "max_fds": 0}
+
 # Services whose audio path goes through PulseAudio's own buffering, so a
 # change to PULSE_LATENCY_MSEC has to re-exec them to take effect. snapclient
 # is absent on purpose: it requests its own 100ms buffer and ignores the
@@ -51,6 +62,15 @@ PULSE_DEPENDENTS = ["snapclient", "squeezelite", "ledfx"]
 PULSE_LATENCY_CONSUMERS = ["squeezelite", "ledfx"]
 
 
+# Every version of the config document a process holds gets its own number in
+# doc["revision"], so build() can remember what it made of it. Numbers come
+# from one counter and are never reused - a reset document must not collide
+# with an older one - and they are not written to disk.
+_revisions = itertools.count(1)
+_built = OrderedDict()
+BUILD_CACHE = 4
+
+
 class ConfigError(ValueError):
     """A parameter the panel should reject with 400 rather than launch."""
 
@@ -107,6 +127,11 @@ def env_defaults(role=None):
         },
     }
 
+    for conf in services.values():
+        conf.update(LIMIT_DEFAULTS)
+        conf.update(priority.DEFAULTS)
+        conf.update(cgroups.DEFAULTS)
+
     # EXTRA_ARGS reached LedFx in this role, so that is where it still lands.
     if shared_extra:
         services["ledfx"]["extra_args"] = shared_extra
@@ -120,6 +145,17 @@ def env_defaults(role=None):
             # Dockerfile ENV, so it is normally already in os.environ.
             "PULSE_LATENCY_MSEC": os.getenv("PULSE_LATENCY_MSEC", "10"),
             "STARTUP_DELAY_SEC": str(_env_int("STARTUP_DELAY_SEC", 2)),
+            "SAMPLE_INTERVAL_SEC": str(_env_int("SAMPLE_INTERVAL_SEC", 1)),
+            # Off unless asked for: a tuned node's latency drifts from the
+            # value above, which is then only where tuning starts.
+            "LATENCY_AUTOTUNE": str(_env_flag("LATENCY_AUTOTUNE", False)).lower(),
+            # Where the children's output is kept on disk; empty keeps it in
+            # memory only, as it always was.
+            "LOG_SPOOL_DIR": os.getenv("LOG_SPOOL_DIR", "").strip(),
+            "LOG_SPOOL_MB": str(_env_int("LOG_SPOOL_MB", 64)),
+            # Compressed history each service keeps in memory beyond its last
+            # ~1 MB of output; 0 keeps just that.
+            "LOG_HISTORY_MB": str(_env_int("LOG_HISTORY_MB", 0)),
         },
     }
 
@@ -173,8 +209,72 @@ def _bool(value, field):
     raise ConfigError("%s must be true or false" % field)
 
 
+def _int_between(lo, hi):
+    def check(value, field):
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            raise ConfigError("%s must be a number" % field)
+        if not lo <= number <= hi:
+            raise ConfigError("%s must be between %d and %d" % (field, lo, hi))
+        return number
+    return check
+
+
+_LIMIT_VALIDATORS = {
+    "max_rss_mb": _int_between(0, 1 << 20),
+    "max_cpu_percent": _int_between(0, 100 * 1024),  # of one core, so >100 is fine
+    "cpu_window_s": _int_between(0, 86400),
+    "max_fds": _int_between(0, 1 << 20),
+}
+
+
+def _cpus(value, field):
+    value = _text(value, field, allow_empty=True, max_len=256)
+    try:
+        priority.parse_cpus(value)
+    except ValueError as exc:
+        raise ConfigError("%s: %s" % (field, exc))
+    return value
+
+
+def _choice(options):
+    def check(value, field):
+        if value not in options:
+            raise ConfigError("%s must be one of: %s"
+                              % (field, ", ".join(repr(o) for o in options)))
+        return value
+    return check
+
+
+# Applied to the running process as well as the next one, so like the limits
+# they never restart it.
+_LIVE_FIELDS = set(LIMIT_DEFAULTS) | set(priority.DEFAULTS) | set(cgroups.DEFAULTS)
+
+_PRIORITY_VALIDATORS = {
+    "cpus": _cpus,
+    "nice": _int_between(-20, 19),
+    "ionice": _choice(list(priority.IONICE_CLASSES)),
+    "sched": _choice(list(priority.SCHED_POLICIES)),
+    "rt_priority": _int_between(1, 99),
+}
+
+# cgroup v2 quotas, where the container delegates a subtree (see cgroups.py).
+_CGROUP_VALIDATORS = {
+    # A percentage of one core; 0 is no cap.
+    "cpu_max": _int_between(0, 100 * 1024),
+    "cpu_weight": _int_between(1, 10000),
+    "io_weight": _int_between(1, 10000),
+}
+
 _VALIDATORS = {
-    "pulseaudio": {"enabled": _bool, "extra_args": _args},
+    "pulseaudio": {
+        "enabled": _bool,
+        "extra_args": _args,
+        **_LIMIT_VALIDATORS,
+        **_PRIORITY_VALIDATORS,
+        **_CGROUP_VALIDATORS,
+    },
     "snapclient": {
         "enabled": _bool,
         # Blank is allowed: an unconfigured install should be editable in the
@@ -182,6 +282,9 @@ _VALIDATORS = {
         "host": lambda v, f: _text(v, f, allow_empty=True, max_len=253),
         "client_id": lambda v, f: _text(v, f, max_len=128),
         "extra_args": _args,
+        **_LIMIT_VALIDATORS,
+        **_PRIORITY_VALIDATORS,
+        **_CGROUP_VALIDATORS,
     },
     "squeezelite": {
         "enabled": _bool,
@@ -190,12 +293,18 @@ _VALIDATORS = {
         "mac": lambda v, f: _mac(v, f),
         "output": lambda v, f: _text(v, f, max_len=128),
         "extra_args": _args,
+        **_LIMIT_VALIDATORS,
+        **_PRIORITY_VALIDATORS,
+        **_CGROUP_VALIDATORS,
     },
     "ledfx": {
         "enabled": _bool,
         "host": lambda v, f: _text(v, f, max_len=253),
         "port": _port,
         "extra_args": _args,
+        **_LIMIT_VALIDATORS,
+        **_PRIORITY_VALIDATORS,
+        **_CGROUP_VALIDATORS,
     },
 }
 
@@ -224,6 +333,37 @@ def _env_value(key, value):
         if not 0 <= secs <= 300:
             raise ConfigError("STARTUP_DELAY_SEC must be between 0 and 300")
         return str(secs)
+    if key == "SAMPLE_INTERVAL_SEC":
+        try:
+            secs = int(value)
+        except (TypeError, ValueError):
+            raise ConfigError("SAMPLE_INTERVAL_SEC must be a number")
+        if not 0 <= secs <= 3600:
+            raise ConfigError("SAMPLE_INTERVAL_SEC must be between 0 and 3600")
+        return str(secs)
+    if key == "LATENCY_AUTOTUNE":
+        return str(_bool(value, key)).lower()
+    if key == "LOG_SPOOL_DIR":
+        path = _text(value, key, allow_empty=True)
+        if path and not path.startswith("/"):
+            raise ConfigError("LOG_SPOOL_DIR must be an absolute path, or empty")
+        return path
+    if key == "LOG_SPOOL_MB":
+        try:
+            mb = int(value)
+        except (TypeError, ValueError):
+            raise ConfigError("LOG_SPOOL_MB must be a number")
+        if not 1 <= mb <= 100000:
+            raise ConfigError("LOG_SPOOL_MB must be between 1 and 100000")
+        return str(mb)
+    if key == "LOG_HISTORY_MB":
+        try:
+            mb = int(value)
+        except (TypeError, ValueError):
+            raise ConfigError("LOG_HISTORY_MB must be a number")
+        if not 0 <= mb <= 256:
+            raise ConfigError("LOG_HISTORY_MB must be between 0 and 256")
+        return str(mb)
     raise ConfigError("unknown setting %s" % key)
 
 
@@ -251,7 +391,10 @@ def apply_patch(doc, patch):
             clean = validators[field](value, "%s.%s" % (name, field))
             if new["services"][name].get(field) != clean:
                 new["services"][name][field] = clean
-                changed.add(name)
+                # Limits and priorities reach the running process as they
+                # stand; changing one is no reason to restart it.
+                if field not in _LIVE_FIELDS:
+                    changed.add(name)
 
     for key, value in (patch.get("env") or {}).items():
         clean = _env_value(key, value)
@@ -260,13 +403,21 @@ def apply_patch(doc, patch):
             if key == "PULSE_LATENCY_MSEC":
                 changed.update(PULSE_LATENCY_CONSUMERS)
             else:
-                # STARTUP_DELAY_SEC is read at launch, not by a running
-                # process; it applies to the next start on its own.
+                # The rest are read at launch, not by a running process;
+                # they apply to the next start on their own.
                 changed.update(())
 
+    touch(new)
     return new, sorted(changed)
 
 
+def touch(doc):
+    """Give `doc` a new revision. Anything that edits a document in place
+    has to call this, or build() will go on answering for the old content."""
+    doc["revision"] = next(_revisions)
+    return doc
+
+
 # ---- persistence ------------------------------------------------------------
 
 
@@ -278,25 +429,43 @@ def load(path=None, role=None):
         stored = json.loads(Path(path).read_text())
     except FileNotFoundError:
         save(defaults, path)
-        return defaults
+        return touch(defaults)
     except (OSError, ValueError) as exc:
         # A corrupt or unreadable config must not stop the container booting -
         # the whole point of this image is that audio comes up unattended.
         print("[panel] ignoring unreadable %s (%s); using environment defaults" % (path, exc), flush=True)
-        return defaults
+        return touch(defaults)
 
     # Merge so a key added by a later image version appears without the user
     # having to delete their config.
     merged = defaults
     for name, fields in (stored.get("services") or {}).items():
-        if name in merged["services"] and isinstance(fields, dict):
-            merged["services"][name].update(fields)
+        if name not in merged["services"] or not isinstance(fields, dict):
+            continue
+        validators = _VALIDATORS[name]
+        for field, value in fields.items():
+            if field not in validators:
+                merged["services"][name][field] = value
+                continue
+            # The file is edited by hand and written by older images too: a
+            # value the panel would refuse must not reach a running process.
+            try:
+                merged["services"][name][field] = validators[field](value, "%s.%s" % (name, field))
+            except ConfigError as exc:
+                _ignored(path, exc)
     for key, value in (stored.get("env") or {}).items():
         if key in merged["env"]:
-            merged["env"][key] = str(value)
+            try:
+                merged["env"][key] = _env_value(key, str(value))
+            except ConfigError as exc:
+                _ignored(path, exc)
     if stored.get("role"):
         merged["role"] = str(stored["role"]).lower()
-    return merged
+    return touch(merged)
+
+
+def _ignored(path, exc):
+    print("[panel] ignoring a bad value in %s (%s); using the default" % (path, exc), flush=True)
 
 
 def save(doc, path=None):
@@ -306,7 +475,8 @@ def save(doc, path=None):
         Path(path).parent.mkdir(parents=True, exist_ok=True)
         tmp = str(path) + ".tmp"
         with open(tmp, "w") as handle:
-            json.dump(doc, handle, indent=2, sort_keys=True)
+            json.dump({k: v for k, v in doc.items() if k != "revision"},
+                      handle, indent=2, sort_keys=True)
             handle.write("\n")
             handle.flush()
             os.fsync(handle.fileno())
@@ -319,7 +489,45 @@ def save(doc, path=None):
 
 
 def reset_to_env(path=None, role=None):
-    return save(env_defaults(role), path)
+    return touch(save(env_defaults(role), path))
+
+
+# ---- readiness --------------------------------------------------------------
+
+
+def _pulse_sockets():
+    """Where the daemon's native-protocol socket can be, most specific first.
+
+    Running as a user daemon with no XDG_RUNTIME_DIR, PulseAudio makes a
+    /tmp/pulse-XXXX directory and links it from ~/.config/pulse, which is why
+    both of those are searched rather than one fixed path.
+    """
+    server = os.environ.get("PULSE_SERVER", "")
+    if server.startswith("unix:"):
+        return [server[len("unix:"):]]
+    paths = []
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        paths.append(os.path.join(os.environ["XDG_RUNTIME_DIR"], "pulse", "native"))
+    paths += glob.glob(os.path.expanduser("~/.config/pulse/*-runtime/native"))
+    paths += glob.glob("/tmp/pulse-*/native")
+    return paths
+
+
+def pulse_ready():
+    """True once PulseAudio accepts a client: the same socket connect a client
+    makes first. The loop asks this every READY_POLL_S while it waits, so it
+    must not block: a non-blocking connect to a unix socket answers at once.
+    With no socket to be found it stays False, and the wait ends on
+    startup_delay instead."""
+    for path in _pulse_sockets():
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.setblocking(False)
+            try:
+                sock.connect(path)
+                return True
+            except OSError:
+                continue
+    return False
 
 
 # ---- argv -------------------------------------------------------------------
@@ -331,7 +539,23 @@ def build(doc, **_ignored):
     A service whose required parameter is missing comes back disabled with a
     `blocked` reason, so the panel can say why rather than launching something
     that cannot work.
+
+    The result is remembered per document revision, so every status poll that
+    only wants `blocked` does not split every extra_args again. Treat it as
+    read-only: the next caller with the same revision gets the same object.
     """
+    revision = doc.get("revision")
+    if revision is None:
+        return _build(doc)
+    specs = _built.get(revision)
+    if specs is None:
+        specs = _built[revision] = _build(doc)
+        while len(_built) > BUILD_CACHE:
+            _built.popitem(last=False)
+    return specs
+
+
+def _build(doc):
     svc = doc["services"]
     env = doc.get("env", {})
     # libpulse reads this from the child's environment; snapclient sets its own
@@ -373,5 +597,11 @@ def build(doc, **_ignored):
             "env": dict(child_env),
             "enabled": bool(conf.get("enabled", True)) and blocked is None,
             "blocked": blocked,
+            # The clients need the daemon serving, not just started.
+            "ready": pulse_ready if name == "pulseaudio" else None,
+            "after": ["pulseaudio"] if name in PULSE_DEPENDENTS else [],
+            "limits": {key: conf.get(key, default) for key, default in LIMIT_DEFAULTS.items()},
+            "priority": {key: conf.get(key, default) for key, default in priority.DEFAULTS.items()},
+            "cgroup": {key: conf.get(key, default) for key, default in cgroups.DEFAULTS.items()},
         }
     return specs
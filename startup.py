@@ -13,8 +13,11 @@ import threading
 import time
 from pathlib import Path
 
+import cgroups
 import services
 import supervisor
+from latency import LatencyTuner
+from logspool import Spool
 from supervisor import Supervisor, log
 
 _shutdown = threading.Event()
@@ -59,10 +62,34 @@ def main():
         log("INFO", "🌈 Mode: LedFx Suite (Pulse Bridge)")
 
         specs = services.build(doc)
+        tuner = None
+        if doc["env"].get("LATENCY_AUTOTUNE") == "true":
+            tuner = LatencyTuner(
+                doc["env"].get("PULSE_LATENCY_MSEC", "10"),
+                services.PULSE_LATENCY_CONSUMERS,
+                # PulseAudio's own underruns are the consumers' streams too.
+                watched=services.PULSE_LATENCY_CONSUMERS + ["pulseaudio"],
+                state_path=os.path.join(os.path.dirname(services.CONFIG_PATH), "latency.json"),
+            )
+        spool = None
+        if doc["env"].get("LOG_SPOOL_DIR"):
+            try:
+                spool = Spool(doc["env"]["LOG_SPOOL_DIR"], int(doc["env"].get("LOG_SPOOL_MB", 64)),
+                              log=log)
+                log("INFO", "🗄️ Keeping service logs under %s, up to %s MB"
+                    % (spool.root, doc["env"].get("LOG_SPOOL_MB", 64)))
+            except OSError as exc:
+                # Like the panel: no disk for logs is no reason to go without audio.
+                log("WARN", "⚠️ Cannot keep logs under %s (%s); memory only"
+                    % (doc["env"]["LOG_SPOOL_DIR"], exc.strerror or exc))
         sup = Supervisor(
             specs,
             startup_delay=int(doc["env"].get("STARTUP_DELAY_SEC", 2)),
-            dependents=services.PULSE_DEPENDENTS,
+            sample_interval=int(doc["env"].get("SAMPLE_INTERVAL_SEC", 1)),
+            cgroup_root=cgroups.detect(),
+            tuner=tuner,
+            spool=spool,
+            log_history=int(doc["env"].get("LOG_HISTORY_MB", 0)) << 20,
         )
 
         # The panel is optional scenery: anyone who never opens it should not be
@@ -7,44 +7,293 @@ makes "stop" atomic against a restart that is one tick from firing: there is no
 window in which an API thread reads the state, decides, and acts while the loop
 does the same thing with the same child.
 """
+import atexit
 import os
 import queue
+import selectors
 import subprocess
 import sys
 import threading
 import time
-from collections import deque
+from heapq import heappop, heappush
 from datetime import datetime
 from pathlib import Path
+from types import MappingProxyType, SimpleNamespace
+
+import audioevents
+import cgroups
+import priority
+import procstat
+from history import History
+from logring import LogRing
+from metrics import INTENT_BUCKETS, TICK_BUCKETS, Histogram
 
 INIT_DELAY = 5
 MAX_DELAY = 60
-STABLE_RUN_S = 30      # ran longer than this -> reset backoff on next crash
-STOP_GRACE_S = 8       # time children get to exit before SIGKILL
-TICK_S = 0.25          # loop period; the panel should feel immediate
-LOG_LINES = 200
+STABLE_RUN_S = 30        # ran longer than this -> reset backoff on next crash
+STOP_GRACE_S = 8         # time children get to exit before SIGKILL
+PULSE_STOP_LAG_S = 0.5   # at shutdown, how long PulseAudio outlives its clients
+TICK_S = 0.25            # poll period when child exits cannot be waited on
+READY_POLL_S = 0.05      # how often a starting daemon's probe is retried
+HEALTH_REFRESH_S = 20    # the HEALTHCHECK wants the file touched within a minute
+SAMPLE_S = 1             # default period of the /proc resource sample
+LIMIT_RESTART_S = 600    # a service over its limits is restarted at most this often
+LATENCY_CHECK_S = 5      # how often the latency tuner looks at the underrun counts
+PUMP_CHUNK = 65536       # bytes per read from a child's pipe
+PUMP_MAX_LINE = 65536    # a line longer than this is cut rather than buffered
+LOG_QUEUE_LINES = 10000  # lines waiting for stdout before they are dropped
+LOG_BATCH_LINES = 1000   # most lines in a single write
+HEALTH_TIMER = ""        # the health refresh's key in the timer heap
+OPS_TIMER = "(ops)"      # ...and the key for staged operations
+SAMPLE_TIMER = "(sample)"  # ...and for the next resource sample
+LATENCY_TIMER = "(latency)"  # ...and for the latency tuner's next look
 HEALTH_PATH = os.environ.get("HEALTH_PATH", "/tmp/supervisor_health")
 
 
+class _LogWriter:
+    """The only thing that writes to stdout.
+
+    Lines arrive whole on a bounded queue and leave in batches: whatever has
+    queued up while the last write was in progress goes out as one write and
+    one flush, so a chatty child costs one syscall per batch, not per line,
+    and lines still never interleave. If stdout stops keeping up - a stalled
+    `docker logs` reader, say - the queue fills and further lines are counted
+    and dropped rather than blocking the loop or the pump that produced them.
+    """
+
+    def __init__(self, maxsize=None):
+        self._queue = queue.Queue(maxsize or LOG_QUEUE_LINES)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.dropped = 0
+        self._reported = 0
+
+    def put(self, line):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=2.0):
+        """Wait for what is queued so far to be written, e.g. before exit."""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="log-writer")
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < LOG_BATCH_LINES:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            waiting = [item for item in batch if isinstance(item, threading.Event)]
+            lines = [item for item in batch if not isinstance(item, threading.Event)]
+            if self.dropped != self._reported:
+                lines.append("[supervisor] ⚠️ %d log lines dropped: stdout is not keeping up"
+                             % (self.dropped - self._reported))
+                self._reported = self.dropped
+            try:
+                if lines:
+                    sys.stdout.write("\n".join(lines) + "\n")
+                    sys.stdout.flush()
+            except Exception:
+                pass  # nowhere left to say so
+            for done in waiting:
+                done.set()
+
+
+_writer = _LogWriter()
+atexit.register(_writer.flush)
+
+
 def _emit(line):
-    """One write per line: print() writes the text and the newline separately,
-    and with the panel, the loop and every child's pump thread all writing to
-    the same stdout, that interleaves them mid-line."""
-    sys.stdout.write(line + "\n")
-    sys.stdout.flush()
+    """Queue one whole line for stdout: print() writes the text and the
+    newline separately, and with the panel, the loop and the log pump all
+    writing to the same stdout, that interleaves them mid-line."""
+    _writer.put(line)
+
+
+def log_dropped():
+    """Lines lost because stdout could not keep up, since the process began."""
+    return _writer.dropped
 
 
 def log(level, msg):
     _emit("[%s] [%s]  ➡️  %s" % (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), level, msg))
 
 
+class _FdThread:
+    """One daemon thread multiplexing file descriptors through a selector.
+
+    New descriptors reach the selector through a self-pipe, since only the
+    thread itself may touch its registrations while it sits in select().
+    Subclasses override _ready(key), called with each registered descriptor
+    that turns readable.
+    """
+
+    name = "fd-thread"
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._wfd, False)
+        self._selector.register(self._rfd, selectors.EVENT_READ)
+        threading.Thread(target=self._run, daemon=True, name=self.name).start()
+
+    def add(self, fd, data):
+        with self._lock:
+            self._pending.append((fd, data))
+        try:
+            os.write(self._wfd, b"\0")
+        except BlockingIOError:
+            pass  # the pipe is full of the same news already
+
+    def _drop(self, fd):
+        self._selector.unregister(fd)
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.fd != self._rfd:
+                    self._ready(key)
+                    continue
+                try:
+                    os.read(self._rfd, 4096)
+                except BlockingIOError:
+                    pass
+                with self._lock:
+                    pending, self._pending = self._pending, []
+                for fd, data in pending:
+                    self._selector.register(fd, selectors.EVENT_READ, data)
+
+    def _ready(self, key):
+        # Nothing here reads it, so it would be reported ready forever.
+        self._drop(key.fd)
+
+
+class _ExitWatcher(_FdThread):
+    """Calls `notify(name)` the moment a child exits, so the loop need not poll.
+
+    Each child gets a pidfd, which turns readable when the process exits. It
+    does not reap it, so Popen.poll() still collects the status on the loop
+    thread as before.
+    """
+
+    name = "exit-watch"
+
+    def __init__(self, notify):
+        self.notify = notify
+        super().__init__()
+
+    @staticmethod
+    def available():
+        """pidfd_open needs Linux 5.3 and Python 3.9; without it, poll."""
+        if not hasattr(os, "pidfd_open"):
+            return False
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+        except OSError:
+            return False
+        return True
+
+    def watch(self, proc, name):
+        try:
+            fd = os.pidfd_open(proc.pid)
+        except OSError:
+            # Already gone (and reaped): nothing to wait for, so look now.
+            self.notify(name)
+            return
+        self.add(fd, name)
+
+    def _ready(self, key):
+        self._drop(key.fd)
+        os.close(key.fd)
+        self.notify(key.data)
+
+
+class _LogPump(_FdThread):
+    """Drains every child's stdout into `sink(svc, line)`, from one thread.
+
+    Pipes are read as bytes in chunks of PUMP_CHUNK and split here, so a child
+    that prints invalid UTF-8 gets U+FFFD instead of a decode error - the old
+    per-child readline() thread died on one of those, nothing read the pipe
+    again, and the child blocked as soon as the pipe buffer filled. Nothing a
+    line contains stops the draining: a pipe is dropped only at EOF.
+    """
+
+    name = "log-pump"
+
+    def __init__(self, sink):
+        self.sink = sink  # sink(svc, raw line without its newline)
+        super().__init__()
+
+    def watch(self, svc, stream):
+        os.set_blocking(stream.fileno(), False)
+        self.add(stream.fileno(), (svc, stream, bytearray()))
+
+    def _ready(self, key):
+        svc, stream, partial = key.data
+        try:
+            chunk = os.read(key.fd, PUMP_CHUNK)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b""
+        if not chunk:
+            if partial:
+                self._line(svc, bytes(partial))
+            self._drop(key.fd)
+            stream.close()
+            return
+        svc.log_bytes += len(chunk)
+        partial += chunk
+        if b"\n" not in chunk and len(partial) < PUMP_MAX_LINE:
+            return
+        lines = partial.split(b"\n")
+        rest = lines.pop()
+        if len(rest) >= PUMP_MAX_LINE:
+            # A child that never prints a newline still gets drained.
+            lines.append(rest)
+            rest = b""
+        partial[:] = rest
+        for line in lines:
+            self._line(svc, line)
+
+    def _line(self, svc, raw):
+        svc.log_lines += 1
+        try:
+            self.sink(svc, raw.rstrip())
+        except Exception:
+            pass  # a broken stdout must not stop the pipe being drained
+
+
 class Service:
     """One supervised process and the state the panel reports."""
 
-    def __init__(self, name, argv, env=None, enabled=True):
+    def __init__(self, name, argv, env=None, enabled=True, ready=None, after=None,
+                 limits=None, scheduling=None, cgroup=None):
         self.name = name
         self.argv = list(argv)
         self.env = dict(env or {})
+        self.ready = ready               # probe: true once it serves clients
+        self.after = list(after or [])   # services that must be ready first
         self.desired = bool(enabled)     # what the operator wants
         self.proc = None
         self.delay = INIT_DELAY
@@ -52,7 +301,25 @@ class Service:
         self.started_at = None
         self.restarts = 0
         self.last_exit = None
-        self.logs = deque(maxlen=LOG_LINES)
+        self.logs = LogRing()
+        self.spool = None                # its log on disk, with a spool
+        self.events = audioevents.Extractor(name)  # underruns and the like
+        self.log_bytes = 0               # read from its pipe, for throughput
+        self.log_lines = 0
+        self.holder = None               # the staged operation that has it in hand
+        self.last_gap = None             # seconds of audio its last restart cost
+        self.usage = None                # what it costs, as last sampled
+        self._cpu = None                 # (pid, when, cpu_s) at that sample
+        self.history = None              # a day of samples, while sampling
+        self.limits = dict(limits or {})  # see services.LIMIT_DEFAULTS
+        self.scheduling = dict(scheduling or {})  # see priority.DEFAULTS
+        self.cgroup = dict(cgroup or {})  # see cgroups.DEFAULTS
+        self.cgroup_usage = None         # its cgroup's counters, as last sampled
+        self.limit_restarts = 0
+        self.last_limit = None           # what the last limit hit measured
+        self._limit_at = None            # when a limit last restarted it
+        self._limit_noted = None         # ...and the hold-off already logged
+        self._cpu_over = None            # since when CPU has been over its limit
 
     @property
     def running(self):
@@ -68,43 +335,425 @@ class Service:
             return "backoff"
         return "starting"
 
-    def status(self, now=None):
-        now = now or time.monotonic()
+    @property
+    def held(self):
+        """Whether an operation in progress owns it, so the loop leaves it be."""
+        return self.holder is not None
+
+    def take(self, op):
+        self.holder = op
+
+    def release(self, op):
+        # Only its own hold: another op may have taken the service over since.
+        if self.holder is op:
+            self.holder = None
+
+    def row(self):
+        """The raw state, as a snapshot holds it: times stay monotonic
+        instants, and become durations only when presented."""
+        running = self.running
         return {
             "name": self.name,
             "state": self.state,
             "desired": self.desired,
-            "running": self.running,
-            "pid": self.proc.pid if self.running else None,
-            "uptime": (now - self.started_at) if (self.running and self.started_at) else 0,
+            "running": running,
+            "pid": self.proc.pid if running else None,
+            "started_at": self.started_at if running else None,
+            "restart_at": self.restart_at,
             "restarts": self.restarts,
             "last_exit": self.last_exit,
-            "retry_in": max(0, self.restart_at - now) if self.restart_at else 0,
             "command": " ".join(self.argv),
+            "last_gap": self.last_gap,
+            "limit_restarts": self.limit_restarts,
+            "last_limit": self.last_limit,
         }
 
+    def readings(self, now):
+        """What moves with every sample and every line printed: read as it
+        stands rather than published, since in the snapshot it would move the
+        version every SAMPLE_INTERVAL_SEC and wake every watcher with it. Each
+        is a single attribute read, so any thread may call it."""
+        events, recent, last_event = self.events.snapshot()
+        return {
+            "name": self.name,
+            "usage": self.usage if self.proc is not None else None,
+            "cgroup": self.cgroup_usage,
+            "log_bytes": self.log_bytes,
+            "log_lines": self.log_lines,
+            "events": events,
+            "events_per_minute": audioevents.per_minute(recent, now),
+            "last_event": last_event,
+        }
+
+    def status(self, now=None):
+        return _present(self.row(), now or time.monotonic())
+
+    def sample(self, now):
+        """Read what the process costs from /proc. CPU % is its share of one
+        core since the previous sample, so the first after a start has none."""
+        cur = procstat.read(self.proc.pid) if self.running else None
+        if cur is None:
+            self.usage = self._cpu = None
+            return
+        pid, cpu = self.proc.pid, None
+        if self._cpu is not None and self._cpu[0] == pid and now > self._cpu[1]:
+            cpu = round(100 * (cur["cpu_s"] - self._cpu[2]) / (now - self._cpu[1]), 1)
+        self._cpu = (pid, now, cur.pop("cpu_s"))
+        cur["cpu_percent"] = cpu
+        # A new dict each time: a reader on another thread may hold the old one.
+        self.usage = cur
+
     def record(self, line):
-        self.logs.append("%s %s" % (time.strftime("%H:%M:%S"), line.rstrip()))
+        """Keep a line for the panel; it is given a clock time only when read."""
+        self.logs.append(line)
+
+
+# The fields a watcher is told about when they change. Uptime and retry_in move
+# every second on their own, and a page can count those locally.
+CHANGE_FIELDS = ("state", "desired", "pid", "restarts", "last_exit", "command")
+
+
+def _change_key(row):
+    return tuple(row[field] for field in CHANGE_FIELDS)
+
+
+def _present(row, now):
+    """A row as the API reports it: uptime and retry_in as of `now`."""
+    out = dict(row)
+    started, restart = out.pop("started_at"), out.pop("restart_at")
+    out["uptime"] = (now - started) if started else 0
+    out["retry_in"] = max(0, restart - now) if restart else 0
+    return out
+
+
+class Snapshot:
+    """Every service's state as the loop last published it.
+
+    Built by the loop at the end of a tick and never modified afterwards, so
+    any thread can read one without a lock, a syscall, or the risk of seeing
+    a service halfway through a change. `version` goes up whenever the
+    content does.
+    """
+
+    __slots__ = ("version", "healthy", "rows", "published", "published_wall", "latency")
+
+    def __init__(self, version, healthy, rows, published=None, latency=None):
+        self.version = version
+        self.healthy = healthy
+        self.latency = latency   # the tuner's state, if there is a tuner
+        self.rows = tuple(MappingProxyType(row) for row in rows)
+        self.published = published or time.monotonic()
+        self.published_wall = time.time() - (time.monotonic() - self.published)
+
+    def status(self, now=None):
+        now = now or time.monotonic()
+        return [_present(row, now) for row in self.rows]
+
+    def service(self, name, now=None):
+        for row in self.rows:
+            if row["name"] == name:
+                return _present(row, now or time.monotonic())
+        return None
+
+
+class _Stopper:
+    """Stops a set of children together without blocking: SIGTERM to all of
+    them at once, SIGKILL to whatever outlives `grace`. Whoever owns it calls
+    poll() when woken, until it says they are all gone."""
+
+    def __init__(self, svcs, now, grace=None):
+        self.svcs = [svc for svc in svcs if svc.proc is not None]
+        self.deadline = now + (STOP_GRACE_S if grace is None else grace)
+        self.killed = False
+        for svc in self.svcs:
+            if svc.proc.poll() is None:
+                log("INFO", "⏹️ Stopping %s..." % svc.name)
+                svc.proc.terminate()
+
+    def poll(self, now):
+        """True once every child has exited (or could not be killed); else the
+        instant it next needs looking at."""
+        alive = [svc for svc in self.svcs if svc.proc is not None and svc.proc.poll() is None]
+        for svc in self.svcs:
+            if svc not in alive:
+                svc.proc = None
+        if not alive:
+            return True
+        if now < self.deadline:
+            return self.deadline
+        if self.killed:
+            # SIGKILL did not take within its 2s: nothing more to be done.
+            for svc in alive:
+                svc.proc = None
+            return True
+        for svc in alive:
+            log("WARN", "⚠️ '%s' ignored SIGTERM, killing it" % svc.name)
+            svc.proc.kill()
+        self.killed = True
+        self.deadline = now + 2
+        return self.deadline
+
+
+class _Cycle:
+    """Stops one service without blocking the loop, and starts it again if
+    `start` is still set once the child is gone (a stop arriving meanwhile
+    clears it, a start sets it). The service is held until then, like the
+    ones a _PulseRestart has in hand."""
+
+    def __init__(self, sup, svc, now, start):
+        self.sup = sup
+        self.svcs = [svc]
+        self.start = {svc.name: start}
+        self.done = []           # intent events to set once it finishes
+        svc.take(self)
+        self.stopper = _Stopper([svc], now)
+
+    def step(self, now):
+        gone = self.stopper.poll(now)
+        if gone is not True:
+            return gone
+        for svc in self.svcs:
+            svc.release(self)
+            if self.start[svc.name] and svc.desired and not svc.running:
+                svc.delay = INIT_DELAY
+                svc.restart_at = None
+                self.sup._spawn(svc)
+        return None
+
+
+class _AllOf:
+    """Stands in for an intent's event when it started several staged
+    operations: the event is set when the last of them finishes."""
+
+    def __init__(self, event, count):
+        self.event = event
+        self.posted = event.posted
+        self.count = count
+
+    def set(self):
+        self.count -= 1
+        if self.count <= 0:
+            self.event.set()
+
+    def is_set(self):
+        return self.event.is_set()
+
+
+class _PulseRestart:
+    """Restarts PulseAudio and its clients one stage per tick.
+
+    PulseAudio's clients cannot respawn a server (autospawn = no in
+    client.conf), so a bare restart would leave them crash-looping against a
+    socket that briefly does not exist: they are taken down first and brought
+    back once the new daemon answers. Done inline that was up to three grace
+    periods plus the readiness wait with the loop blocked; as stages, the loop
+    keeps draining intents, noticing crashes and refreshing health throughout.
+
+    step() returns the instant it next needs to run, or None when finished.
+    Services it has in hand are `held`, so the loop's own restart logic leaves
+    them alone meanwhile.
+    """
+
+    def __init__(self, sup, now):
+        self.sup = sup
+        self.pulse = sup.services["pulseaudio"]
+        self.done = []           # intent events to set once it finishes
+        # A stop or restart of one of them already under way is taken over:
+        # left to itself it would bring a client back against the old daemon.
+        # Its intent completes when this does.
+        taken = []
+        for op in list(sup._ops):
+            if isinstance(op, _Cycle) and any(
+                    svc is self.pulse or svc.name in sup.dependents for svc in op.svcs):
+                sup._ops.remove(op)
+                self.done.extend(op.done)
+                taken.extend(op.svcs)
+        self.clients = [sup.services[n] for n in sup.dependents if n in sup.services
+                        and (sup.services[n].desired or sup.services[n] in taken)]
+        self.svcs = self.clients + [self.pulse]
+        self.began = now
+        for svc in self.svcs:
+            svc.take(self)
+        self.pulse.desired = True
+        self.stage = self._stop_clients
+        self.stopper = _Stopper(reversed(self.clients), now)
+
+    def step(self, now):
+        return self.stage(now)
+
+    def _stop_clients(self, now):
+        gone = self.stopper.poll(now)
+        if gone is not True:
+            return gone
+        self.stopper = _Stopper([self.pulse], now)
+        self.stage = self._stop_daemon
+        return now
+
+    def _stop_daemon(self, now):
+        gone = self.stopper.poll(now)
+        if gone is not True:
+            return gone
+        pulse = self.pulse
+        if pulse.desired:  # unless the operator stopped it meanwhile
+            pulse.delay = INIT_DELAY
+            pulse.restart_at = None
+            self.sup._spawn(pulse)
+        self.ready_by = now + self.sup.startup_delay
+        self.stage = self._await_daemon
+        return now
+
+    def _await_daemon(self, now):
+        pulse = self.pulse
+        if not pulse.desired:
+            # The operator stopped it while it was coming up.
+            if pulse.running:
+                self.stopper = _Stopper([pulse], now)
+                self.stage = self._drop_daemon
+                return now
+            return self._resume(now)
+        if self.sup.startup_delay > 0 and pulse.running and pulse.ready is not None:
+            try:
+                ready = pulse.ready()
+            except Exception:
+                ready = False
+            if not ready and now < self.ready_by:
+                return min(now + READY_POLL_S, self.ready_by)
+            if not ready:
+                log("WARN", "⚠️ pulseaudio not ready after %ss; starting its clients anyway"
+                    % self.sup.startup_delay)
+        elif self.sup.startup_delay > 0 and pulse.running and now < self.ready_by:
+            return self.ready_by  # no probe: the fixed wait, as before
+        return self._resume(now)
+
+    def _drop_daemon(self, now):
+        gone = self.stopper.poll(now)
+        if gone is not True:
+            return gone
+        return self._resume(now)
+
+    def _resume(self, now):
+        for svc in self.clients:
+            # The operator may have stopped one while it was down.
+            if svc.desired and not svc.running:
+                svc.delay = INIT_DELAY
+                svc.restart_at = None
+                self.sup._spawn(svc)
+        for svc in self.svcs:
+            svc.release(self)
+        gap = now - self.began
+        self.pulse.last_gap = gap
+        log("INFO", "🔁 PulseAudio restart done; its clients were down for %.2fs" % gap)
+        self.pulse.record("restart cycle took %.2fs of audio" % gap)
+        return None
+
+
+def _limited(limits):
+    """True if any limit is set; cpu_window_s alone is not one."""
+    return any(limits.get(key) for key in ("max_rss_mb", "max_cpu_percent", "max_fds"))
+
+
+def _unenforced(names):
+    log("WARN", "⚠️ SAMPLE_INTERVAL_SEC is 0, so the limits set for %s are not enforced"
+        % ", ".join(names))
 
 
 class Supervisor:
-    def __init__(self, specs, startup_delay=2, health_path=HEALTH_PATH, dependents=None):
+    def __init__(self, specs, startup_delay=2, health_path=HEALTH_PATH, dependents=None,
+                 sample_interval=SAMPLE_S, cgroup_root=None, tuner=None, spool=None,
+                 log_history=0):
         self.services = {}
         self.order = []
         for name, spec in specs.items():
-            self.services[name] = Service(name, spec["argv"], spec.get("env"), spec.get("enabled", True))
+            self.services[name] = Service(name, spec["argv"], spec.get("env"),
+                                          spec.get("enabled", True), spec.get("ready"),
+                                          spec.get("after"), spec.get("limits"),
+                                          spec.get("priority"), spec.get("cgroup"))
             self.order.append(name)
+        # `dependents` is the older way of saying a service runs after
+        # PulseAudio; either way, those are the ones a pulse restart takes down.
+        for name in dependents or []:
+            svc = self.services.get(name)
+            if svc is not None and "pulseaudio" not in svc.after:
+                svc.after.append("pulseaudio")
+        for svc in self.services.values():
+            svc.after = [dep for dep in svc.after if dep in self.services and dep != svc.name]
+        self._rank = {name: i for i, name in enumerate(self.order)}
+        # Bytes of compressed output each service keeps past its ring.
+        for svc in self.services.values():
+            svc.logs.history_bytes = log_history
+        # Every line also goes to disk, numbered on from where the last run's
+        # left off so a cursor into the spool stays valid across a restart.
+        self.spool = spool
+        if spool is not None:
+            for svc in self.services.values():
+                try:
+                    svc.spool = spool.service(svc.name)
+                except OSError as exc:
+                    log("WARN", "⚠️ Cannot keep %s's log on disk (%s); memory only"
+                        % (svc.name, exc.strerror or exc))
+                    continue
+                svc.logs.next_seq = svc.spool.next_seq
+                svc.logs.sink = svc.spool.append
         self.startup_delay = startup_delay
         self.health_path = health_path
-        self.dependents = list(dependents or [])
+        self.sample_interval = sample_interval
+        self.dependents = [name for name in self.order
+                           if "pulseaudio" in self.services[name].after]
         self._intents = queue.Queue()
         self._wake = threading.Event()
         self._shutdown = threading.Event()
+        # Deadlines as a heap of (when, name): backoff expiries, services
+        # reaching STABLE_RUN_S, and the health refresh under HEALTH_TIMER.
+        # Entries are never removed early; one whose deadline has since moved
+        # is skipped when it pops, and `_armed` says which one is current.
+        self._timers = []
+        self._armed = {}
+        self._exited = queue.SimpleQueue()
+        self._ops = []           # staged operations in progress, e.g. _PulseRestart
+        self._check_all = True
+        # Event-driven where the kernel allows it; otherwise tick() polls every
+        # service each TICK_S, which finds the same exits up to that much later.
+        self._exits = _ExitWatcher(self._child_exited) if _ExitWatcher.available() else None
+        self._pump = _LogPump(self._pumped)
+        # The last Snapshot the loop published, and a condition watchers wait
+        # on for the next one (see changes()).
+        self._changed = threading.Condition()
+        self.snapshot = Snapshot(0, False, [svc.row() for svc in self.services.values()],
+                                 latency=tuner.state() if tuner is not None else None)
+        # Tick and intent timings, once /metrics has asked for them.
+        self.stats = None
+        # Each child's own cgroup, when the container delegates a subtree.
+        self._cgroups = None
+        if cgroup_root:
+            tree = cgroups.Tree(cgroup_root)
+            try:
+                tree.setup()
+                self._cgroups = tree
+                log("INFO", "🧩 Each service gets its own cgroup under %s" % cgroup_root)
+            except OSError as exc:
+                log("WARN", "⚠️ Cannot divide cgroup %s (%s); services share it"
+                    % (cgroup_root, exc.strerror or exc))
+        if self.sample_interval > 0:
+            for svc in self.services.values():
+                svc.history = History(self.sample_interval)
+            self._arm(SAMPLE_TIMER, time.monotonic() + self.sample_interval)
+        else:
+            # Limits are checked against each sample, so with none they do nothing.
+            limited = [name for name in self.order if _limited(self.services[name].limits)]
+            if limited:
+                _unenforced(limited)
+        # Moves PULSE_LATENCY_MSEC for its consumers (see latency.py).
+        self.tuner = tuner
+        if tuner is not None:
+            log("INFO", "🎚️ Tuning PULSE_LATENCY_MSEC from underruns, starting at %d ms"
+                % tuner.msec)
+            self._arm(LATENCY_TIMER, time.monotonic() + LATENCY_CHECK_S)
 
     # ---- intents: called from Flask threads, executed by the loop ----------
 
     def _post(self, fn):
         done = threading.Event()
+        done.posted = time.monotonic()
         self._intents.put((fn, done))
         self._wake.set()
         return done
@@ -128,10 +777,12 @@ class Supervisor:
         log("INFO", "🚀 Starting %s: %s" % (svc.name, " ".join(svc.argv)))
         env = os.environ.copy()
         env.update(svc.env)
+        if self.tuner is not None and svc.name in self.tuner.consumers:
+            env["PULSE_LATENCY_MSEC"] = str(self.tuner.msec)
         try:
             svc.proc = subprocess.Popen(
                 svc.argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                text=True, bufsize=1, env=env,
+                bufsize=0, env=env,
             )
         except OSError as exc:
             svc.proc = None
@@ -143,86 +794,134 @@ class Supervisor:
             return
         svc.started_at = time.monotonic()
         svc.restart_at = None
-        threading.Thread(target=self._pump, args=(svc, svc.proc), daemon=True).start()
+        svc.events.started()
+        if self._cgroups is not None:
+            for failure in self._cgroups.place(svc.name, svc.proc.pid, svc.cgroup):
+                log("WARN", "⚠️ Cannot set %s's %s" % (svc.name, failure))
+        if any(svc.scheduling.get(k, v) != v for k, v in priority.DEFAULTS.items()):
+            self._apply_scheduling(svc)
+        if self._exits is not None:
+            self._exits.watch(svc.proc, svc.name)
+        self._pump.watch(svc, svc.proc.stdout)
 
-    def _pump(self, svc, proc):
-        """Children's output goes to stdout as before, and to the ring buffer."""
-        try:
-            for line in iter(proc.stdout.readline, ""):
-                if line:
-                    _emit("[%s] %s" % (svc.name, line.rstrip()))
-                    svc.record(line)
-        except Exception:
-            pass
+    @staticmethod
+    def _apply_scheduling(svc):
+        """CPUs, nice, ionice and realtime policy, on the process as it runs.
+        Refused ones (no CAP_SYS_NICE, say) are logged and otherwise ignored."""
+        for failure in priority.apply(svc.proc.pid, svc.scheduling):
+            log("WARN", "⚠️ Cannot set %s's %s" % (svc.name, failure))
 
-    def _terminate(self, svc):
-        proc = svc.proc
-        if proc is None or proc.poll() is not None:
-            svc.proc = None
-            return
-        log("INFO", "⏹️ Stopping %s..." % svc.name)
-        proc.terminate()
-        try:
-            proc.wait(timeout=STOP_GRACE_S)
-        except subprocess.TimeoutExpired:
-            log("WARN", "⚠️ '%s' ignored SIGTERM, killing it" % svc.name)
-            proc.kill()
-            try:
-                proc.wait(timeout=2)
-            except subprocess.TimeoutExpired:
-                pass
-        svc.proc = None
+    @staticmethod
+    def _pumped(svc, raw):
+        """Children's output goes to stdout as before, to the ring buffer, and
+        past the service's audio event rules."""
+        _emit("[%s] %s" % (svc.name, raw.decode("utf-8", errors="replace")))
+        svc.record(raw)
+        svc.events.feed(raw)
 
     def _do_start(self, name):
         svc = self.services[name]
         svc.desired = True
         svc.delay = INIT_DELAY
         svc.restart_at = None
+        op = svc.holder
+        if op is not None:
+            # Still on its way down: it comes back once it is gone.
+            if isinstance(op, _Cycle):
+                op.start[name] = True
+            return op
         if not svc.running:
             self._spawn(svc)
+        return None
 
     def _do_stop(self, name):
         svc = self.services[name]
-        # Clearing desired first is what stops the loop from restarting it: by
-        # the time _terminate returns, no scheduled restart can still fire.
+        # Clearing desired first is what stops the loop from restarting it:
+        # once the child is gone, no scheduled restart can still fire.
         svc.desired = False
         svc.restart_at = None
-        self._terminate(svc)
         svc.record("stopped by operator")
+        op = svc.holder
+        if op is not None:
+            if isinstance(op, _Cycle):
+                op.start[name] = False
+            return op  # a PulseRestart keeps down whatever is no longer desired
+        if svc.running:
+            return self._cycle(svc, start=False)
+        svc.proc = None
+        return None
 
-    def _do_restart(self, name):
+    def _do_restart(self, name, reason="restarted by operator"):
+        svc = self.services[name]
+        svc.record(reason)
         if name == "pulseaudio":
             return self._do_restart_pulse()
-        self._do_stop(name)
-        self._do_start(name)
+        svc.desired = True
+        svc.delay = INIT_DELAY
+        svc.restart_at = None
+        op = svc.holder
+        if op is not None:
+            if isinstance(op, _Cycle):
+                op.start[name] = True
+            return op
+        if svc.running:
+            return self._cycle(svc, start=True)
+        self._spawn(svc)
+        return None
+
+    def _cycle(self, svc, start):
+        """Stop `svc` (and start it again if `start`) as a staged operation,
+        so a child slow to die holds up nothing else the loop does."""
+        op = _Cycle(self, svc, time.monotonic(), start)
+        self._ops.append(op)
+        self._wake.set()
+        return op
 
     def _do_restart_pulse(self):
-        """PulseAudio's clients cannot respawn a server (autospawn = no in
-        client.conf), so a bare restart would leave them crash-looping against
-        a socket that briefly does not exist. Take them down with it."""
-        resume = [n for n in self.dependents
-                  if n in self.services and self.services[n].desired]
-        for name in reversed(resume):
-            self._terminate(self.services[name])
-        self._do_stop("pulseaudio")
-        self._do_start("pulseaudio")
-        if self.startup_delay > 0:
-            log("INFO", "⏱️ Waiting %ss for PulseAudio readiness..." % self.startup_delay)
-            time.sleep(self.startup_delay)
-        for name in resume:
-            svc = self.services[name]
-            svc.delay = INIT_DELAY
-            svc.restart_at = None
-            self._spawn(svc)
+        """Start a staged restart (see _PulseRestart), or join the one already
+        under way. The intent that asked for it completes when it does."""
+        for op in self._ops:
+            if isinstance(op, _PulseRestart):
+                return op
+        op = _PulseRestart(self, time.monotonic())
+        self._ops.append(op)
+        self._wake.set()
+        return op
 
     def _do_reconfigure(self, specs, changed):
         pulse_changed = "pulseaudio" in changed
+        if self.tuner is not None:
+            # A latency the operator sets is where tuning starts again.
+            for name in self.tuner.consumers:
+                configured = (specs.get(name) or {}).get("env", {}).get("PULSE_LATENCY_MSEC")
+                if configured is not None:
+                    if self.tuner.configure(configured):
+                        log("INFO", "🎚️ PULSE_LATENCY_MSEC set to %s ms; tuning starts "
+                                    "again from there" % configured)
+                    break
+        ops = []
         for name, spec in specs.items():
             svc = self.services.get(name)
             if svc is None:
                 continue
             svc.argv = list(spec["argv"])
             svc.env = dict(spec.get("env") or {})
+            svc.ready = spec.get("ready", svc.ready)
+            limits = dict(spec.get("limits") or {})
+            if limits != svc.limits and self.sample_interval <= 0 and _limited(limits):
+                _unenforced([name])
+            svc.limits = limits
+            scheduling = dict(spec.get("priority") or {})
+            if scheduling != svc.scheduling:
+                svc.scheduling = scheduling
+                if svc.running:
+                    self._apply_scheduling(svc)
+            cgroup = dict(spec.get("cgroup") or {})
+            if cgroup != svc.cgroup:
+                svc.cgroup = cgroup
+                if self._cgroups is not None:
+                    for failure in self._cgroups.apply(name, cgroup):
+                        log("WARN", "⚠️ Cannot set %s's %s" % (name, failure))
             # Only act on enabled for a service the caller says changed. Acting
             # on every disagreement would let an edit to one service revive
             # another that the operator had stopped from the panel, since a
@@ -231,74 +930,293 @@ class Supervisor:
                 continue
             wanted = bool(spec.get("enabled", True))
             if wanted != svc.desired:
-                (self._do_start if wanted else self._do_stop)(name)
+                ops.append((self._do_start if wanted else self._do_stop)(name))
                 changed = [c for c in changed if c != name]
         if pulse_changed:
-            self._do_restart_pulse()
-            return
+            ops.append(self._do_restart_pulse())
+            return ops
         for name in changed:
             svc = self.services.get(name)
             if svc is not None and svc.desired:
-                self._do_restart(name)
+                ops.append(self._do_restart(name, "restarted with a new configuration"))
+        return ops
 
     # ---- loop --------------------------------------------------------------
 
     def autostart(self):
+        """Start every enabled service as soon as everything it runs `after` is
+        ready, so services that only wait on the same thing come up together.
+
+        A dependency that is disabled, exits before it is ready, or is still
+        not ready after startup_delay holds nobody back: its dependents start
+        anyway, as they always did after the fixed sleep.
+        """
+        pending = []
         for name in self.order:
-            svc = self.services[name]
-            if not svc.desired:
+            if self.services[name].desired:
+                pending.append(name)
+            else:
                 log("INFO", "⏭️ %s is disabled; not starting it" % name)
-                continue
-            self._spawn(svc)
-            if name == "pulseaudio" and self.startup_delay > 0:
-                log("INFO", "⏱️ Waiting %ss for PulseAudio readiness..." % self.startup_delay)
-                time.sleep(self.startup_delay)
+        awaited = {dep for name in pending for dep in self.services[name].after}
+        ready = set(self.order) - set(pending)
+        starting = {}  # awaited services spawned but not yet ready -> when
+        while pending:
+            now = time.monotonic()
+            for name, since in list(starting.items()):
+                if self._ready_yet(self.services[name], since, now):
+                    ready.add(name)
+                    del starting[name]
+            launch = [name for name in pending if ready.issuperset(self.services[name].after)]
+            if not launch and not starting:
+                # Only a cycle gets here; breaking it beats starting nothing.
+                log("WARN", "⚠️ Dependency cycle among %s; starting them anyway"
+                    % ", ".join(pending))
+                launch = pending
+            for name in launch:
+                pending.remove(name)
+                svc = self.services[name]
+                self._spawn(svc)
+                if name not in awaited or self.startup_delay <= 0:
+                    ready.add(name)
+                    continue
+                starting[name] = now
+                if svc.ready is None:
+                    log("INFO", "⏱️ Waiting %ss for %s..." % (self.startup_delay, name))
+            if pending and not launch:
+                time.sleep(READY_POLL_S)
+
+    def _ready_yet(self, svc, since, now):
+        """Whether `svc`, spawned at `since`, should stop holding back the
+        services that run after it.
+
+        startup_delay is only the limit: a daemon that is up in 200ms is waited
+        on for 200ms. Without a probe, it is the fixed sleep.
+        """
+        if not svc.running:
+            log("WARN", "⚠️ %s exited before it was ready" % svc.name)
+            return True
+        if svc.ready is None:
+            return now >= since + self.startup_delay
+        try:
+            ready = svc.ready()
+        except Exception:
+            ready = False
+        if ready:
+            log("INFO", "✅ %s ready after %.2fs" % (svc.name, now - since))
+            return True
+        if now >= since + self.startup_delay:
+            log("WARN", "⚠️ %s not ready after %ss; starting what runs after it anyway"
+                % (svc.name, self.startup_delay))
+            return True
+        return False
+
+    def _child_exited(self, name):
+        """Exit watcher thread: hand the name to the loop and wake it."""
+        self._exited.put(name)
+        self._wake.set()
+
+    def _arm(self, name, when):
+        if when is not None and self._armed.get(name) != when:
+            self._armed[name] = when
+            heappush(self._timers, (when, name))
+
+    def _due(self, now):
+        """Pop every timer that has come due and is still the current one."""
+        names = set()
+        while self._timers and self._timers[0][0] <= now:
+            when, name = heappop(self._timers)
+            if self._armed.get(name) == when:
+                del self._armed[name]
+                names.add(name)
+        return names
+
+    def _next_deadline(self):
+        return self._timers[0][0] if self._timers else None
 
     def tick(self, now=None):
         now = now or time.monotonic()
-        self._drain_intents()
+        done = []
+        stats = self.stats
+        began = time.monotonic() if stats is not None else None
+        try:
+            self._tick(now, done)
+        finally:
+            # Only now: a caller waiting on an intent reads the snapshot next,
+            # and it should find its own change already in it.
+            for event in done:
+                event.set()
+            if stats is not None:
+                ended = time.monotonic()
+                stats.tick.observe(ended - began)
+                for event in done:
+                    if event.is_set():  # an _AllOf counts once, when it fires
+                        stats.intent.observe(ended - event.posted)
 
-        for name in self.order:
-            svc = self.services[name]
-            if not svc.desired:
-                continue
-            if svc.running:
-                if svc.started_at and (now - svc.started_at) > STABLE_RUN_S:
-                    svc.delay = INIT_DELAY
-                continue
+    def _tick(self, now, done):
+        if self._drain_intents(done):
+            # An intent can touch any service; look at them all once.
+            self._check_all = True
+        busy = bool(self._ops)
+        self._step_ops(now, done)
 
-            rc = svc.proc.poll() if svc.proc is not None else None
-            if svc.proc is not None:
-                run_time = now - (svc.started_at or now)
-                svc.last_exit = rc
-                svc.proc = None
-                if run_time > STABLE_RUN_S:
-                    svc.delay = INIT_DELAY
-                log("WARN", "⚠️ '%s' exited (code %s, ran %.0fs). Restarting in %ss..."
-                    % (name, rc, run_time, svc.delay))
-                svc.record("exited with %s; restarting in %ss" % (rc, svc.delay))
-                svc.restart_at = now + svc.delay
-                svc.delay = min(svc.delay * 2, MAX_DELAY)
-            elif svc.restart_at is not None and now >= svc.restart_at:
-                svc.restarts += 1
-                self._spawn(svc)
-            elif svc.restart_at is None:
-                self._spawn(svc)
+        due = self._due(now)
+        while True:
+            try:
+                due.add(self._exited.get_nowait())
+            except queue.Empty:
+                break
+        if self._check_all or self._exits is None:
+            due.update(self.order)
+            self._check_all = False
+
+        for name in sorted(due & self._rank.keys(), key=self._rank.__getitem__):
+            self._check(self.services[name], now)
+        if SAMPLE_TIMER in due:
+            for svc in self.services.values():
+                svc.sample(now)
+                if self._cgroups is not None:
+                    svc.cgroup_usage = self._cgroups.usage(svc.name)
+                usage = svc.usage or {}
+                svc.history.add(now, usage.get("cpu_percent"), usage.get("rss"),
+                                svc.restarts, svc.running)
+                self._enforce(svc, now)
+            self._arm(SAMPLE_TIMER, now + self.sample_interval)
+        if LATENCY_TIMER in due:
+            self._tune(now)
+            self._arm(LATENCY_TIMER, now + LATENCY_CHECK_S)
+        if due or busy:
+            self._update_health(now)
+            self._publish(now)
+
+    def _step_ops(self, now, done):
+        """Advance each staged operation as far as it will go right now."""
+        soonest = None
+        for op in list(self._ops):
+            when = op.step(now)
+            while when is not None and when <= now:
+                when = op.step(now)
+            if when is None:
+                self._ops.remove(op)
+                done.extend(op.done)
+                self._check_all = True
+            elif soonest is None or when < soonest:
+                soonest = when
+        if soonest is not None:
+            self._arm(OPS_TIMER, soonest)
+
+    def _check(self, svc, now):
+        name = svc.name
+        if not svc.desired or svc.held:
+            return
+        if svc.running:
+            if svc.started_at and (now - svc.started_at) > STABLE_RUN_S:
+                svc.delay = INIT_DELAY
+            else:
+                self._arm(name, (svc.started_at or now) + STABLE_RUN_S)
+            return
+
+        rc = svc.proc.poll() if svc.proc is not None else None
+        if svc.proc is not None:
+            run_time = now - (svc.started_at or now)
+            svc.last_exit = rc
+            svc.proc = None
+            if run_time > STABLE_RUN_S:
+                svc.delay = INIT_DELAY
+            log("WARN", "⚠️ '%s' exited (code %s, ran %.0fs). Restarting in %ss..."
+                % (name, rc, run_time, svc.delay))
+            svc.record("exited with %s; restarting in %ss" % (rc, svc.delay))
+            svc.restart_at = now + svc.delay
+            svc.delay = min(svc.delay * 2, MAX_DELAY)
+        elif svc.restart_at is not None and now >= svc.restart_at:
+            svc.restarts += 1
+            self._spawn(svc)
+        elif svc.restart_at is None:
+            self._spawn(svc)
+        if svc.restart_at is not None:
+            self._arm(name, svc.restart_at)
+        elif svc.running:
+            self._arm(name, svc.started_at + STABLE_RUN_S)
 
-        self._update_health(now)
+    def _enforce(self, svc, now):
+        """Restart a service whose last sample broke one of its limits, the
+        same way the panel's restart does, but not more than once every
+        LIMIT_RESTART_S: a limit set too low must not become a crash loop."""
+        usage, limits = svc.usage, svc.limits
+        if usage is None or not svc.desired or svc.held:
+            svc._cpu_over = None
+            return
+        cpu, max_cpu = usage["cpu_percent"], limits.get("max_cpu_percent")
+        if max_cpu and cpu is not None and cpu > max_cpu:
+            svc._cpu_over = svc._cpu_over or now
+        else:
+            svc._cpu_over = None
+        hit = None
+        if limits.get("max_rss_mb") and usage["rss"] > limits["max_rss_mb"] << 20:
+            hit = "RSS %d MB over its %d MB limit" % (usage["rss"] >> 20, limits["max_rss_mb"])
+        elif limits.get("max_fds") and usage["fds"] > limits["max_fds"]:
+            hit = "%d open files over its limit of %d" % (usage["fds"], limits["max_fds"])
+        elif svc._cpu_over is not None and now - svc._cpu_over >= limits.get("cpu_window_s", 0):
+            hit = "CPU %.0f%% over its %d%% limit for %.0fs" % (cpu, max_cpu, now - svc._cpu_over)
+        if hit is None:
+            return
+        svc.last_limit = hit
+        if svc._limit_at is not None and now - svc._limit_at < LIMIT_RESTART_S:
+            if svc._limit_noted != svc._limit_at:  # say so once, not every sample
+                svc._limit_noted = svc._limit_at
+                log("WARN", "🧯 %s: %s, but it was restarted for that %.0fs ago; leaving it"
+                    % (svc.name, hit, now - svc._limit_at))
+            return
+        log("WARN", "🧯 %s: %s; restarting it" % (svc.name, hit))
+        svc.limit_restarts += 1
+        svc._limit_at = now
+        svc._cpu_over = None
+        self._do_restart(svc.name, "over a limit: %s; restarting" % hit)
 
-    def _drain_intents(self):
+    def _tune(self, now):
+        """Hand the tuner the underruns so far; if it picks a new latency,
+        restart the consumers that are running so they pick it up."""
+        tuner = self.tuner
+        underruns = sum(self.services[name].events.totals["underrun"]
+                        for name in tuner.watched if name in self.services)
+        msec = tuner.observe(now, underruns)
+        if msec is None:
+            return
+        decision = tuner.decisions[-1]
+        # One that is not running picks the new value up when it next starts,
+        # and one held by a PulseAudio restart when that resumes it.
+        restart = [name for name in tuner.consumers if name in self.services
+                   and self.services[name].running and not self.services[name].held]
+        log("INFO", "🎚️ PULSE_LATENCY_MSEC %d -> %d ms (%s); restarting %s"
+            % (decision["from"], msec, decision["reason"], ", ".join(restart) or "nothing"))
+        for name in restart:
+            self._do_restart(name, "PULSE_LATENCY_MSEC tuned to %d ms; restarting" % msec)
+
+    def _drain_intents(self, done):
+        """Run what the API asked for. Each one's event goes in `done`, to be
+        set once its effects are published - or, for one that started a staged
+        operation, handed to that operation to set when it finishes."""
+        ran = 0
         while True:
             try:
-                fn, done = self._intents.get_nowait()
+                fn, event = self._intents.get_nowait()
             except queue.Empty:
-                return
+                return ran
+            ran += 1
             try:
-                fn()
+                result = fn()
             except Exception as exc:  # an API mistake must not kill the loop
                 log("ERROR", "🛑 intent failed: %s" % exc)
-            finally:
-                done.set()
+                result = None
+            ops = [op for op in (result if isinstance(result, list) else [result])
+                   if op is not None]
+            if not ops:
+                done.append(event)
+            elif len(ops) == 1:
+                ops[0].done.append(event)
+            else:
+                joined = _AllOf(event, len(set(ops)))
+                for op in set(ops):
+                    op.done.append(joined)
 
     def healthy(self, now=None):
         """Everything that should be running is running, and has settled.
@@ -323,22 +1241,106 @@ class Supervisor:
                 Path(self.health_path).touch()
             except OSError:
                 pass
+            self._arm(HEALTH_TIMER, now + HEALTH_REFRESH_S)
 
     def run(self, shutdown):
         log("INFO", "✅ All services running. Monitoring for crashes...")
+        # The loop may now sleep indefinitely, so shutdown has to wake it too.
+        threading.Thread(target=lambda: (shutdown.wait(), self._wake.set()),
+                         daemon=True, name="shutdown-wake").start()
         while not shutdown.is_set():
-            self.tick()
-            self._wake.wait(TICK_S)
+            # Clear before ticking: a wake that lands during the tick must make
+            # the next wait return at once, not be wiped after it.
             self._wake.clear()
+            self.tick()
+            deadline = self._next_deadline()
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            if self._exits is None:
+                timeout = TICK_S if timeout is None else min(timeout, TICK_S)
+            self._wake.wait(timeout)
 
     def stop_all(self):
-        for name in reversed(self.order):
-            svc = self.services[name]
+        """Stop everything for shutdown, inside one STOP_GRACE_S deadline.
+
+        Docker waits 10s after SIGTERM before it SIGKILLs PID 1, and anything
+        still running then dies uncleanly. So every client gets SIGTERM at
+        once, PulseAudio as soon as they have gone (or PULSE_STOP_LAG_S later,
+        whichever is first), and all of them share the one deadline before
+        SIGKILL: shutdown takes as long as the slowest child, not the sum.
+        """
+        now = time.monotonic()
+        deadline = now + STOP_GRACE_S
+        self._ops = []
+        for svc in self.services.values():
             svc.desired = False
             svc.restart_at = None
-            self._terminate(svc)
+            svc.holder = None
+        pulse = self.services.get("pulseaudio")
+        clients = _Stopper([self.services[n] for n in reversed(self.order)
+                            if n != "pulseaudio"], now)
+        daemon = None if pulse is not None else clients
+        pulse_at = now + PULSE_STOP_LAG_S
+        while True:
+            now = time.monotonic()
+            gone = clients.poll(now)
+            if daemon is None and (gone is True or now >= pulse_at):
+                daemon = _Stopper([pulse], now, grace=max(0, deadline - now))
+            pending = [] if daemon is not None else [pulse_at]
+            for result in (gone, daemon.poll(now) if daemon is not None else True):
+                if result is not True:
+                    pending.append(result)
+            if not pending:
+                break
+            timeout = max(0, min(pending) - now)
+            if self._exits is None:
+                timeout = min(timeout, TICK_S)
+            # The exit watcher wakes this the moment any child goes.
+            self._wake.clear()
+            self._wake.wait(timeout)
+        self._publish(time.monotonic())
+        if self.spool is not None:
+            self.spool.close()
         log("INFO", "👋 All services stopped.")
 
+    def collect_stats(self):
+        """Start timing ticks and intents, for /metrics. Until something calls
+        this, the loop does not read the clock for them at all."""
+        if self.stats is None:
+            self.stats = SimpleNamespace(tick=Histogram(TICK_BUCKETS),
+                                         intent=Histogram(INTENT_BUCKETS))
+        return self.stats
+
+    def queued(self):
+        """Intents posted that the loop has not yet picked up."""
+        return self._intents.qsize()
+
     def status(self):
-        now = time.monotonic()
-        return [self.services[n].status(now) for n in self.order]
+        """Every service's status, from the last published snapshot."""
+        return self.snapshot.status()
+
+    def readings(self, now=None):
+        """Every service's latest resource sample, log volume and audio event
+        counts (see Service.readings); not versioned, so poll for these."""
+        now = now or time.monotonic()
+        return [self.services[n].readings(now) for n in self.order]
+
+    def _publish(self, now):
+        """Loop thread: replace the snapshot if anything in it changed."""
+        rows = [self.services[n].row() for n in self.order]
+        healthy = self.healthy(now)
+        latency = self.tuner.state() if self.tuner is not None else None
+        old = self.snapshot
+        if (healthy == old.healthy and latency is old.latency
+                and rows == [dict(row) for row in old.rows]):
+            return
+        with self._changed:
+            self.snapshot = Snapshot(old.version + 1, healthy, rows, now, latency)
+            self._changed.notify_all()
+
+    def changes(self, since=None, timeout=None):
+        """Block until the snapshot version differs from `since`, or timeout,
+        and return the snapshot. A watcher with nothing to learn sits here
+        rather than polling."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.snapshot.version != since, timeout)
+            return self.snapshot
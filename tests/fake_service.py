@@ -8,6 +8,9 @@ argv: fake_service.py <name> [mode]
   run     stay alive until terminated (default)
   crash   exit non-zero at once, to exercise the restart backoff
   stubborn ignore SIGTERM, to exercise the SIGKILL path
+  garbage  print invalid UTF-8 and more than a pipe buffer, then run
+  dropouts connect, print two underruns and a lost connection the way
+           squeezelite does, then reconnect and run
 """
 import os
 import signal
@@ -24,6 +27,19 @@ if mode == "crash":
     print("%s simulated failure" % name, flush=True)
     sys.exit(3)
 
+if mode == "dropouts":
+    print("slimproto:352 connected to 192.168.1.5:3483", flush=True)
+    print("output_thread:569 output underrun", flush=True)
+    print("output_thread:569 output underrun", flush=True)
+    print("slimproto:205 connection closed", flush=True)
+    print("slimproto:352 connected to 192.168.1.5:3483", flush=True)
+
+if mode == "garbage":
+    sys.stdout.buffer.write(b"%s bad bytes \xff\xfe here\n" % name.encode())
+    sys.stdout.buffer.write((b"x" * 99 + b"\n") * 2000)
+    sys.stdout.buffer.write(b"%s survived the garbage\n" % name.encode())
+    sys.stdout.flush()
+
 if mode == "stubborn":
     signal.signal(signal.SIGTERM, lambda *_: None)
 else:
@@ -1,6 +1,8 @@
 """The HTTP surface, against a real supervisor over fake binaries."""
 import base64
+import json
 import sys
+import threading
 import time
 
 import pytest
@@ -74,6 +76,97 @@ def test_restart_through_the_api_replaces_the_process(client):
     assert wait_until(lambda: client.sup.services["ledfx"].proc.pid != before)
 
 
+def _events(res):
+    """The data of each event in an SSE response, as it arrives."""
+    for chunk in res.response:
+        text = chunk.decode() if isinstance(chunk, bytes) else chunk
+        for block in text.split("\n\n"):
+            for line in block.splitlines():
+                if line.startswith("data: "):
+                    yield json.loads(line[len("data: "):])
+
+
+def test_the_event_stream_sends_the_table_then_only_what_changed(client):
+    # The published snapshot, not the live processes: a table sent while they
+    # were still starting would be followed by a delta of all four.
+    assert wait_until(lambda: all(row["running"] for row in client.sup.snapshot.rows))
+    res = client.get("/api/events", buffered=False)
+    assert res.mimetype == "text/event-stream"
+    events = _events(res)
+
+    first = next(events)
+    while len(first["services"]) < 4:      # the loop may still be settling
+        first = next(events)
+    assert [s["name"] for s in first["services"]] == list(client.sup.order)
+
+    client.sup.stop("squeezelite").wait(5)
+    delta = next(events)
+    while "squeezelite" not in [s["name"] for s in delta["services"]]:
+        delta = next(events)
+    # Only rows that changed: the three still running are not resent
+    assert [s["name"] for s in delta["services"]] == ["squeezelite"]
+    assert delta["services"][0]["state"] == "stopped"
+    res.close()
+
+
+def test_an_unchanged_status_is_a_304(client):
+    assert wait_until(lambda: client.sup.snapshot.service("ledfx")["state"] == "running")
+    time.sleep(0.3)                            # let the loop settle
+    first = client.get("/api/services")
+    etag = first.headers["ETag"]
+    again = client.get("/api/services", headers={"If-None-Match": etag})
+    if again.status_code == 200:               # the loop published in between
+        etag = again.headers["ETag"]
+        again = client.get("/api/services", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+
+    client.post("/api/services/squeezelite/stop")
+    changed = client.get("/api/services", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+
+def test_uptime_is_as_of_the_request_not_the_snapshot(client):
+    assert wait_until(lambda: client.sup.snapshot.healthy)
+    first = client.get("/api/services")
+    time.sleep(0.5)
+    again = client.get("/api/services")
+    assert again.headers["ETag"] == first.headers["ETag"]   # the same snapshot...
+    assert first.headers["ETag"].startswith("W/")
+    uptimes = [{s["name"]: s["uptime"] for s in res.get_json()["services"]}
+               for res in (first, again)]
+    # ...but a fresh body says how long it has been up by now
+    assert uptimes[1]["ledfx"] - uptimes[0]["ledfx"] >= 0.4
+    assert again.get_json()["as_of"] - first.get_json()["as_of"] >= 0.4
+
+
+def test_readings_are_served_apart_from_the_status(client):
+    sup = client.sup
+    assert wait_until(lambda: sup.snapshot.healthy and sup.readings()[-1]["usage"] is not None)
+    etag = client.get("/api/services").headers["ETag"]
+    usage = sup.readings()[-1]["usage"]
+
+    # A fresh sample is not a change of state: the status stays a 304
+    assert wait_until(lambda: sup.readings()[-1]["usage"] is not usage)
+    assert client.get("/api/services", headers={"If-None-Match": etag}).status_code == 304
+
+    rows = {row["name"]: row for row in client.get("/api/readings").get_json()["services"]}
+    assert rows["ledfx"]["usage"]["rss"] > 0
+    assert rows["ledfx"]["log_lines"] >= 1
+    assert set(rows["squeezelite"]["events"]) == set(rows["squeezelite"]["events_per_minute"])
+
+
+def test_an_unchanged_config_is_a_304_until_it_is_edited(client):
+    etag = client.get("/api/config").headers["ETag"]
+    assert client.get("/api/config", headers={"If-None-Match": etag}).status_code == 304
+
+    client.patch("/api/config", json={"services": {"squeezelite": {"name": "Tagged"}}})
+    res = client.get("/api/config", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.get_json()["services"]["squeezelite"]["name"] == "Tagged"
+
+
 def test_unknown_services_and_actions_are_refused(client):
     assert client.post("/api/services/nosuch/start").status_code == 404
     assert client.post("/api/services/ledfx/explode").status_code == 400
@@ -86,6 +179,75 @@ def test_logs_are_served_for_a_service(client):
     assert client.get("/api/services/nosuch/logs").status_code == 404
 
 
+def test_logs_can_be_followed_with_a_cursor(client):
+    svc = client.sup.services["ledfx"]
+    assert wait_until(lambda: any("PULSE_LATENCY_MSEC" in line for line in svc.logs))
+    data = client.get("/api/services/ledfx/logs").get_json()
+    assert data["next"] == svc.logs.next_seq and data["lost"] == 0
+
+    svc.record("one more line")
+    data = client.get("/api/services/ledfx/logs?since=%d" % data["next"]).get_json()
+    assert len(data["logs"]) == 1 and data["logs"][0].endswith("one more line")
+    assert client.get("/api/services/ledfx/logs?since=%d" % data["next"]).get_json()["logs"] == []
+
+    assert client.get("/api/services/ledfx/logs?since=abc").status_code == 400
+    assert client.get("/api/services/ledfx/logs?limit=0").status_code == 400
+
+
+def test_lines_the_ring_has_lost_are_read_from_the_spool(make_supervisor, tmp_path, monkeypatch):
+    from logspool import Spool
+
+    monkeypatch.setattr(panel, "ADMIN_PASSWORD", "")
+    sup = make_supervisor({"ledfx": fake_spec("ledfx", "run", enabled=False)},
+                          spool=Spool(str(tmp_path / "logs"), 8))
+    svc = sup.services["ledfx"]
+    for i in range(20000):
+        svc.record(b"line %05d " % i + b"." * 90)
+    assert svc.logs.first_seq > 0
+    sup.spool.flush()
+    app = panel.create_app(sup, services.env_defaults("ledfx-suite"))
+    with app.test_client() as c:
+        data = c.get("/api/services/ledfx/logs?since=0&limit=3").get_json()
+        assert data["first"] == 0 and data["next"] == 3 and data["lost"] == 0
+        assert "line 00002" in data["logs"][2]
+        data = c.get("/api/services/ledfx/logs?from=0&limit=1").get_json()
+        assert "line 00000" in data["logs"][0]
+    # Without a spool there is no history to ask a time of.
+    app = panel.create_app(make_supervisor({"ledfx": fake_spec("ledfx", enabled=False)}),
+                           services.env_defaults("ledfx-suite"))
+    with app.test_client() as c:
+        assert c.get("/api/services/ledfx/logs?from=0").status_code == 400
+
+
+def test_a_log_can_be_followed_live_and_filtered(client):
+    svc = client.sup.services["ledfx"]
+    assert wait_until(lambda: any("PULSE_LATENCY_MSEC" in line for line in svc.logs))
+    res = client.get("/api/services/ledfx/logs/stream?regex=^wanted", buffered=False)
+    assert res.mimetype == "text/event-stream"
+    events = _events(res)
+
+    threading.Timer(0.2, lambda: [svc.record(b"noise"), svc.record(b"wanted line")]).start()
+    event = next(events)
+    assert len(event["logs"]) == 1 and event["logs"][0].endswith("wanted line")
+    assert event["next"] == svc.logs.next_seq
+    res.close()
+
+
+def test_a_live_follower_can_replay_from_a_cursor(client):
+    svc = client.sup.services["ledfx"]
+    svc.record(b"before the stream")
+    cursor = svc.logs.next_seq - 1
+    res = client.get("/api/services/ledfx/logs/stream?since=%d" % cursor, buffered=False)
+    event = next(_events(res))
+    assert event["logs"][0].endswith("before the stream")
+    res.close()
+
+
+def test_a_bad_log_filter_is_a_400(client):
+    assert client.get("/api/services/ledfx/logs/stream?regex=(").status_code == 400
+    assert client.get("/api/services/nosuch/logs/stream").status_code == 404
+
+
 def test_config_is_returned_and_patched(client):
     assert client.get("/api/config").get_json()["role"] == "ledfx-suite"
 
@@ -167,3 +329,41 @@ def test_stopping_through_the_api_persists_and_is_not_undone_by_an_edit(client):
     assert wait_until(lambda: client.sup.services["ledfx"].proc is not None)
     time.sleep(0.5)
     assert client.sup.services["squeezelite"].state == "stopped"
+
+
+def test_metrics_are_served_in_the_openmetrics_format(client):
+    assert wait_until(lambda: all(s["running"] for s in client.sup.status()))
+    assert client.sup.stats is None  # nothing timed before anyone scrapes
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert res.headers["Content-Type"].startswith("application/openmetrics-text")
+    body = res.get_data(as_text=True)
+    assert body.endswith("# EOF\n")
+    assert 'ledfx_service_up{service="ledfx"} 1' in body
+    assert 'ledfx_service_state{service="ledfx",ledfx_service_state="running"} 1' in body
+    assert 'ledfx_service_restarts_total{service="pulseaudio"} 0' in body
+    assert "ledfx_log_dropped_lines_total 0" in body
+    assert 'ledfx_audio_events_total{service="squeezelite",type="underrun"} 0' in body
+
+    # The scrape switched the timings on; the next one has something in them.
+    client.sup.restart("ledfx").wait(5)
+    client.get("/api/services")
+    body = client.get("/metrics").get_data(as_text=True)
+    counts = {line.split()[0]: float(line.split()[1])
+              for line in body.splitlines() if "_count" in line}
+    assert counts["ledfx_supervisor_tick_seconds_count"] >= 1
+    assert counts["ledfx_supervisor_intent_seconds_count"] >= 1
+    assert counts['ledfx_http_request_seconds_count{route="/api/services",method="GET"}'] == 1
+
+
+def test_a_services_history_is_served_downsampled(client):
+    assert wait_until(lambda: client.sup.readings()[0]["usage"] is not None)
+    res = client.get("/api/services/ledfx/history?points=12")
+    assert res.status_code == 200
+    data = res.get_json()
+    assert len(data["t"]) == 12 and data["to"] - data["from"] == panel.HISTORY_WINDOW_S
+    assert set(data["cpu_percent"]) == {"min", "max", "mean"}
+    assert 1 in data["up"]["max"]
+
+    assert client.get("/api/services/ledfx/history?from=10&to=5").status_code == 400
+    assert client.get("/api/services/nosuch/history").status_code == 404
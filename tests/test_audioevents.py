@@ -0,0 +1,60 @@
+"""Turning the children's log lines into typed audio events."""
+import pytest
+
+import audioevents
+from audioevents import Extractor
+
+
+@pytest.mark.parametrize("service, line, kind", [
+    ("squeezelite", b"[12:00:01.5] output_thread:569 output underrun", "underrun"),
+    ("squeezelite", b"slimproto:205 connection closed", "reconnect"),
+    ("squeezelite", b"output_thread:495 track start sample rate: 96000", "format_change"),
+    ("snapclient", b"[Error] (Connection) Connection lost, reconnecting", "reconnect"),
+    ("snapclient", b"[Info] (Player) sampleformat: 48000:16:2", "format_change"),
+    ("snapclient", b"[Info] ServerSettings - buffer: 1000, latency: 0", "buffer_resize"),
+    ("snapclient", b"[Warn] (Player) XRUN", "underrun"),
+    ("pulseaudio", b"E: [alsa-sink] Underrun on 'sink'", "underrun"),
+    ("pulseaudio", b"I: [pulseaudio] Changing sample rate to 48000 Hz", "format_change"),
+])
+def test_known_lines_become_events(service, line, kind):
+    assert Extractor(service).feed(line) == kind
+
+
+def test_ordinary_lines_and_unknown_services_are_not_events():
+    assert Extractor("squeezelite").feed(b"decode_thread:100 streaming") is None
+    assert Extractor("ledfx").feed(b"underrun") is None
+
+
+def test_totals_and_the_per_minute_rate():
+    events = Extractor("squeezelite")
+    events.feed(b"connected to lms", now=90)
+    events.feed(b"output underrun", now=100)
+    events.feed(b"output underrun", now=150)
+    events.feed(b"connected to lms", now=155)
+    totals, recent, last = events.snapshot()
+    assert totals["underrun"] == 2 and totals["reconnect"] == 1
+    assert last == {"type": "reconnect", "line": "connected to lms"}
+    rate = audioevents.per_minute(recent, now=200)
+    assert rate["underrun"] == 1 and rate["reconnect"] == 1
+
+
+def test_a_clean_start_is_not_a_reconnect():
+    events = Extractor("squeezelite")
+    assert events.feed(b"slimproto:352 connected to 192.168.1.5:3483") is None
+    assert events.totals["reconnect"] == 0
+    # A lost connection counts once, not again when it comes back...
+    assert events.feed(b"slimproto:205 connection closed") == "reconnect"
+    assert events.feed(b"slimproto:352 connected to 192.168.1.5:3483") is None
+    assert events.totals["reconnect"] == 1
+    # ...and a restarted process connecting is a fresh start again.
+    events.started()
+    assert events.feed(b"slimproto:352 connected to 192.168.1.5:3483") is None
+    assert events.totals["reconnect"] == 1
+
+
+def test_a_snapshot_is_reused_until_the_next_event():
+    events = Extractor("pulseaudio")
+    first = events.snapshot()
+    assert events.snapshot() is first
+    events.feed(b"Underrun!")
+    assert events.snapshot() is not first
@@ -0,0 +1,63 @@
+"""Per-service cgroups, against a directory laid out like cgroupfs."""
+import os
+
+import cgroups
+
+
+def fake_cgroupfs(tmp_path, controllers="cpuset cpu io memory pids"):
+    root = tmp_path / "cg"
+    root.mkdir()
+    (root / "cgroup.controllers").write_text(controllers + "\n")
+    (root / "cgroup.subtree_control").write_text("")
+    return root
+
+
+def test_setup_leaves_the_root_and_enables_the_controllers(tmp_path):
+    root = fake_cgroupfs(tmp_path)
+    tree = cgroups.Tree(str(root))
+    tree.setup()
+    assert (root / "supervisor" / "cgroup.procs").read_text() == str(os.getpid())
+    assert (root / "cgroup.subtree_control").read_text() == "+cpu +io +memory"
+
+
+def test_a_service_is_placed_with_its_quotas(tmp_path):
+    root = fake_cgroupfs(tmp_path)
+    tree = cgroups.Tree(str(root))
+    tree.setup()
+    assert tree.place("ledfx", 4242, {"cpu_max": 150, "cpu_weight": 50, "io_weight": 20}) == []
+    svc = root / "ledfx"
+    assert (svc / "cpu.max").read_text() == "150000 100000"
+    assert (svc / "cpu.weight").read_text() == "50"
+    assert (svc / "io.weight").read_text() == "default 20"
+    assert (svc / "cgroup.procs").read_text() == "4242"
+
+    tree.apply("ledfx", {})
+    assert (svc / "cpu.max").read_text() == "max 100000"
+
+
+def test_a_malformed_quota_is_reported_not_written(tmp_path):
+    root = fake_cgroupfs(tmp_path)
+    tree = cgroups.Tree(str(root))
+    tree.setup()
+    assert tree.apply("ledfx", {"cpu_max": "half"}) == [
+        "cgroup: invalid literal for int() with base 10: 'half'"]
+    assert not (root / "ledfx" / "cpu.max").exists()
+
+
+def test_only_the_controllers_on_offer_are_used(tmp_path):
+    root = fake_cgroupfs(tmp_path, controllers="memory pids")
+    tree = cgroups.Tree(str(root))
+    tree.setup()
+    assert (root / "cgroup.subtree_control").read_text() == "+memory"
+    tree.place("ledfx", 1, {"cpu_max": 50})
+    assert not (root / "ledfx" / "cpu.max").exists()
+
+
+def test_usage_is_read_back(tmp_path):
+    root = fake_cgroupfs(tmp_path)
+    tree = cgroups.Tree(str(root))
+    (root / "ledfx").mkdir()
+    (root / "ledfx" / "cpu.stat").write_text("usage_usec 123456\nuser_usec 100000\n")
+    (root / "ledfx" / "memory.current").write_text("7340032\n")
+    assert tree.usage("ledfx") == {"cpu_usec": 123456, "memory": 7340032}
+    assert tree.usage("other") == {"cpu_usec": None, "memory": None}
@@ -0,0 +1,57 @@
+"""The per-service resource history: fixed memory, rollups, downsampling."""
+import time
+
+from history import History
+
+
+def filled(history, seconds, **fields):
+    """Samples for the last `seconds`, one a second, ending now."""
+    now = time.monotonic()
+    for i in range(seconds):
+        cpu = fields.get("cpu", lambda i: i % 10)(i)
+        history.add(now - seconds + i + 1, cpu, 1000 + i, 0, 1)
+    return time.time()
+
+
+def test_its_memory_is_fixed_at_construction():
+    history = History(1, span=3600)
+    size = history.nbytes
+    filled(history, 3000)
+    assert history.nbytes == size
+    # 3600 raw slots of four float32 fields and a stamp, plus the rollups
+    assert size < 3600 * 20 + 60 * 84 + 6 * 84 + 1
+
+
+def test_buckets_carry_the_min_max_and_mean_of_their_samples():
+    history = History(1, span=3600)
+    now = filled(history, 100)
+    data = history.query(now - 100, now, 10)
+    assert data["resolution"] == 1
+    assert len(data["t"]) == 10
+    cpu = data["cpu_percent"]
+    full = [i for i, mean in enumerate(cpu["mean"]) if mean is not None]
+    assert len(full) >= 9
+    i = full[len(full) // 2]
+    assert (cpu["min"][i], cpu["max"][i]) == (0, 9)
+    assert cpu["mean"][i] == 4.5
+    assert data["up"]["mean"][i] == 1
+
+
+def test_a_long_range_is_answered_from_a_rollup():
+    history = History(1, span=3600)
+    now = filled(history, 1800, cpu=lambda i: 50)
+    data = history.query(now - 1800, now, 3)
+    assert data["resolution"] == 600
+    means = [m for m in data["cpu_percent"]["mean"] if m is not None]
+    assert means and all(m == 50 for m in means)
+    assert data["rss"]["max"][-1] >= 1000 + 1700
+
+
+def test_stopped_time_and_old_laps_read_as_no_data():
+    history = History(1, span=60)
+    now = time.monotonic()
+    history.add(now - 200, 99, 5, 0, 1)     # a lap and more ago
+    history.add(now - 10, None, None, 0, 0)  # stopped: nothing to measure
+    data = history.query(time.time() - 60, time.time(), 6)
+    assert all(v is None for v in data["cpu_percent"]["max"])
+    assert 0 in data["up"]["min"]
@@ -0,0 +1,85 @@
+"""The PULSE_LATENCY_MSEC tuner's decisions, on made-up underrun counts."""
+import json
+
+import latency
+from latency import LatencyTuner
+
+
+def tuner(tmp_path=None, configured=10):
+    path = str(tmp_path / "latency.json") if tmp_path else None
+    return LatencyTuner(configured, ["squeezelite", "ledfx"], state_path=path)
+
+
+def test_dropouts_step_it_up_one_rung():
+    t = tuner()
+    assert t.observe(0, 0) is None
+    assert t.observe(5, 2) is None          # under UP_UNDERRUNS
+    assert t.observe(10, 3) == 15
+    assert t.msec == 15 and t.changes == 1
+    assert t.decisions[-1]["from"] == 10 and "3 underruns" in t.decisions[-1]["reason"]
+
+
+def test_underruns_spread_wider_than_the_window_do_not_count():
+    t = tuner()
+    for i in range(1, 6):
+        assert t.observe(i * (latency.UP_WINDOW_S + 1), i) is None
+    assert t.msec == 10
+
+
+def test_changes_are_rate_capped_and_the_restart_settles_first():
+    t = tuner()
+    assert t.observe(0, 3) == 15
+    # The restart's own dropouts are not held against the new value...
+    assert t.observe(latency.SETTLE_S - 1, 10) is None
+    # ...and later ones wait out MIN_CHANGE_S before it moves again.
+    assert t.observe(latency.SETTLE_S + 1, 13) is None
+    assert t.observe(latency.MIN_CHANGE_S - 1, 13) is None
+    assert t.observe(latency.MIN_CHANGE_S - 1 + 30, 16) == 20
+
+
+def test_a_long_clean_stretch_steps_it_down():
+    t = tuner(configured=20)
+    assert t.observe(0, 0) is None
+    assert t.observe(latency.DOWN_CLEAN_S - 1, 0) is None
+    assert t.observe(latency.DOWN_CLEAN_S, 0) == 15
+    assert "no underruns" in t.decisions[-1]["reason"]
+
+
+def test_a_step_down_that_does_not_hold_doubles_the_wait_for_the_next():
+    t = tuner(configured=20)
+    t.observe(0, 0)
+    down = latency.DOWN_CLEAN_S
+    assert t.observe(down, 0) == 15
+    up = down + latency.MIN_CHANGE_S
+    assert t.observe(up, 3) == 20
+    assert t.clean_s == 2 * latency.DOWN_CLEAN_S
+    assert t.observe(up + latency.DOWN_CLEAN_S, 3) is None
+    assert t.observe(up + 2 * latency.DOWN_CLEAN_S, 3) == 15
+
+
+def test_the_ends_of_the_ladder_hold():
+    t = tuner(configured=latency.LADDER[-1])
+    assert t.observe(0, 100) is None
+    t = tuner(configured=latency.LADDER[0])
+    t.observe(0, 0)
+    assert t.observe(latency.DOWN_CLEAN_S, 0) is None
+
+
+def test_what_it_settled_on_survives_a_restart(tmp_path):
+    t = tuner(tmp_path)
+    t.observe(0, 3)
+    assert tuner(tmp_path).msec == 15
+    # Tuned from another starting point: not this one's to reuse.
+    assert tuner(tmp_path, configured=40).msec == 40
+    (tmp_path / "latency.json").write_text("not json")
+    assert tuner(tmp_path).msec == 10
+
+
+def test_the_operator_setting_a_value_starts_over(tmp_path):
+    t = tuner(tmp_path)
+    t.observe(0, 3)
+    before = t.state()
+    assert not t.configure("10")
+    assert t.configure("40")
+    assert t.msec == 40 and t.state() is not before
+    assert json.loads((tmp_path / "latency.json").read_text())["configured"] == 40
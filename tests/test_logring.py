@@ -0,0 +1,125 @@
+"""The log ring: fixed memory, newest lines kept, formatted only when read."""
+import re
+
+from logring import LogRing
+
+
+def test_lines_come_back_oldest_first_with_a_subsecond_time():
+    ring = LogRing(max_bytes=1024, max_lines=16)
+    ring.append(b"first")
+    ring.append("second")
+    lines = ring.lines()
+    assert [line.split(" ", 1)[1] for line in lines] == ["first", "second"]
+    assert re.match(r"\d\d:\d\d:\d\d\.\d{3} first$", lines[0])
+
+
+def test_the_oldest_lines_make_room_for_new_ones():
+    ring = LogRing(max_bytes=100, max_lines=1000)
+    for i in range(500):
+        ring.append(b"line %03d" % i, ts_ns=i)
+    entries = ring.entries()
+    assert entries[-1] == (499, b"line 499")
+    # Contiguous: nothing in the middle was lost to make room
+    assert [ts for ts, _ in entries] == list(range(500 - len(entries), 500))
+    assert sum(len(raw) for _, raw in entries) <= 100
+
+
+def test_the_line_count_is_bounded_too():
+    ring = LogRing(max_bytes=1 << 16, max_lines=8)
+    for i in range(20):
+        ring.append(b"x")
+    assert len(ring) == 8
+
+
+def test_a_long_line_is_cut_not_dropped():
+    ring = LogRing(max_bytes=1024, max_lines=8, line_max=10)
+    ring.append(b"y" * 50)
+    assert ring.entries()[0][1] == b"y" * 10
+
+
+def test_invalid_utf8_is_shown_rather_than_raised():
+    ring = LogRing(max_bytes=1024, max_lines=8)
+    ring.append(b"bad \xff byte")
+    assert ring.lines()[0].endswith("bad \ufffd byte")
+
+
+def test_storage_is_allocated_up_front():
+    ring = LogRing(max_bytes=4096, max_lines=64)
+    arena = ring._arena
+    for i in range(1000):
+        ring.append(b"z" * (i % 50))
+    assert ring._arena is arena and len(arena) == 4096
+
+
+def test_a_reader_gets_only_what_is_new_since_its_cursor():
+    ring = LogRing(max_bytes=1024, max_lines=100)
+    for i in range(5):
+        ring.append(b"a%d" % i)
+    lines, first, nxt, lost = ring.read()
+    assert (len(lines), first, nxt, lost) == (5, 0, 5, 0)
+
+    ring.append(b"b")
+    lines, first, nxt, lost = ring.read(since=nxt)
+    assert [line.split(" ", 1)[1] for line in lines] == ["b"]
+    assert (first, nxt, lost) == (5, 6, 0)
+    assert ring.read(since=nxt)[0] == []
+
+
+def test_a_reader_that_fell_behind_is_told_how_much_it_lost():
+    ring = LogRing(max_bytes=1024, max_lines=10)
+    for i in range(25):
+        ring.append(b"%d" % i)
+    lines, first, nxt, lost = ring.read(since=3)
+    assert (first, nxt, lost) == (15, 25, 12)
+    assert lines[0].endswith(" 15")
+
+
+def test_limit_pages_forward_from_the_cursor_and_tails_without_one():
+    ring = LogRing(max_bytes=1024, max_lines=100)
+    for i in range(10):
+        ring.append(b"%d" % i)
+    lines, first, nxt, _ = ring.read(since=2, limit=3)
+    assert (first, nxt) == (2, 5)
+    lines, first, nxt, _ = ring.read(limit=3)
+    assert (first, nxt) == (7, 10)
+
+
+def test_a_slow_follower_loses_lines_and_is_told():
+    ring = LogRing(max_bytes=1024, max_lines=100)
+    tail = ring.subscribe(maxlen=3)
+    for i in range(5):
+        ring.append(b"%d" % i)
+    entries, dropped = tail.get(timeout=0)
+    assert [raw for _, _, raw in entries] == [b"0", b"1", b"2"]
+    assert [seq for seq, _, _ in entries] == [0, 1, 2]
+    assert dropped == 2
+
+    ring.unsubscribe(tail)
+    ring.append(b"unheard")
+    assert tail.get(timeout=0) == ([], 0)
+
+
+def test_with_history_the_lines_it_lets_go_are_kept_compressed(monkeypatch):
+    import logring
+
+    monkeypatch.setattr(logring, "BLOCK_BYTES", 2048)
+    ring = LogRing(max_bytes=4096, max_lines=1000, history_bytes=8192)
+    for i in range(5000):
+        ring.append(b"ledfx: frame %05d rendered in 3 ms" % i, ts_ns=i)
+    # Far more than the arena holds, in a fraction of the raw size.
+    assert len(ring) > 1000 and ring.nbytes < 4096 + 8192 + 2048
+    first = ring.first_seq
+    assert ring.entries(first, first + 1) == [(first, b"ledfx: frame %05d rendered in 3 ms" % first)]
+    # A range across history, the block being filled and the arena is seamless.
+    entries = ring.entries(first)
+    assert [ts for ts, _ in entries] == list(range(first, 5000))
+    lines, start, nxt, lost = ring.read(since=0, limit=3)
+    assert (start, nxt, lost) == (first, first + 3, first)
+    assert lines[2].endswith("frame %05d rendered in 3 ms" % (first + 2))
+
+
+def test_without_history_nothing_is_compressed():
+    ring = LogRing(max_bytes=100, max_lines=1000)
+    for i in range(500):
+        ring.append(b"line %03d" % i)
+    assert ring.nbytes == 100 and not ring._blocks and ring._filling is None
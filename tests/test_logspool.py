@@ -0,0 +1,153 @@
+"""The on-disk log spool: segments, retention, and reads from the index."""
+import errno
+import os
+import time
+
+import logspool
+from logring import LogRing
+from logspool import Spool
+
+
+def spooled(tmp_path, lines, name="ledfx", max_mb=1):
+    spool = Spool(str(tmp_path), max_mb)
+    ring = LogRing()
+    svc = spool.service(name)
+    ring.next_seq = svc.next_seq
+    ring.sink = svc.append
+    for line in lines:
+        ring.append(line)
+    spool.flush()
+    return spool, svc, ring
+
+
+def test_lines_come_back_from_disk_by_sequence_number(tmp_path):
+    _, svc, ring = spooled(tmp_path, [b"line %d" % i for i in range(1000)])
+    entries = svc.read(700, 5)
+    assert [seq for seq, _, _ in entries] == list(range(700, 705))
+    assert entries[0][2] == b"line 700"
+    # The same timestamps the ring gives, so they format the same way.
+    assert entries[-1][1] == ring.entries(704, 705)[0][0]
+
+
+def test_numbering_carries_on_after_a_restart_and_a_torn_write_is_cut(tmp_path):
+    spool, svc, _ = spooled(tmp_path, [b"before %d" % i for i in range(10)])
+    spool.close()
+    with open(svc._active.path, "ab") as handle:
+        handle.write(logspool.HEADER.pack(10, 0, 50) + b"half")
+    _, again, ring = spooled(tmp_path, [b"after"])
+    assert again.next_seq == 10 and ring.first_seq == 10
+    assert [raw for _, _, raw in again.read(8, 10)] == [b"before 8", b"before 9", b"after"]
+
+
+def test_numbers_lost_lines_had_are_not_handed_out_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(logspool, "QUEUE_LINES", 5)
+    said = []
+    spool = Spool(str(tmp_path), 1, log=lambda level, msg: said.append(msg))
+    svc = spool.service("ledfx")
+    for i in range(20):  # faster than the writer lingers
+        svc.append(i, time.monotonic_ns(), b"line %d" % i)
+    spool.flush()
+    assert svc.dropped == 15 and any("15 log lines" in msg for msg in said)
+    assert [seq for seq, _, _ in svc.read(0, 20)] == list(range(5))
+
+    # No clean close: the next run starts above anything this one claimed
+    again = Spool(str(tmp_path), 1).service("ledfx")
+    assert again.next_seq >= 20
+
+
+def test_segments_rotate_and_the_oldest_go_first_whoever_they_belong_to(tmp_path, monkeypatch):
+    monkeypatch.setattr(logspool, "SEGMENT_MIN", 4096)
+    spool = Spool(str(tmp_path), 1)
+    spool.segment_bytes = 4096
+    spool.max_bytes = 20000
+    quiet, chatty = spool.service("pulseaudio"), spool.service("ledfx")
+    for i in range(100):
+        quiet.append(i, time.monotonic_ns(), b"q" * 40)
+    spool.flush()
+    for i in range(2000):
+        chatty.append(i, time.monotonic_ns(), b"x" * 40)
+    spool.flush()
+    # Its first segment was the oldest anywhere; the one it is writing stays.
+    assert quiet.read(0, 1)[0][0] > 0
+    assert spool.max_bytes - 4096 <= quiet.nbytes + chatty.nbytes <= spool.max_bytes + 4096
+    assert len(os.listdir(tmp_path / "ledfx")) > 1
+    newest = chatty.read(1999, 1)
+    assert newest and newest[0][2] == b"x" * 40
+    assert chatty.read(0, 1)[0][0] > 0
+
+
+def test_a_time_finds_the_first_line_printed_then(tmp_path):
+    spool = Spool(str(tmp_path), 1)
+    svc = spool.service("ledfx")
+    base = time.monotonic_ns()
+    for i in range(300):
+        svc.append(i, base + i * 10**9, b"second %d" % i)
+    spool.flush()
+    start = (base + logspool._WALL_OFFSET_NS) / 1e9
+    assert svc.seq_at(start + 150.5) == 151
+    assert svc.seq_at(start - 1000) == 0
+    assert svc.seq_at(start + 10**6) == 300
+
+
+def test_a_write_failure_is_reported_once_through_the_log(tmp_path, monkeypatch):
+    said = []
+    spool = Spool(str(tmp_path), 1, log=lambda level, msg: said.append((level, msg)))
+    svc = spool.service("ledfx")
+
+    def full(fd, data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(logspool.os, "write", full)
+    for i in range(3):
+        svc.append(i, time.monotonic_ns(), b"line")
+        spool.flush()
+    assert len(said) == 1
+    assert said[0][0] == "WARN" and "No space left on device" in said[0][1]
+
+
+def test_a_batch_that_fails_halfway_is_taken_back_off_the_file(tmp_path, monkeypatch):
+    spool, svc, _ = spooled(tmp_path, [b"kept %d" % i for i in range(5)])
+    real_write, calls = os.write, []
+
+    def short_then_full(fd, data):
+        calls.append(len(data))
+        if len(calls) == 1:
+            return real_write(fd, bytes(data[:len(data) // 2]))
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(logspool.os, "write", short_then_full)
+    for i in range(5, 10):
+        svc.append(i, time.monotonic_ns(), b"lost %d" % i)
+    spool.flush()
+    monkeypatch.setattr(logspool.os, "write", real_write)
+    assert os.path.getsize(svc._active.path) == svc._active.size
+
+    svc.append(10, time.monotonic_ns(), b"after")
+    spool.flush()
+    assert [raw for _, _, raw in svc.read(0, 20)] == [b"kept %d" % i for i in range(5)] + [b"after"]
+
+
+def test_a_segment_left_empty_by_a_failed_write_is_trimmed_first(tmp_path, monkeypatch):
+    said = []
+    spool = Spool(str(tmp_path), 1, log=lambda level, msg: said.append((level, msg)))
+    spool.segment_bytes, spool.max_bytes = 4096, 20000
+    quiet, chatty = spool.service("pulseaudio"), spool.service("ledfx")
+
+    def refuse(*args):
+        raise OSError(errno.EIO, "Input/output error")
+
+    # Neither the write nor taking it back works: the segment is abandoned empty
+    with monkeypatch.context() as patch:
+        patch.setattr(logspool.os, "write", refuse)
+        patch.setattr(logspool.os, "ftruncate", refuse)
+        quiet.append(0, time.monotonic_ns(), b"lost")
+        spool.flush()
+    assert quiet._segments[0].count == 0 and quiet._active is None
+
+    quiet.append(1, time.monotonic_ns(), b"q" * 40)
+    for i in range(2000):
+        chatty.append(i, time.monotonic_ns(), b"x" * 40)
+    spool.flush()
+    assert quiet._segments[0].count == 1
+    assert quiet.nbytes + chatty.nbytes <= spool.max_bytes + 4096
+    assert not [level for level, _ in said if level == "ERROR"]
@@ -0,0 +1,62 @@
+"""Applying CPU, nice and scheduling settings to a running process."""
+import os
+import subprocess
+import sys
+
+import pytest
+
+import priority
+
+
+@pytest.fixture
+def child():
+    proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    yield proc
+    proc.kill()
+    proc.wait()
+
+
+def test_cpu_lists_parse_into_sets():
+    assert priority.parse_cpus("0-2, 5") == {0, 1, 2, 5}
+    assert priority.parse_cpus("") == set()
+    for bad in ["a", "3-1", "1-", "0-4096"]:
+        with pytest.raises(ValueError):
+            priority.parse_cpus(bad)
+
+
+def test_settings_reach_the_process(child):
+    cpu = min(os.sched_getaffinity(0))
+    assert priority.apply(child.pid, {"cpus": str(cpu), "nice": 3, "ionice": "idle"}) == []
+    assert os.sched_getaffinity(child.pid) == {cpu}
+    assert os.getpriority(os.PRIO_PROCESS, child.pid) == 3
+
+
+def test_defaults_undo_them(child):
+    priority.apply(child.pid, {"cpus": str(min(os.sched_getaffinity(0)))})
+    assert priority.apply(child.pid, {}) == []
+    assert os.sched_getaffinity(child.pid) == os.sched_getaffinity(0)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="lowering nice needs CAP_SYS_NICE")
+def test_defaults_undo_a_raised_nice(child):
+    priority.apply(child.pid, {"nice": 3})
+    assert priority.apply(child.pid, {}) == []
+    assert os.getpriority(os.PRIO_PROCESS, child.pid) == 0
+
+
+def test_a_refused_setting_is_reported_not_raised(child, monkeypatch):
+    def refuse(*args):
+        raise PermissionError(1, "Operation not permitted")
+
+    monkeypatch.setattr(os, "sched_setscheduler", refuse)
+    failed = priority.apply(child.pid, {"sched": "fifo", "nice": 2})
+    assert failed == ["scheduling policy: Operation not permitted"]
+    assert os.getpriority(os.PRIO_PROCESS, child.pid) == 2
+
+
+def test_a_malformed_setting_is_reported_not_raised(child):
+    assert priority.apply(child.pid, {"nice": "lots"}) == [
+        "priority: invalid literal for int() with base 10: 'lots'"]
+    assert priority.apply(child.pid, {"sched": "sometimes"}) == [
+        "priority: unknown value 'sometimes'"]
+    assert priority.apply(child.pid, {"rt_priority": None, "sched": "fifo"})
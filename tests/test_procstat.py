@@ -0,0 +1,42 @@
+"""Reading a process's cost from /proc."""
+import os
+import threading
+
+import procstat
+
+
+def test_it_reads_a_live_process():
+    stop = threading.Event()
+    worker = threading.Thread(target=stop.wait)
+    worker.start()
+    try:
+        with open(__file__):
+            usage = procstat.read(os.getpid())
+    finally:
+        stop.set()
+        worker.join()
+    assert usage["threads"] >= 2
+    assert usage["rss"] > 1 << 20
+    assert usage["fds"] >= 4  # stdio plus the file held open above
+    assert usage["cpu_s"] > 0
+    assert usage["ctx_voluntary"] >= 0 and usage["ctx_involuntary"] >= 0
+
+
+def test_a_command_name_with_spaces_and_parens_does_not_shift_the_fields(tmp_path):
+    proc = tmp_path / "42"
+    (proc / "fd").mkdir(parents=True)
+    (proc / "stat").write_bytes(
+        b"42 (my (odd) name) S 1 42 42 0 -1 4194560 100 0 0 0 "
+        + b"%d %d 0 0 20 0 7 0 100 1000000 250" % (3 * procstat._TICK, procstat._TICK))
+    (proc / "statm").write_bytes(b"1000 250 100 1 0 200 0\n")
+    (proc / "status").write_bytes(b"Name:\tx\nvoluntary_ctxt_switches:\t12\n"
+                                  b"nonvoluntary_ctxt_switches:\t3\n")
+    usage = procstat.read(42, root=str(tmp_path))
+    assert usage["cpu_s"] == 4
+    assert usage["threads"] == 7
+    assert usage["rss"] == 250 * os.sysconf("SC_PAGE_SIZE")
+    assert (usage["ctx_voluntary"], usage["ctx_involuntary"]) == (12, 3)
+
+
+def test_a_process_that_has_gone_reads_as_none(tmp_path):
+    assert procstat.read(12345, root=str(tmp_path)) is None
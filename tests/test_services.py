@@ -3,6 +3,8 @@ import json
 
 import pytest
 
+import cgroups
+import priority
 import services
 from services import ConfigError
 
@@ -19,6 +21,7 @@ def env(monkeypatch):
     monkeypatch.setenv("SQUEEZELITE_EXTRA_ARGS", "-W")
     monkeypatch.setenv("PULSE_LATENCY_MSEC", "10")
     monkeypatch.delenv("SNAP_CLIENT_ID", raising=False)
+    monkeypatch.delenv("LATENCY_AUTOTUNE", raising=False)
     monkeypatch.delenv("EXTRA_ARGS", raising=False)
     return monkeypatch
 
@@ -83,6 +86,38 @@ def test_new_keys_appear_without_deleting_an_old_config(env, tmp_path):
     assert "PULSE_LATENCY_MSEC" in doc["env"]
 
 
+def test_stored_limits_are_checked_like_a_patch(env, tmp_path, capsys):
+    path = tmp_path / "services.json"
+    path.write_text(json.dumps({"version": 1, "role": "ledfx-suite", "env": {}, "services": {
+        "ledfx": {"max_rss_mb": "512", "max_fds": "lots", "max_cpu_percent": -5}}}))
+    limits = services.build(services.load(str(path)))["ledfx"]["limits"]
+    # What the panel would have accepted, as it would have stored it
+    assert limits["max_rss_mb"] == 512
+    # ...and the default, with a warning, for what it would have refused
+    assert limits["max_fds"] == 0 and limits["max_cpu_percent"] == 0
+    assert "ledfx.max_fds must be a number" in capsys.readouterr().out
+
+
+def test_stored_priorities_are_checked_like_a_patch(env, tmp_path, capsys):
+    path = tmp_path / "services.json"
+    path.write_text(json.dumps({"version": 1, "role": "ledfx-suite", "env": {}, "services": {
+        "ledfx": {"nice": "high", "sched": "fifo", "rt_priority": 500, "cpus": "0-"}}}))
+    scheduling = services.build(services.load(str(path)))["ledfx"]["priority"]
+    assert scheduling == dict(priority.DEFAULTS, sched="fifo")
+    out = capsys.readouterr().out
+    assert "ledfx.nice" in out and "ledfx.rt_priority" in out and "ledfx.cpus" in out
+
+
+def test_stored_cgroup_quotas_are_checked_like_a_patch(env, tmp_path, capsys):
+    path = tmp_path / "services.json"
+    path.write_text(json.dumps({"version": 1, "role": "ledfx-suite", "env": {}, "services": {
+        "ledfx": {"cpu_max": "half", "cpu_weight": 0, "io_weight": "200"}}}))
+    quotas = services.build(services.load(str(path)))["ledfx"]["cgroup"]
+    assert quotas == dict(cgroups.DEFAULTS, io_weight=200)
+    out = capsys.readouterr().out
+    assert "ledfx.cpu_max" in out and "ledfx.cpu_weight" in out
+
+
 def test_reset_goes_back_to_the_environment(env, tmp_path):
     path = tmp_path / "services.json"
     doc = services.load(str(path))
@@ -141,7 +176,8 @@ def test_with_no_environment_at_all_the_image_still_has_a_config(monkeypatch):
     for var in ["ROLE", "SNAP_HOST", "SNAP_CLIENT_ID", "CLIENT_ID", "EXTRA_ARGS",
                 "SQUEEZELITE_NAME", "SQUEEZELITE_SERVER_PORT", "SQUEEZELITE_MAC",
                 "SQUEEZELITE_EXTRA_ARGS", "SQUEEZELITE_OUTPUT", "PULSE_LATENCY_MSEC",
-                "STARTUP_DELAY_SEC", "LEDFX_HOST", "LEDFX_PORT"]:
+                "STARTUP_DELAY_SEC", "SAMPLE_INTERVAL_SEC", "LATENCY_AUTOTUNE", "LOG_SPOOL_DIR",
+                "LOG_SPOOL_MB", "LOG_HISTORY_MB", "LEDFX_HOST", "LEDFX_PORT"]:
         monkeypatch.delenv(var, raising=False)
     specs = services.build(services.env_defaults())
 
@@ -159,6 +195,41 @@ def test_giving_a_host_unblocks_snapclient(env):
     assert services.build(doc)["snapclient"]["argv"][-1] == "tcp://192.168.1.50"
 
 
+def test_build_is_remembered_per_revision(env, tmp_path, monkeypatch):
+    doc = services.load(str(tmp_path / "services.json"))
+    first = services.build(doc)
+
+    calls = []
+    monkeypatch.setattr(services.shlex, "split", lambda *a: calls.append(a) or [])
+    assert services.build(doc) is first
+    assert calls == []
+
+    patched, _ = services.apply_patch(doc, {"services": {"ledfx": {"port": 9000}}})
+    assert patched["revision"] != doc["revision"]
+    assert services.build(patched) is not first
+
+
+def test_an_in_place_edit_needs_a_new_revision(env, tmp_path):
+    doc = services.load(str(tmp_path / "services.json"))
+    assert services.build(doc)["squeezelite"]["enabled"]
+    doc["services"]["squeezelite"]["enabled"] = False
+    services.touch(doc)
+    assert not services.build(doc)["squeezelite"]["enabled"]
+
+
+def test_a_reset_document_never_reuses_a_revision(env, tmp_path):
+    path = str(tmp_path / "services.json")
+    doc = services.load(path)
+    reset = services.reset_to_env(path)
+    assert reset["revision"] > doc["revision"]
+
+
+def test_the_revision_is_not_written_to_disk(env, tmp_path):
+    path = tmp_path / "services.json"
+    services.save(services.load(str(path)), str(path))
+    assert "revision" not in json.loads(path.read_text())
+
+
 def test_pulse_latency_reaches_the_children(env):
     specs = services.build(services.env_defaults("ledfx-suite"))
     assert specs["squeezelite"]["env"]["PULSE_LATENCY_MSEC"] == "10"
@@ -181,6 +252,17 @@ def test_pulse_latency_reaches_the_children(env):
     ({"env": {"PULSE_LATENCY_MSEC": "0"}}, "between 1 and 10000"),
     ({"env": {"PULSE_LATENCY_MSEC": "abc"}}, "must be a number"),
     ({"env": {"STARTUP_DELAY_SEC": "-1"}}, "between 0 and 300"),
+    ({"env": {"SAMPLE_INTERVAL_SEC": "3601"}}, "between 0 and 3600"),
+    ({"env": {"LATENCY_AUTOTUNE": "maybe"}}, "true or false"),
+    ({"env": {"LOG_SPOOL_DIR": "logs"}}, "absolute path"),
+    ({"env": {"LOG_SPOOL_MB": "0"}}, "between 1 and 100000"),
+    ({"env": {"LOG_HISTORY_MB": "-1"}}, "between 0 and 256"),
+    ({"services": {"ledfx": {"max_rss_mb": -1}}}, "between 0 and"),
+    ({"services": {"pulseaudio": {"max_fds": "lots"}}}, "must be a number"),
+    ({"services": {"ledfx": {"cpus": "0-x"}}}, "not a CPU number"),
+    ({"services": {"ledfx": {"nice": 20}}}, "between -20 and 19"),
+    ({"services": {"ledfx": {"sched": "deadline"}}}, "must be one of"),
+    ({"services": {"ledfx": {"cpu_weight": 0}}}, "between 1 and 10000"),
     ({"env": {"NOT_A_SETTING": "1"}}, "unknown setting"),
 ])
 def test_bad_parameters_are_rejected_with_a_reason(env, patch, message):
@@ -205,6 +287,14 @@ def test_changing_the_buffer_restarts_only_the_services_that_read_it(env):
     assert changed == ["ledfx", "squeezelite"]
 
 
+def test_latency_tuning_is_off_unless_asked_for_and_restarts_nothing(env):
+    doc = services.env_defaults("ledfx-suite")
+    assert doc["env"]["LATENCY_AUTOTUNE"] == "false"
+    new, changed = services.apply_patch(doc, {"env": {"LATENCY_AUTOTUNE": True}})
+    assert new["env"]["LATENCY_AUTOTUNE"] == "true"
+    assert changed == []
+
+
 def test_editing_one_service_does_not_disturb_the_others(env):
     doc = services.env_defaults("ledfx-suite")
     _, changed = services.apply_patch(doc, {"services": {"squeezelite": {"name": "New"}}})
@@ -215,3 +305,64 @@ def test_an_unchanged_value_is_not_reported_as_a_change(env):
     doc = services.env_defaults("ledfx-suite")
     _, changed = services.apply_patch(doc, {"services": {"squeezelite": {"name": "Squeez-LedFx"}}})
     assert changed == []
+
+
+def test_pulse_readiness_is_a_socket_that_accepts(env, tmp_path):
+    import socket
+
+    path = str(tmp_path / "native")
+    env.setenv("PULSE_SERVER", "unix:" + path)
+    assert not services.pulse_ready()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    try:
+        assert services.pulse_ready()
+    finally:
+        server.close()
+    assert services.build(services.env_defaults())["pulseaudio"]["ready"] is services.pulse_ready
+
+
+def test_pulse_readiness_never_waits_on_a_daemon_that_does_not_accept(env, tmp_path):
+    import socket
+    import time
+
+    # The loop asks every READY_POLL_S; a daemon too busy to accept must not hold it.
+    path = str(tmp_path / "n")
+    env.setenv("PULSE_SERVER", "unix:" + path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as daemon:
+        daemon.bind(path)
+        daemon.listen(0)
+        # Queued but never accepted: the connect alone is what counts as ready.
+        began = time.monotonic()
+        assert services.pulse_ready()
+        assert time.monotonic() - began < 0.1
+        # Now its backlog is full, where a blocking connect would hang.
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as waiting:
+            waiting.setblocking(False)
+            try:
+                waiting.connect(path)
+            except BlockingIOError:
+                pass
+            began = time.monotonic()
+            assert not services.pulse_ready()
+            assert time.monotonic() - began < 0.1
+
+
+def test_the_pulse_clients_run_after_pulseaudio():
+    specs = services.build(services.env_defaults())
+    assert specs["pulseaudio"]["after"] == []
+    for name in services.PULSE_DEPENDENTS:
+        assert specs[name]["after"] == ["pulseaudio"]
+
+
+def test_a_limit_or_priority_is_not_a_reason_to_restart(env):
+    doc = services.env_defaults()
+    new, changed = services.apply_patch(doc, {"services": {"ledfx": {"max_rss_mb": 800,
+                                                                     "cpus": "2-3",
+                                                                     "cpu_max": 200}}})
+    assert changed == []
+    assert services.build(new)["ledfx"]["cgroup"]["cpu_max"] == 200
+    assert services.build(new)["ledfx"]["priority"]["cpus"] == "2-3"
+    assert services.build(new)["ledfx"]["limits"]["max_rss_mb"] == 800
@@ -1,5 +1,7 @@
 """What the supervisor must keep doing once a browser can drive it."""
 import os
+import sys
+import threading
 import time
 
 from conftest import fake_spec
@@ -136,12 +138,13 @@ def test_a_stopped_service_can_be_started_again(sup):
 
 
 def test_logs_are_captured_into_a_bounded_ring(sup):
-    from supervisor import LOG_LINES
+    import logring
 
     svc = sup.services["ledfx"]
     assert wait_until(lambda: len(svc.logs) > 0)
     assert any("started pid=" in line for line in svc.logs)
-    assert svc.logs.maxlen == LOG_LINES == 200
+    assert svc.logs.maxlen == logring.RING_LINES
+    assert len(svc.logs._arena) == logring.RING_BYTES
 
 
 def test_child_environment_carries_pulse_latency(fast, make_supervisor):
@@ -187,3 +190,421 @@ def test_editing_one_service_does_not_revive_another_that_was_stopped(sup):
     assert wait_until(lambda: sup.services["ledfx"].running)
     assert sup.services["squeezelite"].state == "stopped"
     assert sup.services["squeezelite"].proc is None
+
+
+def test_an_exit_is_noticed_without_waiting_for_a_poll(fast, make_supervisor):
+    import signal
+
+    sup = make_supervisor({"ledfx": fake_spec("ledfx")})
+    svc = sup.services["ledfx"]
+    assert wait_until(lambda: svc.running)
+    assert sup._exits is not None, "pidfd_open should be available on Linux"
+
+    os.kill(svc.proc.pid, signal.SIGKILL)
+    assert wait_until(lambda: svc.last_exit == -signal.SIGKILL, timeout=1.0)
+    assert wait_until(lambda: svc.running)
+
+
+def test_a_quiet_loop_sleeps(fast, make_supervisor, monkeypatch):
+    sup = make_supervisor({"ledfx": fake_spec("ledfx")})
+    assert wait_until(sup.healthy)
+
+    ticks = []
+    real_tick = sup.tick
+    monkeypatch.setattr(sup, "tick", lambda *a: (ticks.append(1), real_tick(*a)))
+    sup._wake.set()
+    time.sleep(1.0)
+    # Polling would have ticked four times a second; settled, it has nothing to
+    # do until the next health refresh.
+    assert len(ticks) <= 2
+
+
+def test_polling_still_restarts_without_pidfd(fast, make_supervisor, monkeypatch):
+    import supervisor as sup_mod
+
+    monkeypatch.setattr(sup_mod._ExitWatcher, "available", staticmethod(lambda: False))
+    sup = make_supervisor({"ledfx": fake_spec("ledfx", "crash")})
+    assert sup._exits is None
+    assert wait_until(lambda: sup.services["ledfx"].restarts >= 1)
+
+
+def test_a_backoff_fires_on_its_deadline_not_on_the_next_poll(fast, make_supervisor):
+    sup = make_supervisor({"ledfx": fake_spec("ledfx", "crash")})
+    svc = sup.services["ledfx"]
+    assert wait_until(lambda: svc.state == "backoff")
+    due = svc.restart_at
+    assert sup._next_deadline() <= due
+
+    assert wait_until(lambda: svc.restarts >= 1)
+    assert time.monotonic() - due < 0.2
+
+
+def test_invalid_utf8_does_not_stop_the_log_pump(fast, make_supervisor, capsys):
+    sup = make_supervisor({"ledfx": fake_spec("ledfx", "garbage")})
+    svc = sup.services["ledfx"]
+
+    # 200KB is more than a pipe buffer holds: had the pump stopped at the bad
+    # bytes, the child would block on write and never print the last line.
+    assert wait_until(lambda: any("survived the garbage" in line for line in svc.logs))
+    fast._writer.flush()
+    assert "bad bytes \ufffd\ufffd here" in capsys.readouterr().out
+    assert svc.log_bytes > 200000
+    assert svc.log_lines >= 2002
+
+
+def test_a_stalled_stdout_drops_and_counts_lines_instead_of_blocking(monkeypatch):
+    import supervisor as sup_mod
+
+    writer = sup_mod._LogWriter(maxsize=5)
+    stall = threading.Event()
+    written = []
+
+    class SlowStdout:
+        def write(self, text):
+            stall.wait(5)
+            written.append(text)
+
+        def flush(self):
+            pass
+
+    monkeypatch.setattr(sys, "stdout", SlowStdout())
+    started = time.monotonic()
+    for i in range(100):
+        writer.put("line %d" % i)
+    assert time.monotonic() - started < 0.5      # the producer never waited
+    assert writer.dropped > 0
+
+    stall.set()
+    writer.flush()
+    text = "".join(written)
+    assert "line 0\n" in text
+    assert "log lines dropped" in text
+
+
+def test_the_published_snapshot_is_immutable_and_versioned(sup):
+    import pytest
+
+    assert wait_until(lambda: sup.snapshot.service("squeezelite")["state"] == "running")
+    snap = sup.snapshot
+    with pytest.raises(TypeError):
+        snap.rows[0]["state"] = "mangled"
+
+    sup.stop("squeezelite").wait(5)
+    # The intent is reported done only once its effect has been published
+    assert sup.snapshot.version > snap.version
+    assert sup.snapshot.service("squeezelite")["state"] == "stopped"
+    assert snap.service("squeezelite")["state"] == "running"   # the old one is untouched
+
+
+def test_reading_status_does_not_touch_the_children(sup, monkeypatch):
+    import subprocess
+
+    assert wait_until(lambda: all_running(sup))
+    polls = []
+    real_poll = subprocess.Popen.poll
+    monkeypatch.setattr(subprocess.Popen, "poll", lambda self: (polls.append(1), real_poll(self))[1])
+    sup.status()
+    assert polls == []
+
+
+def test_clients_start_as_soon_as_pulseaudio_is_ready(fast, make_supervisor):
+    probes = []
+
+    def ready():
+        probes.append(time.monotonic())
+        return len(probes) >= 3
+
+    pulse = fake_spec("pulseaudio")
+    pulse["ready"] = ready
+    started = time.monotonic()
+    sup = make_supervisor({"pulseaudio": pulse, "ledfx": fake_spec("ledfx")},
+                          startup_delay=30, dependents=["ledfx"])
+    # Not the 30s limit: the probe answered on its third try
+    assert time.monotonic() - started < 5
+    assert len(probes) == 3
+    assert wait_until(lambda: sup.services["ledfx"].running)
+
+
+def test_services_waiting_on_the_same_dependency_start_together(fast, make_supervisor):
+    answered = []
+
+    def ready():
+        if len(answered) < 3:
+            answered.append(None)
+            return False
+        answered.append(time.monotonic())
+        return True
+
+    pulse = fake_spec("pulseaudio")
+    pulse["ready"] = ready
+    specs = {"pulseaudio": pulse}
+    for name in ["snapclient", "squeezelite", "ledfx"]:
+        specs[name] = dict(fake_spec(name), after=["pulseaudio"])
+    specs["other"] = fake_spec("other")
+    sup = make_supervisor(specs, startup_delay=30)
+
+    clients = [sup.services[n].started_at for n in ["snapclient", "squeezelite", "ledfx"]]
+    assert min(clients) >= answered[-1]
+    assert max(clients) - min(clients) < 0.5
+    # Nothing made it wait, so it went first alongside pulseaudio
+    assert sup.services["other"].started_at < answered[-1]
+    assert sup.dependents == ["snapclient", "squeezelite", "ledfx"]
+
+
+def test_a_pulseaudio_that_never_answers_still_gets_its_clients_after_the_limit(fast, make_supervisor):
+    pulse = fake_spec("pulseaudio")
+    pulse["ready"] = lambda: False
+    started = time.monotonic()
+    sup = make_supervisor({"pulseaudio": pulse, "ledfx": fake_spec("ledfx")},
+                          startup_delay=1, dependents=["ledfx"])
+    assert 1 <= time.monotonic() - started < 3
+    assert wait_until(lambda: sup.services["ledfx"].running)
+
+
+def test_the_loop_stays_responsive_during_a_pulse_restart(fast, make_supervisor):
+    sup = make_supervisor({"pulseaudio": fake_spec("pulseaudio"),
+                           "ledfx": fake_spec("ledfx", "stubborn"),
+                           "other": fake_spec("other")},
+                          dependents=["ledfx"])
+    assert wait_until(lambda: all_running(sup))
+    # The fake installs its SIGTERM handler just after its second line
+    assert wait_until(lambda: any("PULSE_LATENCY" in line for line in sup.services["ledfx"].logs))
+    time.sleep(0.2)
+
+    restarted = sup.restart("pulseaudio")
+    # ledfx ignores SIGTERM, so the restart sits out the whole grace period;
+    # an unrelated stop must not queue up behind it.
+    assert sup.stop("other").wait(0.5)
+    assert not restarted.is_set()
+
+    assert restarted.wait(10)
+    assert sup.services["ledfx"].running
+    gap = sup.snapshot.service("pulseaudio")["last_gap"]
+    assert gap is not None and gap >= fast.STOP_GRACE_S
+
+
+def test_a_stubborn_restart_does_not_hold_up_other_intents(fast, make_supervisor):
+    sup = make_supervisor({"ledfx": fake_spec("ledfx", "stubborn"),
+                           "other": fake_spec("other")})
+    assert wait_until(lambda: all_running(sup))
+    assert wait_until(lambda: any("PULSE_LATENCY" in line for line in sup.services["ledfx"].logs))
+    time.sleep(0.2)
+    pid = sup.services["ledfx"].proc.pid
+
+    restarted = sup.restart("ledfx")
+    # ledfx sits out the grace period before it is killed; the loop carries
+    # on meanwhile instead of waiting in it.
+    assert sup.stop("other").wait(0.5)
+    assert not restarted.is_set()
+
+    assert restarted.wait(10)
+    assert not pid_alive(pid)
+    assert sup.services["ledfx"].running
+    assert sup.services["ledfx"].proc.pid != pid
+
+
+def test_stopping_pulseaudio_during_its_restart_keeps_it_stopped(fast, make_supervisor):
+    answering = [True]
+    pulse = fake_spec("pulseaudio")
+    pulse["ready"] = lambda: answering[0]
+    sup = make_supervisor({"pulseaudio": pulse, "ledfx": fake_spec("ledfx")},
+                          startup_delay=30, dependents=["ledfx"])
+    assert wait_until(lambda: all_running(sup))
+    svc, old = sup.services["pulseaudio"], sup.services["pulseaudio"].proc.pid
+
+    answering[0] = False
+    restarted = sup.restart("pulseaudio")
+    # The new daemon is up, and the restart is waiting for it to answer
+    assert wait_until(lambda: svc.proc is not None and svc.proc.pid != old)
+    assert sup.stop("pulseaudio").wait(5)
+    assert restarted.is_set()
+    time.sleep(0.3)
+    assert not svc.desired and not svc.running and svc.state == "stopped"
+
+
+def test_a_pulse_restart_takes_over_a_clients_own_restart(fast, make_supervisor):
+    asked = []
+
+    def ready():
+        asked.append(time.monotonic())
+        return len(asked) > 5
+
+    pulse = fake_spec("pulseaudio")
+    pulse["ready"] = ready
+    sup = make_supervisor({"pulseaudio": pulse, "ledfx": fake_spec("ledfx", "stubborn")},
+                          startup_delay=30, dependents=["ledfx"])
+    ledfx = sup.services["ledfx"]
+    assert wait_until(lambda: all_running(sup))
+    assert wait_until(lambda: any("PULSE_LATENCY" in line for line in ledfx.logs))
+    time.sleep(0.2)
+
+    first = sup.restart("ledfx")
+    assert wait_until(lambda: ledfx.held)
+    asked.clear()
+    second = sup.restart("pulseaudio")
+    assert first.wait(10) and second.wait(10)
+    # One new ledfx, started against the new daemon rather than the old one
+    assert ledfx.running and ledfx.restarts == 0
+    assert ledfx.started_at > sup.services["pulseaudio"].started_at
+    assert not ledfx.held
+
+
+def test_shutdown_takes_as_long_as_the_slowest_child_not_the_sum(fast, make_supervisor):
+    sup = make_supervisor({name: fake_spec(name, "stubborn")
+                           for name in ["pulseaudio", "snapclient", "squeezelite", "ledfx"]})
+    assert wait_until(lambda: all(
+        any("PULSE_LATENCY" in line for line in sup.services[n].logs) for n in sup.order))
+    time.sleep(0.2)
+    pids = [sup.services[n].proc.pid for n in sup.order]
+
+    started = time.monotonic()
+    sup.stop_all()
+    # Four children ignoring SIGTERM cost one grace period between them
+    assert time.monotonic() - started < fast.STOP_GRACE_S + 1
+    assert not any(pid_alive(pid) for pid in pids)
+
+
+def test_running_children_are_sampled_from_proc(fast, make_supervisor):
+    sup = make_supervisor({"ledfx": fake_spec("ledfx")}, sample_interval=0.2)
+    assert wait_until(lambda: (sup.readings()[0]["usage"] or {}).get("cpu_percent")
+                      is not None)
+    usage = sup.readings()[0]["usage"]
+    assert usage["rss"] > 0 and usage["threads"] >= 1 and usage["fds"] >= 3
+    assert usage["cpu_percent"] >= 0
+
+    assert sup.stop("ledfx").wait(10)
+    assert sup.readings()[0]["usage"] is None
+
+
+def test_samples_do_not_move_the_snapshot_version(fast, make_supervisor):
+    sup = make_supervisor({"ledfx": fake_spec("ledfx")}, sample_interval=0.05)
+    assert wait_until(lambda: sup.snapshot.healthy and sup.readings()[0]["usage"] is not None)
+    version, usage = sup.snapshot.version, sup.readings()[0]["usage"]
+
+    # Fresh samples keep coming, but nothing a watcher is told about changed
+    assert wait_until(lambda: sup.readings()[0]["usage"] is not usage)
+    time.sleep(0.3)
+    assert sup.snapshot.version == version
+    assert "usage" not in sup.snapshot.service("ledfx")
+
+
+def test_a_service_over_its_memory_limit_is_restarted_but_not_in_a_loop(fast, make_supervisor):
+    spec = dict(fake_spec("ledfx"), limits={"max_rss_mb": 1})  # any python is over 1 MB
+    sup = make_supervisor({"ledfx": spec}, sample_interval=0.1)
+    assert wait_until(lambda: sup.snapshot.service("ledfx")["limit_restarts"] == 1)
+    row = sup.snapshot.service("ledfx")
+    assert "over its 1 MB limit" in row["last_limit"]
+    assert any("over a limit" in line for line in sup.services["ledfx"].logs)
+    assert not any("stopped by operator" in line for line in sup.services["ledfx"].logs)
+
+    # Still over it, but the restart is not repeated within LIMIT_RESTART_S
+    time.sleep(0.5)
+    assert sup.snapshot.service("ledfx")["limit_restarts"] == 1
+    assert wait_until(lambda: sup.services["ledfx"].running)
+
+
+def test_limits_change_without_a_restart(fast, make_supervisor):
+    sup = make_supervisor({"ledfx": fake_spec("ledfx")})
+    assert wait_until(lambda: sup.services["ledfx"].running)
+    pid = sup.services["ledfx"].proc.pid
+    spec = dict(fake_spec("ledfx"), limits={"max_fds": 500})
+    assert sup.reconfigure({"ledfx": spec}, []).wait(5)
+    assert sup.services["ledfx"].limits == {"max_fds": 500}
+    assert sup.services["ledfx"].proc.pid == pid
+
+
+def test_scheduling_is_applied_at_spawn_and_when_changed(fast, make_supervisor):
+    spec = dict(fake_spec("ledfx"), priority={"nice": 5})
+    sup = make_supervisor({"ledfx": spec})
+    assert wait_until(lambda: sup.services["ledfx"].running)
+    pid = sup.services["ledfx"].proc.pid
+    assert os.getpriority(os.PRIO_PROCESS, pid) == 5
+
+    spec = dict(fake_spec("ledfx"), priority={"nice": 7})
+    assert sup.reconfigure({"ledfx": spec}, []).wait(5)
+    assert sup.services["ledfx"].proc.pid == pid  # not restarted
+    assert os.getpriority(os.PRIO_PROCESS, pid) == 7
+
+
+def test_children_go_into_their_own_cgroups(fast, make_supervisor, tmp_path):
+    root = tmp_path / "cg"
+    root.mkdir()
+    (root / "cgroup.controllers").write_text("cpu io memory\n")
+    spec = dict(fake_spec("ledfx"), cgroup={"cpu_max": 50, "cpu_weight": 100, "io_weight": 100})
+    sup = make_supervisor({"ledfx": spec}, sample_interval=0.1, cgroup_root=str(root))
+    assert wait_until(lambda: sup.services["ledfx"].running)
+    assert (root / "ledfx" / "cgroup.procs").read_text() == str(sup.services["ledfx"].proc.pid)
+    assert (root / "ledfx" / "cpu.max").read_text() == "50000 100000"
+
+    (root / "ledfx" / "memory.current").write_text("1048576\n")
+    assert wait_until(lambda: (sup.readings()[0]["cgroup"] or {}).get("memory") == 1048576)
+
+    spec = dict(fake_spec("ledfx"), cgroup={"cpu_max": 0, "cpu_weight": 10, "io_weight": 100})
+    assert sup.reconfigure({"ledfx": spec}, []).wait(5)
+    assert (root / "ledfx" / "cpu.max").read_text() == "max 100000"
+    assert (root / "ledfx" / "cpu.weight").read_text() == "10"
+
+
+def test_an_undivisible_cgroup_leaves_services_where_they_are(fast, make_supervisor, tmp_path):
+    sup = make_supervisor({"ledfx": fake_spec("ledfx")}, cgroup_root=str(tmp_path / "missing"))
+    assert wait_until(lambda: sup.services["ledfx"].running)
+    assert sup.readings()[0]["cgroup"] is None
+
+
+def test_audio_events_in_a_childs_output_are_counted(fast, make_supervisor):
+    sup = make_supervisor({"squeezelite": fake_spec("squeezelite", "dropouts")})
+    assert wait_until(lambda: sup.readings()[0]["events"]["reconnect"] == 1)
+    row = sup.readings()[0]
+    assert row["events"]["underrun"] == 2
+    assert row["events_per_minute"]["underrun"] == 2
+    assert row["last_event"]["type"] == "reconnect"
+
+
+def test_the_latency_tuner_restarts_the_consumers_with_its_value(fast, make_supervisor, monkeypatch):
+    import latency
+
+    monkeypatch.setattr(fast, "LATENCY_CHECK_S", 0.05)
+    monkeypatch.setattr(latency, "UP_UNDERRUNS", 2)
+    monkeypatch.setattr(latency, "SETTLE_S", 0)
+    tuner = latency.LatencyTuner(10, ["squeezelite"])
+    spec = fake_spec("squeezelite", "dropouts")
+    spec["env"] = {"PULSE_LATENCY_MSEC": "10"}
+    sup = make_supervisor({"squeezelite": spec}, tuner=tuner)
+    assert wait_until(lambda: (sup.snapshot.latency or {}).get("msec") == 15)
+    svc = sup.services["squeezelite"]
+    assert wait_until(lambda: any("PULSE_LATENCY_MSEC=15" in line for line in svc.logs))
+    assert sup.snapshot.latency["decisions"][0]["to"] == 15
+    assert any("tuned to 15 ms" in line for line in svc.logs)
+    assert not any("stopped by operator" in line for line in svc.logs)
+    # MIN_CHANGE_S holds it there, whatever the restarted child prints.
+    assert tuner.changes == 1
+
+
+def test_a_spooled_log_numbers_on_from_the_last_run(make_supervisor, tmp_path):
+    from logspool import Spool
+
+    first = make_supervisor({"ledfx": fake_spec("ledfx")}, spool=Spool(str(tmp_path / "logs"), 8))
+    assert wait_until(lambda: any("PULSE_LATENCY" in line for line in first.services["ledfx"].logs))
+    printed = first.services["ledfx"].logs.next_seq
+    first.stop_all()
+    written = first.spool.service("ledfx").read(0, 10000)
+    assert [seq for seq, _, _ in written] == list(range(first.services["ledfx"].logs.next_seq))
+
+    again = make_supervisor({"ledfx": fake_spec("ledfx", enabled=False)},
+                            spool=Spool(str(tmp_path / "logs"), 8))
+    assert again.services["ledfx"].logs.first_seq >= printed
+
+
+def test_limits_with_sampling_off_are_reported_as_unenforced(fast, make_supervisor, monkeypatch):
+    said = []
+    monkeypatch.setattr(fast, "log", lambda level, msg: said.append((level, msg)))
+    specs = {"ledfx": dict(fake_spec("ledfx"), limits={"max_rss_mb": 1}),
+             "squeezelite": dict(fake_spec("squeezelite"), limits={"cpu_window_s": 60})}
+    sup = make_supervisor(specs, sample_interval=0)
+    warned = [msg for level, msg in said if level == "WARN" and "not enforced" in msg]
+    assert len(warned) == 1 and "ledfx" in warned[0] and "squeezelite" not in warned[0]
+
+    specs["squeezelite"]["limits"] = {"max_fds": 64}
+    sup.reconfigure(specs, []).wait(10)
+    warned = [msg for level, msg in said if level == "WARN" and "not enforced" in msg]
+    assert len(warned) == 2 and "squeezelite" in warned[1]